@@ -0,0 +1,101 @@
+"""
+Compares the legacy string-concatenated INSERT with bulk.bulk_insert (COPY FROM STDIN) on the full
+words.txt and structure_released.xml.
+
+Usage:
+    python benchmarks/bulk_ingest.py --dsn "host=... dbname=... user=... password=..." \
+        [--words words.txt] [--structure structure_released.xml] [--repeat 3]
+
+Files which are not given are downloaded from image-net. Rows are written into temporary tables,
+so the database contents are not changed.
+"""
+import sys
+import getopt
+import time
+import psycopg2 as pspg
+import defusedxml.ElementTree as ElementTree
+import imagenet_pkg.util as util
+from imagenet_pkg.bulk import bulk_insert
+from imagenet_pkg.constants import *
+
+
+def _read(path, url):
+    if path:
+        with open(path, 'r') as fp:
+            return fp.read()
+    return util.get(url).text
+
+
+def _load_words(text):
+    words = text.strip(' \n\t').split('\n')
+    return [tuple(w.split('\t')[:2]) for w in words]
+
+
+def _load_structure(text):
+    root = ElementTree.fromstring(text).find('./synset[@wnid]')
+    stack = [root]
+    rows = []
+    while stack:
+        parent = stack.pop()
+        for child in parent.findall('./synset[@wnid]'):
+            rows.append((DEFAULT_RELEASE, parent.get('wnid'), child.get('wnid')))
+            stack.append(child)
+    # same pairs may appear under several parents' subtrees
+    return list(dict.fromkeys(rows))
+
+
+def _legacy_words(cursor, rows):
+    rows = [(wnid, words.replace("'", "''")) for wnid, words in rows]
+    query = 'INSERT INTO bench_classes (wnid, words) VALUES ' + \
+            ','.join([f"('{x[0]}', '{x[1]}') " for x in rows]) + \
+            ' ON CONFLICT DO NOTHING;'
+    cursor.execute(query)
+
+
+def _legacy_structure(cursor, rows):
+    query = 'INSERT INTO bench_structure (release, parent_wnid, child_wnid) VALUES ' + \
+            ','.join([f"('{x[0]}', '{x[1]}', '{x[2]}')" for x in rows]) + \
+            ' ON CONFLICT DO NOTHING;'
+    cursor.execute(query)
+
+
+def _bulk_words(cursor, rows):
+    bulk_insert(cursor, 'bench_classes', ('wnid', 'words'), rows)
+
+
+def _bulk_structure(cursor, rows):
+    bulk_insert(cursor, 'bench_structure', ('release', 'parent_wnid', 'child_wnid'), rows)
+
+
+def _run(conn, fn, rows, repeat):
+    cursor = conn.cursor()
+    timings = []
+    for _ in range(repeat):
+        cursor.execute('ROLLBACK')
+        cursor.execute('CREATE TEMPORARY TABLE bench_classes (LIKE classes INCLUDING ALL);')
+        cursor.execute('CREATE TEMPORARY TABLE bench_structure (LIKE structure INCLUDING ALL);')
+        started = time.perf_counter()
+        fn(cursor, rows)
+        timings.append(time.perf_counter() - started)
+        cursor.execute('ROLLBACK')
+    return min(timings)
+
+
+def main():
+    opts = dict(getopt.getopt(sys.argv[1:], '', ['dsn=', 'words=', 'structure=', 'repeat='])[0])
+    conn = pspg.connect(opts['--dsn'])
+    repeat = int(opts.get('--repeat', 3))
+
+    words = _load_words(_read(opts.get('--words'), IMGNETAPI_ALLWORDS))
+    structure = _load_structure(_read(opts.get('--structure'), IMGNETAPI_STRUCTURE_RELEASED))
+
+    print(f'{"dataset":<12}{"rows":>10}{"legacy, s":>12}{"copy, s":>12}{"speedup":>10}')
+    for name, rows, legacy, bulk in (('words', words, _legacy_words, _bulk_words),
+                                     ('structure', structure, _legacy_structure, _bulk_structure)):
+        t_legacy = _run(conn, legacy, rows, repeat)
+        t_bulk = _run(conn, bulk, rows, repeat)
+        print(f'{name:<12}{len(rows):>10}{t_legacy:>12.3f}{t_bulk:>12.3f}{t_legacy / t_bulk:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
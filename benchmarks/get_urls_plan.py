@@ -0,0 +1,113 @@
+"""
+Compares query plans of the legacy get_urls query (an IN-list of wnid literals, filtered by NOT IN on a LEFT JOIN)
+with the current one (wnids as a single = ANY(array) parameter), on synthetic urls / url_states tables.
+Also shows a scan of pending urls with and without url_states_pending_index.
+
+Usage:
+    python benchmarks/get_urls_plan.py --dsn "host=... dbname=... user=... password=..." \
+        [--urls 14000000] [--classes 21841] [--selected 2000] [--missing-states 0.2] [--keep]
+
+Tables are created in schema bench_get_urls, which is dropped at the end unless --keep is given
+(a kept schema is reused by the next run).
+"""
+import sys
+import getopt
+import time
+import random
+import psycopg2 as pspg
+from imagenet_pkg.constants import *
+
+SCHEMA = 'bench_get_urls'
+
+
+def _create(cursor, urls, classes, missing_states):
+    cursor.execute(f'CREATE SCHEMA {SCHEMA};')
+    cursor.execute(f'CREATE TABLE {SCHEMA}.urls (LIKE public.urls INCLUDING INDEXES);')
+    # indexes of url_states are created explicitly, the partial one is switched on and off below
+    cursor.execute(f'CREATE TABLE {SCHEMA}.url_states (LIKE public.url_states);')
+    cursor.execute(f'ALTER TABLE {SCHEMA}.url_states ADD PRIMARY KEY (url_id);')
+    cursor.execute(f'CREATE INDEX ON {SCHEMA}.url_states (state_id);')
+
+    started = time.perf_counter()
+    cursor.execute(f"INSERT INTO {SCHEMA}.urls (id, release, wnid, url) "
+                   f"SELECT i, '{DEFAULT_RELEASE}', 'n' || lpad((i % {classes})::text, 8, '0'), "
+                   f"       'http://host' || (i % 5000) || '.example.com/images/' || i || '.jpg' "
+                   f"FROM generate_series(1, {urls}) i;")
+    # states are spread over all of ref_url_states, some urls have no state row at all
+    cursor.execute(f"INSERT INTO {SCHEMA}.url_states (url_id, state_id) "
+                   f"SELECT id, 1 + (hashint4(id) & 2147483647) % 5 FROM {SCHEMA}.urls "
+                   f"WHERE random() >= {missing_states};")
+    cursor.execute(f'ANALYZE {SCHEMA}.urls;')
+    cursor.execute(f'ANALYZE {SCHEMA}.url_states;')
+    print(f'Created {urls} urls in {time.perf_counter() - started:.1f} s')
+
+
+def _explain(cursor, title, query, params=None):
+    cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, params)
+    plan = [row[0] for row in cursor.fetchall()]
+    print(f'\n===== {title} =====')
+    print('\n'.join(plan))
+    return plan
+
+
+def _count(cursor, query, params=None):
+    cursor.execute(f'SELECT COUNT(*) FROM ({query.rstrip(";")}) q;', params)
+    return cursor.fetchone()[0]
+
+
+def main():
+    opts = dict(getopt.getopt(sys.argv[1:], '', ['dsn=', 'urls=', 'classes=', 'selected=', 'missing-states=',
+                                                 'keep'])[0])
+    conn = pspg.connect(opts['--dsn'])
+    conn.autocommit = True
+    cursor = conn.cursor()
+    urls = int(opts.get('--urls', 14000000))
+    classes = int(opts.get('--classes', 21841))
+    selected = int(opts.get('--selected', 2000))
+    missing_states = float(opts.get('--missing-states', 0.2))
+
+    cursor.execute('SELECT 1 FROM information_schema.schemata WHERE schema_name = %s;', (SCHEMA,))
+    if not cursor.fetchone():
+        _create(cursor, urls, classes, missing_states)
+    cursor.execute(f'SET search_path = {SCHEMA}, public;')
+
+    wnids = ['n' + str(i).zfill(8) for i in random.Random(0).sample(range(classes), min(selected, classes))]
+    done = ','.join(map(str, URL_STATES_DONE))
+
+    legacy = f"SELECT url.id, url.wnid, url.url, ust.state_id " \
+             f"FROM urls url " \
+             f"     LEFT OUTER JOIN url_states ust " \
+             f"          ON ust.url_id = url.id " \
+             f"WHERE ust.state_id not in ({done})" \
+             f"  AND url.wnid in ({','.join(repr(wnid) for wnid in wnids)}) " \
+             f"ORDER BY ust.state_id, url.wnid;"
+    current = f"SELECT url.id, url.wnid, url.url, ust.state_id " \
+              f"FROM urls url " \
+              f"     LEFT OUTER JOIN url_states ust " \
+              f"          ON ust.url_id = url.id " \
+              f"WHERE url.release = '{DEFAULT_RELEASE}' " \
+              f"  AND url.wnid = ANY(%(wnids)s::varchar[]) " \
+              f"  AND (ust.state_id IS NULL OR ust.state_id NOT IN ({done})) " \
+              f"ORDER BY ust.state_id NULLS FIRST, url.wnid;"
+    pending = f"SELECT url_id FROM url_states WHERE state_id NOT IN ({done}) ORDER BY url_id LIMIT 100000;"
+
+    params = {'wnids': wnids}
+    print(f'rows: legacy {_count(cursor, legacy)}, current {_count(cursor, current, params)} '
+          f'(legacy drops urls without a state row)')
+    _explain(cursor, f'legacy get_urls, {len(wnids)} classes', legacy)
+    _explain(cursor, f'current get_urls, {len(wnids)} classes', current, params)
+
+    # schema-qualified, so that the index of public.url_states is never touched
+    cursor.execute(f'DROP INDEX IF EXISTS {SCHEMA}.url_states_pending_index;')
+    _explain(cursor, 'pending urls, no partial index', pending)
+    cursor.execute(f'CREATE INDEX url_states_pending_index ON {SCHEMA}.url_states (url_id) '
+                   f'WHERE state_id NOT IN ({done});')
+    cursor.execute(f'ANALYZE {SCHEMA}.url_states;')
+    _explain(cursor, 'pending urls, url_states_pending_index', pending)
+
+    if '--keep' not in opts:
+        cursor.execute(f'DROP SCHEMA {SCHEMA} CASCADE;')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Runs N worker processes (imgnet-pull --mode work) against one database and reports throughput, to check that
+leasing scales with the number of workers.
+
+Usage:
+    python benchmarks/parallel_workers.py --dsn "host=... dbname=... user=... password=..." --workers 1,2,4,8 \
+        -- --pg_host ... --pg_dbname ... --pg_user ... --pg_password ... -c n02084071 -R -d /tmp/images
+
+Arguments after "--" are passed to every worker. Urls of the classes must be cached before. Before every round,
+states of urls saved by the previous round are reset, so that every round downloads the same urls (images are
+overwritten in place). Run it against a scratch database only: the reset touches every url of the database.
+"""
+import sys
+import time
+import getopt
+import subprocess
+import psycopg2 as pspg
+from imagenet_pkg.constants import *
+
+
+def _count_saved(cursor):
+    cursor.execute(f'SELECT COUNT(*) FROM url_states WHERE state_id = {URL_STATE_SAVED};')
+    return cursor.fetchone()[0]
+
+
+def _reset(cursor):
+    cursor.execute(f'UPDATE url_states SET state_id = {URL_STATE_NONE}, lease_until = NULL, lease_owner = NULL '
+                   f'WHERE state_id IN ({URL_STATE_SAVED}, {URL_STATE_FAILED}) OR lease_until IS NOT NULL;')
+
+
+def main():
+    argv = sys.argv[1:]
+    worker_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+    opts = dict(getopt.getopt(argv, '', ['dsn=', 'workers='])[0])
+    conn = pspg.connect(opts['--dsn'])
+    conn.autocommit = True
+    cursor = conn.cursor()
+
+    print(f'{"workers":>8}{"saved":>10}{"seconds":>10}{"images/s":>12}')
+    for workers in map(int, opts.get('--workers', '1,2,4').split(',')):
+        _reset(cursor)
+        saved = _count_saved(cursor)
+        started = time.perf_counter()
+        processes = [subprocess.Popen([sys.executable, '-m', 'imagenet_pkg.imagenet_pull', '--mode', 'work',
+                                       *worker_args], stdout=subprocess.DEVNULL)
+                     for _ in range(workers)]
+        for process in processes:
+            process.wait()
+        elapsed = time.perf_counter() - started
+        saved = _count_saved(cursor) - saved
+        print(f'{workers:>8}{saved:>10}{elapsed:>10.1f}{saved / elapsed:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 import imagenet_pkg.class_distributer as cd
 import imagenet_pkg.images_puller as image_puller
-import os
+from imagenet_pkg.db import create_database
+from imagenet_pkg.exporter import ShardExporter
+from imagenet_pkg.reader import DatasetReader
+from imagenet_pkg.planner import PullPlanner
+import concurrent.futures
 from imagenet_pkg.constants import *
 
 
@@ -10,19 +14,71 @@ class ApiSession:
                  imagenet_release=DEFAULT_RELEASE,
                  images_dir='',
                  url_on_fail=URL_ON_FAIL_IGNORE,
-                 max_async_requests=MAX_ASYNC_REQUESTS_DEFAULT):
-        self.class_manager = cd.ClassDistributer(db_conn=db_conn,
+                 max_async_requests=MAX_ASYNC_REQUESTS_DEFAULT,
+                 lazy_init=False,
+                 snapshot_dir=SNAPSHOT_DIR_DEFAULT,
+                 host_limits=None,
+                 retry_policy=None,
+                 save_executor=SAVE_EXECUTOR_THREAD,
+                 save_workers=SAVE_WORKERS_DEFAULT,
+                 save_queue_size=SAVE_QUEUE_SIZE_DEFAULT,
+                 states_batch_size=STATES_BATCH_SIZE_DEFAULT,
+                 states_flush_interval=STATES_FLUSH_INTERVAL_DEFAULT,
+                 storage=STORAGE_DIRECTORY,
+                 dedup=False,
+                 db_pool_size=DB_POOL_SIZE_DEFAULT,
+                 max_body_size=MAX_BODY_SIZE_DEFAULT,
+                 verifier=None):
+        """
+        :param db_conn: a libpq dsn, so that database work of the session runs on a pool of connections,
+        or an open psycopg2 connection, on which all work is serialized (see db.Database)
+        :param lazy_init: if True, the class hierarchy is loaded on first use instead of session initialization
+        :param snapshot_dir: directory of hierarchy snapshots, None disables them
+        :param host_limits: dictionary of util.HostLimiter arguments (e.g. max_concurrency, cooldown),
+        which control per-host concurrency of downloads
+        :param retry_policy: util.RetryPolicy used for failed images if url_on_fail is URL_ON_FAIL_RETRY
+        :param save_executor: SAVE_EXECUTOR_THREAD or SAVE_EXECUTOR_PROCESS, pool which validates and writes images
+        :param save_workers: number of save pool workers
+        :param save_queue_size: maximum number of downloaded images waiting for the save pool
+        :param states_batch_size: url states are written to database in batches of this size
+        :param states_flush_interval: buffered url states are written at least every that many seconds
+        :param storage: STORAGE_DIRECTORY (a file per image) or STORAGE_PACK (images appended to shard files)
+        :param dedup: if True, images whose content is already saved are stored as hardlinks (or pack references)
+        to the saved copy, see content_index.ContentIndex
+        :param db_pool_size: maximum number of pooled connections, if db_conn is a dsn
+        :param max_body_size: downloads larger than that many bytes are aborted (and the url is marked as non-image),
+        0 for no limit. Bodies which don't start like a jpeg are aborted after their first bytes
+        :param verifier: verify.ImageVerifier, which fully decodes images in the save pool (SAVE_EXECUTOR_PROCESS
+        is recommended): corrupt images and placeholders are rejected, large ones downscaled, and dimensions
+        of saved images are recorded in url_states
+        """
+        self.db = create_database(db_conn, pool_size=db_pool_size)
+        self.class_manager = cd.ClassDistributer(db_conn=self.db,
                                                  release=imagenet_release,
                                                  directory=images_dir,
-                                                 max_async_requests=max_async_requests)
+                                                 max_async_requests=max_async_requests,
+                                                 host_limits=host_limits,
+                                                 snapshot_dir=snapshot_dir)
         self.imagenet_puller = image_puller.ImagesWorker(self.class_manager,
-                                                         db_conn=db_conn,
+                                                         db_conn=self.db,
                                                          directory=images_dir,
                                                          imagenet_release=imagenet_release,
                                                          url_on_fail=url_on_fail,
-                                                         max_async_requests=max_async_requests)
+                                                         max_async_requests=max_async_requests,
+                                                         host_limits=host_limits,
+                                                         retry_policy=retry_policy,
+                                                         save_executor=save_executor,
+                                                         save_workers=save_workers,
+                                                         save_queue_size=save_queue_size,
+                                                         states_batch_size=states_batch_size,
+                                                         states_flush_interval=states_flush_interval,
+                                                         storage=storage,
+                                                         dedup=dedup,
+                                                         max_body_size=max_body_size,
+                                                         verifier=verifier)
 
         self._init = False
+        self._lazy_init = lazy_init
 
         self.images_dir = images_dir
 
@@ -30,15 +86,19 @@ class ApiSession:
         self.init()
         return self
 
-    def __exit__(self):
-        pass
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.imagenet_puller.states_writer.close()
+        self.imagenet_puller.store.close()
+        if self.imagenet_puller.content_index is not None:
+            self.imagenet_puller.content_index.close()
+        self.db.close()
 
     def _check_init(self):
         if not self._init:
             raise Exception('Imagenet API Session has not been initialized yet.')
 
     def init(self):
-        self.class_manager.init_db()
+        self.class_manager.init_db(lazy=self._lazy_init)
         self._init = True
 
     def get_wnid_info(self, wnid, recursive=False, deep=None):
@@ -82,21 +142,130 @@ class ApiSession:
         self._check_init()
         return self.class_manager.cache_urls(wnids=wnids)
 
-    def get_urls(self, wnid):
+    def import_urls(self, path=None, wnids=None, workers=IMPORT_WORKERS_DEFAULT):
+        """
+        Imports urls from a local fall11_urls.txt (or a .tgz of it), see ClassDistributer.import_urls
+        :param path: path of the dump, by default it is looked for in the images directory
+        :param wnids: if given, only urls of these wnids are imported
+        :param workers: number of parsing processes
+        """
+        self._check_init()
+        return self.class_manager.import_urls(path=path, wnids=wnids, workers=workers)
+
+    def get_urls(self, wnid, stream=False, batch_size=GET_URLS_BATCH_SIZE_DEFAULT):
         """
         :param wnid: May be either single string or a list or strings
+        :param stream: if True, returns a generator reading urls from a server-side cursor in batches of
+        "batch_size", which may be passed to fetch() directly
         :return: (url_id, wnid, url, state_id)
         """
         self._check_init()
-        return self.class_manager.get_urls(wnid)
+        return self.class_manager.get_urls(wnid, stream=stream, batch_size=batch_size)
 
-    def fetch(self, urls):
+    def fetch(self, urls, skip_existing=False, targets=None):
         """
         Downloads given urls
         :param urls: list of urls
+        :param skip_existing: if True, urls whose image is already stored are marked as saved without a request
+        :param targets: dictionary of wnid: number of images to save, urls of a class are not requested anymore
+        once its target is reached (see fetch_targets)
+        """
+        self._check_init()
+        return self.imagenet_puller.fetch(urls, skip_existing=skip_existing, targets=targets)
+
+    async def fetch_async(self, urls, skip_existing=False, targets=None):
+        """
+        Downloads given urls in the running event loop, so that applications can run pulls in their own loop.
+        Database reads (e.g. of get_urls(stream=True)), image writes and url state writes run in threads.
+        :param urls: iterable or async iterable of (url_id, wnid, url, state_id)
+        :param skip_existing: if True, urls whose image is already stored are marked as saved without a request
+        :param targets: dictionary of wnid: number of images to save (see fetch_targets)
+        """
+        self._check_init()
+        await self.imagenet_puller.fetch_async(urls, skip_existing=skip_existing, targets=targets)
+
+    def fetch_targets(self, wnids, fetch_ratio):
+        """
+        Returns dictionary of wnid: number of images still to save, so that "fetch_ratio" of urls of every class
+        are saved. Passed to fetch(), it stops requesting urls of classes which reached the ratio.
+        """
+        self._check_init()
+        return self.imagenet_puller.fetch_targets(wnids, fetch_ratio)
+
+    def select_classes(self, wnids, max_classes=None, strategy=PLAN_STRATEGY_STRATIFIED, seed=None):
+        """
+        Picks a balanced subset of classes (see planner.PullPlanner), e.g. of wnids of a recursive pull
+        :param max_classes: number of classes, all classes picked by "strategy" if None
+        :param strategy: PLAN_STRATEGY_LEAVES, PLAN_STRATEGY_DEPTH or PLAN_STRATEGY_STRATIFIED
+        :param seed: the same seed picks the same classes
+        :return: list of wnids
+        """
+        self._check_init()
+        planner = PullPlanner(max_classes=max_classes, strategy=strategy, seed=seed)
+        return planner.select_classes(self.get_wnid_info(list(wnids)))
+
+    def plan_urls(self, wnids, per_class):
+        """
+        Plans the urls needed to save "per_class" images of every class, over-provisioned by the failure rate
+        measured per host and class (see planner.PullPlanner). Urls of classes are cached first.
+        :return: (list of (url_id, wnid, url, state_id), dictionary of wnid: number of images still to save),
+        to be passed to fetch() as "urls" and "targets"
+        """
+        self._check_init()
+        wnids = list(wnids)
+        self.cache_urls(wnids)
+        planner = PullPlanner(per_class=per_class)
+        return planner.select_urls(wnids, self.imagenet_puller.get_url_states(wnids))
+
+    def url_stats(self, wnids=None, recursive=False, deep=None):
+        """
+        Returns numbers of urls by state over the subtree (the class and its descendants) of every class. Urls of
+        all classes are counted by one grouped query, and summed up the hierarchy in one bottom-up pass.
+        :param wnids: list of wnids, all classes of the hierarchy if None
+        :param recursive: if True, descendants of "wnids" are returned too, "deep" limits the depth
+        :return: list of dictionaries of wnid, level and numbers of urls, saved, failed, non_image and dead urls
+        """
+        self._check_init()
+        totals = self.class_manager.get_subtree_totals(self.imagenet_puller.url_counts())
+        if wnids is None:
+            wnids = self.class_manager.get_wnids()
+        elif recursive:
+            wnids = [info[0] for info in self.get_wnid_info(list(wnids), recursive=True, deep=deep)]
+        empty = (0,) * len(URL_STATS_COLUMNS)
+        return [
+            {'wnid': wnid, 'level': self.class_manager.levels.get(wnid),
+             **dict(zip(URL_STATS_COLUMNS, totals.get(wnid) or empty))}
+            for wnid in wnids
+        ]
+
+    def work(self, wnids, batch_size=LEASE_BATCH_SIZE_DEFAULT, lease_timeout=LEASE_TIMEOUT_DEFAULT, owner=None):
+        """
+        Downloads pending urls of wnids in worker mode, so that many processes (on many machines) can share one
+        pull: urls are leased in batches from url_states with FOR UPDATE SKIP LOCKED (see ImagesWorker.work).
+        Urls of wnids must be cached before.
+        :param batch_size: urls leased at once
+        :param lease_timeout: seconds after which urls leased by a crashed worker are leased again
+        :param owner: worker name written to leases, host:pid by default
+        """
+        self._check_init()
+        return self.imagenet_puller.work(wnids, batch_size=batch_size, lease_timeout=lease_timeout, owner=owner)
+
+    def reconcile(self, wnids, workers=RESUME_SCAN_WORKERS_DEFAULT):
+        """
+        Marks urls of wnids whose image is stored as saved, and resets saved urls whose image is missing,
+        so that an interrupted or restarted pull requests only missing images
+        :param workers: number of threads scanning stored images
+        :return: dictionary of numbers of urls marked as saved and reset
+        """
+        self._check_init()
+        return self.imagenet_puller.reconcile(wnids, workers=workers)
+
+    def revalidate(self, wnids):
+        """
+        Requests saved images of wnids again with If-None-Match / If-Modified-Since, changed images are replaced
         """
         self._check_init()
-        return self.imagenet_puller.fetch(urls)
+        return self.imagenet_puller.revalidate(wnids)
 
     def clean_all(self):
         self._check_init()
@@ -108,31 +277,90 @@ class ApiSession:
         self.imagenet_puller.clean()
 
     def images_data_iter(self, wnid):
+        """
+        Yields images of wnid as bytes, or as memoryview if images are stored in pack files
+        """
         self._check_init()
-
-        for filename in self.images_filenames_iter(wnid):
-            with open(filename, mode='rb') as fp:
-                yield fp.read()
+        return self.imagenet_puller.store.data_iter(wnid)
 
     def images_filenames_iter(self, wnid):
+        """
+        Yields image file names of wnid. Not supported by STORAGE_PACK
+        """
+        self._check_init()
+        return self.imagenet_puller.store.filenames_iter(wnid)
+
+    def images_keys_iter(self, wnid):
+        """
+        Yields keys (file names without extension) of images of wnid
+        """
+        self._check_init()
+        return self.imagenet_puller.store.keys_iter(wnid)
+
+    def read_image(self, wnid, key):
+        self._check_init()
+        return self.imagenet_puller.store.read(wnid, key)
+
+    def export(self, wnids, output_dir, shard_size=EXPORT_SHARD_SIZE_DEFAULT, workers=EXPORT_WORKERS_DEFAULT,
+               shuffle_buffer=EXPORT_SHUFFLE_BUFFER_DEFAULT, seed=None):
+        """
+        Exports saved images of wnids into tar shards (see exporter.ShardExporter). Images exported by
+        earlier runs into the same directory are skipped.
+        :param shard_size: maximum shard size in bytes
+        :param workers: number of threads writing shards
+        :param shuffle_buffer: samples of all classes are shuffled through a buffer of that size, 0 disables it
+        :param seed: seed of shuffling
+        :return: dictionary of stats (exported samples, written shards)
+        """
         self._check_init()
-        directory = os.path.join(self.images_dir, wnid)
-        if not os.path.isdir(directory):
-            return
-        list_files = os.listdir(directory)
+        exporter = ShardExporter(self, output_dir, shard_size=shard_size, workers=workers,
+                                 shuffle_buffer=shuffle_buffer, seed=seed)
+        return exporter.export(wnids)
 
-        for file_name in list_files:
-            if not file_name.lower().endswith('.jpg'):
-                continue
-            file_name = os.path.join(self.images_dir, wnid, file_name)
-            yield file_name
+    def reader(self, wnids, recursive=False, deep=None, decode=False, image_size=None, batch_size=None,
+               shuffle=True, seed=0, rank=0, world_size=1, drop_last=False, workers=READER_WORKERS_DEFAULT,
+               prefetch=READER_PREFETCH_DEFAULT):
+        """
+        Returns a reader of saved images of wnids (see reader.DatasetReader), which yields (image, label, wnid),
+        or (images, labels, wnids) batches if "batch_size" is given. Images are read ahead by "workers" threads.
+        :param recursive: if True, descendants of wnids are read too, "deep" limits the depth
+        :param decode: if True, images are decoded into HxWx3 uint8 NumPy arrays (requires numpy and Pillow)
+        :param image_size: (width, height) decoded images are resized to, required for batches of decoded images
+        :param seed: seed of shuffling, must be the same on every rank
+        :param rank: index of this reader among "world_size" readers of data-parallel training
+        :param drop_last: if True, samples which don't fill every rank and the last partial batch are dropped
+        :param prefetch: number of images read ahead
+        """
+        self._check_init()
+        return DatasetReader(self, wnids, recursive=recursive, deep=deep, decode=decode, image_size=image_size,
+                             batch_size=batch_size, shuffle=shuffle, seed=seed, rank=rank, world_size=world_size,
+                             drop_last=drop_last, workers=workers, prefetch=prefetch)
 
-    def count_images(self, wnid):
+    def dedup_report(self):
+        """
+        :return: dictionary of unique images, duplicates and bytes saved by deduplication, None if it is off
+        """
         self._check_init()
-        directory = os.path.join(self.images_dir, wnid)
-        if not os.path.isdir(directory):
-            return
+        return self.imagenet_puller.dedup_report()
 
-        count = len(list(self.images_filenames_iter(wnid)))
+    def images_entries(self, wnid):
+        """
+        Returns list of (key, size, sha256, width, height) of saved images of wnid, from the manifest of the
+        class. sha256 and dimensions are None if unknown (always with STORAGE_PACK)
+        """
+        self._check_init()
+        return self.imagenet_puller.store.entries(wnid) or []
 
-        return count
+    def count_images(self, wnid, recursive=False, deep=None, workers=MANIFEST_READ_WORKERS_DEFAULT):
+        """
+        Returns the number of saved images of wnid, None if nothing was saved for it. Counted from manifests,
+        the class directory isn't listed
+        :param recursive: if True, images of descendants are counted too, "deep" limits the depth
+        :param workers: number of threads reading manifests of descendants
+        """
+        self._check_init()
+        if not recursive:
+            return self.imagenet_puller.store.count(wnid)
+        wnids = [wnid] + self.class_manager.get_wnids(parent=wnid, deep=deep)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            return sum(count or 0 for count in pool.map(self.imagenet_puller.store.count, wnids))
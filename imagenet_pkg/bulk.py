@@ -0,0 +1,64 @@
+import psycopg2 as pspg
+import psycopg2.extensions
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class RowsReader:
+    """
+    File-like object which streams rows in COPY text format, so that rows don't have to be
+    materialized as a single string.
+    """
+
+    def __init__(self, rows):
+        self._lines = ('\t'.join(_copy_value(v) for v in row) + '\n' for row in rows)
+        self._buffer = ''
+        self.rows = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+            self.rows += 1
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def bulk_insert(cursor, table, columns, rows, on_conflict='ON CONFLICT DO NOTHING', returning=None):
+    """
+    Streams rows over COPY FROM STDIN into a temporary staging table, and moves them into "table" with a single
+    INSERT ... SELECT. Transaction handling is left to the caller.
+    :param cursor: psycopg2 cursor
+    :param table: target table
+    :param columns: list of target columns, in the order of rows' values
+    :param rows: iterable of tuples
+    :param on_conflict: ON CONFLICT clause of the final INSERT
+    :param returning: optional RETURNING expression of the final INSERT, its rows are returned
+    :return: number of inserted (or updated) rows, or list of returned rows if "returning" is set
+    """
+    cursor: pspg.extensions.cursor
+    columns_str = ', '.join(columns)
+    staging = f'{table}_staging'
+
+    cursor.execute(f'DROP TABLE IF EXISTS {staging};')
+    # types only, target's constraints and defaults are applied by the final INSERT
+    cursor.execute(f'CREATE TEMPORARY TABLE {staging} AS SELECT {columns_str} FROM {table} WITH NO DATA;')
+    cursor.copy_expert(f'COPY {staging} ({columns_str}) FROM STDIN', RowsReader(rows))
+
+    query = f'INSERT INTO {table} ({columns_str}) SELECT {columns_str} FROM {staging} {on_conflict or ""}'
+    if returning:
+        query += f' RETURNING {returning}'
+    cursor.execute(query + ';')
+    result = cursor.fetchall() if returning else cursor.rowcount
+
+    cursor.execute(f'DROP TABLE {staging};')
+    return result
@@ -1,41 +1,114 @@
 import os
 import re
+import tarfile
 import itertools
+import concurrent.futures
 import imagenet_pkg.util as util
+from imagenet_pkg.db import Database, create_database
+from imagenet_pkg.url_writer import UrlsWriter
+from imagenet_pkg.hierarchy import HierarchyIndex
+from imagenet_pkg.snapshot import load_snapshot, save_snapshot
 from collections import defaultdict
 from imagenet_pkg.constants import *
-import psycopg2 as pspg
-import psycopg2.extensions
-import os
 import defusedxml.ElementTree as ElementTree
 
 
+_import_wnids = None
+
+
+def _init_import_worker(wnids):
+    global _import_wnids
+    _import_wnids = wnids
+
+
+def _parse_urls_chunk(data):
+    """
+    Parses lines "<wnid>_<number>\\t<url>" of an urls dump. Runs in an import pool worker.
+    :param data: bytes of whole lines
+    :return: (list of (wnid, url), number of skipped lines)
+    """
+    rows = []
+    skipped = 0
+    for line in data.split(b'\n'):
+        image_id, sep, url = line.rstrip(b'\r').partition(b'\t')
+        if not sep or not url:
+            skipped += bool(line.strip())
+            continue
+        try:
+            wnid = image_id.split(b'_', 1)[0].decode('ascii')
+            url = url.strip().decode('utf-8')
+        except UnicodeDecodeError:
+            skipped += 1
+            continue
+        # unknown wnids would violate the foreign key of urls
+        if _import_wnids is not None and wnid not in _import_wnids:
+            skipped += 1
+            continue
+        rows.append((wnid, url))
+    return rows, skipped
+
+
+def _read_chunks(fp, chunk_size):
+    """
+    Yields chunks of whole lines read from a binary file object
+    """
+    rest = b''
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            break
+        data = rest + data
+        end = data.rfind(b'\n') + 1
+        if not end:
+            rest = data
+            continue
+        rest = data[end:]
+        yield data[:end]
+    if rest:
+        yield rest
+
+
 class ClassDistributer:
+    # attributes built by _set_classes_db(), which are stored in the snapshot
+    _SNAPSHOT_ATTRIBUTES = ('wnids', 'words', 'short_words', 'parent_children', 'child_parent',
+                            'hierarchy', 'paths', 'levels')
 
-    def __init__(self, db_conn, directory=None, release=None, max_async_requests=MAX_ASYNC_REQUESTS_DEFAULT):
+    def __init__(self, db_conn, directory=None, release=None, max_async_requests=MAX_ASYNC_REQUESTS_DEFAULT,
+                 host_limits=None, snapshot_dir=SNAPSHOT_DIR_DEFAULT, urls_batch_size=URLS_BATCH_SIZE_DEFAULT):
+        """
+        :param db_conn: db.Database, a dsn or an open psycopg2 connection (see db.create_database)
+        :param snapshot_dir: directory of hierarchy snapshots, which make startup fast. If None, the hierarchy
+        is always built from database
+        :param urls_batch_size: cached urls are written to database in transactions of that many urls
+        """
         # self.env = env
+        self.wnids = None
         self.words = None
         self.short_words = None
         self.parent_children = None
         self.child_parent = None
         self.paths = None
         self.levels = None
+        self.hierarchy: HierarchyIndex = None
 
-        self.db_conn: pspg.extensions.connection = db_conn
-        self.db_cursor: pspg.extensions.cursor = self.db_conn.cursor()
+        self.db: Database = create_database(db_conn)
 
         self.directory = directory
         self.release = release
         self.max_async_requests = max_async_requests
+        self.host_limits = host_limits
+        self.snapshot_dir = snapshot_dir
+        self.urls_batch_size = urls_batch_size
+        self._loaded = False
 
     def _sql_insert(self, query):
-        self.db_cursor.execute('ROLLBACK')
-        self.db_cursor.execute(query)
-        self.db_conn.commit()
+        self.db.execute(query)
 
-    def _sql_select(self, query):
-        self.db_cursor.execute(query)
-        return self.db_cursor.fetchall()
+    def _sql_bulk_insert(self, table, columns, rows, on_conflict='ON CONFLICT DO NOTHING'):
+        return self.db.bulk_insert(table, columns, rows, on_conflict=on_conflict)
+
+    def _sql_select(self, query, params=None):
+        return self.db.select(query, params)
 
     def _cache_data(self, datatype):
         """
@@ -71,26 +144,19 @@ class ClassDistributer:
 
             hierarchy = list(itertools.chain.from_iterable([_get_structure(base_elem) for base_elem in base_elements]))
 
-            query = f"INSERT INTO structure (release, parent_wnid, child_wnid) VALUES " + \
-                    ','.join([f"('{self.release}', '{x[0]}', '{x[1]}')" for x in hierarchy]) + \
-                    ' ON CONFLICT DO NOTHING;'
-            self._sql_insert(query)
+            self._sql_bulk_insert('structure', ('release', 'parent_wnid', 'child_wnid'),
+                                  ((self.release, parent, child) for parent, child in hierarchy))
         elif datatype == 'classes':
             url = IMGNETAPI_ALLWORDS
-            words = util.get(url).text.replace("'", "''")
+            words = util.get(url).text
             words = words.strip(' \n\t').split('\n')
-            words = [tuple(str(w).split('\t')) for w in words]
+            words = [tuple(str(w).split('\t')[:2]) for w in words]
 
-            query = f'INSERT INTO classes (wnid, words) VALUES ' + \
-                    ','.join([f"('{x[0]}', '{x[1]}') " for x in words]) + \
-                    ' ON CONFLICT DO NOTHING;'
-            self._sql_insert(query)
+            self._sql_bulk_insert('classes', ('wnid', 'words'), words)
         elif datatype == 'hierarchy':
-            data_str = [f"('{wnid}', '{self.paths[wnid]}')" for wnid in self.paths]
-            query = f"INSERT INTO classes (wnid, hierarchy) VALUES " + \
-                    ','.join(data_str) + \
-                    " ON CONFLICT (wnid) DO UPDATE SET hierarchy = EXCLUDED.hierarchy;"
-            self._sql_insert(query)
+            self._sql_bulk_insert('classes', ('wnid', 'hierarchy'),
+                                  ((wnid, self.paths[wnid]) for wnid in self.paths),
+                                  on_conflict='ON CONFLICT (wnid) DO UPDATE SET hierarchy = EXCLUDED.hierarchy')
         else:
             raise Exception(f'Invalid datatype {datatype}')
 
@@ -101,16 +167,14 @@ class ClassDistributer:
         """
         print(f'Trying to get {datatype}...')
         if datatype == 'structure':
-            self.db_cursor.execute(f'SELECT COUNT(*) FROM structure WHERE release = \'{self.release}\';')
-            cnt = self.db_cursor.fetchone()[0]
+            cnt = self._sql_select(f'SELECT COUNT(*) FROM structure WHERE release = \'{self.release}\';')[0][0]
             if not cnt:
                 self._cache_data(datatype)
             query = f'SELECT parent_wnid, child_wnid FROM structure WHERE release = \'{self.release}\';'
             hierarchy = self._sql_select(query)
             return hierarchy
         elif datatype == 'classes':
-            self.db_cursor.execute(f'SELECT COUNT(*) FROM classes;')
-            cnt = self.db_cursor.fetchone()[0]
+            cnt = self._sql_select(f'SELECT COUNT(*) FROM classes;')[0][0]
             if not cnt:
                 self._cache_data(datatype)
             query = f'SELECT wnid, words FROM classes;'
@@ -125,6 +189,7 @@ class ClassDistributer:
         If 'recursive' is True, either returns all childs attributes, if False,
         returns just (wnid, short_name, full_name, path)
         """
+        self._ensure_loaded()
 
         if isinstance(wnids, str):
             wnid = wnids
@@ -135,16 +200,43 @@ class ClassDistributer:
             for wnid in wnids
         ]
 
-    def _set_classes_db(self):
-        def _get_path_of(wnid):
-            # if it has a parent
-            if wnid in self.child_parent:
-                parent = self.child_parent[wnid]
-                return os.path.join(_get_path_of(parent), wnid)
-            return wnid
+    def _get_fingerprint(self):
+        """
+        Row counts and checksums of classes and structure, computed by the server, which tell whether
+        a snapshot is still valid
+        """
+        query = f"SELECT (SELECT COUNT(*) FROM classes), " \
+                f"       (SELECT COALESCE(SUM(hashtext(wnid || ' ' || COALESCE(words, ''))::bigint), 0) " \
+                f"        FROM classes), " \
+                f"       (SELECT COUNT(*) FROM classes WHERE hierarchy IS NULL), " \
+                f"       (SELECT COUNT(*) FROM structure WHERE release = '{self.release}'), " \
+                f"       (SELECT COALESCE(SUM(hashtext(parent_wnid || ' ' || child_wnid)::bigint), 0) " \
+                f"        FROM structure WHERE release = '{self.release}');"
+        return tuple(self._sql_select(query)[0])
+
+    def _load_snapshot(self):
+        data = load_snapshot(self.snapshot_dir, self.release, self._get_fingerprint())
+        if data is None:
+            return False
+        for attr in self._SNAPSHOT_ATTRIBUTES:
+            setattr(self, attr, data[attr])
+        return True
+
+    def _save_snapshot(self):
+        data = {attr: getattr(self, attr) for attr in self._SNAPSHOT_ATTRIBUTES}
+        try:
+            save_snapshot(self.snapshot_dir, self.release, self._get_fingerprint(), data)
+        except OSError as ex:
+            print(f'Cannot save hierarchy snapshot: {ex}')
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._set_classes_db()
 
-        def _get_paths():
-            return {wnid: _get_path_of(wnid) for wnid in self.words}
+    def _set_classes_db(self):
+        if self.snapshot_dir and self._load_snapshot():
+            self._loaded = True
+            return
 
         # first get classes
         classes = self._get_data('classes')
@@ -163,35 +255,79 @@ class ClassDistributer:
         self.parent_children = {key: gb[key] for key in gb}
         self.child_parent = {x[1]: x[0] for x in structure}
 
-        self.paths = _get_paths()
-        self.levels = {
-            wnid: len(re.findall(r'n\d{8}', self.paths[wnid]))
-            for wnid in self.paths
-        }
+        self.hierarchy = HierarchyIndex(self.wnids, self.child_parent, self.parent_children)
+        self.paths = self.hierarchy.get_paths()
+        self.levels = self.hierarchy.get_levels()
 
         query = f"SELECT COUNT(*) FROM classes WHERE hierarchy IS NULL;"
         cnt = self._sql_select(query)[0][0]
         if cnt:
             self._cache_data('hierarchy')
 
+        self._loaded = True
+        if self.snapshot_dir:
+            self._save_snapshot()
+
     def _is_cached(self, wnid):
         query = f'SELECT 1 FROM urls ' \
                 f'WHERE release = \'{self.release}\' ' \
                 f'  AND wnid = \'{wnid}\' ' \
                 f'LIMIT 1'
-        self.db_cursor.execute(query)
-        cnt = self.db_cursor.fetchone()
-        return cnt > 0
+        return bool(self._sql_select(query))
 
     def _get_list_cached_urls_wnids(self):
         query = f'SELECT DISTINCT wnid FROM urls WHERE release = \'{self.release}\';'
         wnids = list(itertools.chain.from_iterable(self._sql_select(query)))  # get flatten list of wnids
         return set(wnids)
 
-    def init_db(self, debug=False):
+    def _migrate(self):
+        """
+        Brings databases created by older versions up to date. Columns and indexes are added only if they are
+        missing, as ALTER TABLE locks url_states exclusively even if it changes nothing, and a worker starting
+        during a pull would block every other session using url_states until the lock is granted
+        """
+        # databases created before the 'dead' url state was introduced
+        self._sql_insert(f"INSERT INTO ref_url_states (id, name) VALUES ({URL_STATE_DEAD}, 'dead') "
+                         f"ON CONFLICT DO NOTHING;")
+        columns = [
+            # validators of conditional requests
+            ('etag', 'character varying(500)'),
+            ('last_modified', 'character varying(100)'),
+            # leases of pending urls by workers
+            ('lease_until', 'timestamp with time zone'),
+            ('lease_owner', 'character varying(200)'),
+            # dimensions of verified images
+            ('width', 'integer'),
+            ('height', 'integer'),
+        ]
+        query = "SELECT column_name FROM information_schema.columns " \
+                "WHERE table_schema = current_schema() AND table_name = 'url_states';"
+        existing = set(itertools.chain.from_iterable(self._sql_select(query)))
+        missing = [f'ADD COLUMN IF NOT EXISTS {name} {type_name}'
+                   for name, type_name in columns if name not in existing]
+        if missing:
+            self._sql_insert(f"ALTER TABLE url_states {', '.join(missing)};")
+
+        # indexes added to image-net.sql after the first release
+        indexes = [
+            ('url_states_state_index', '(state_id)'),
+            ('url_states_pending_index', f"(url_id) WHERE state_id NOT IN ({','.join(map(str, URL_STATES_DONE))})"),
+        ]
+        query = "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = 'url_states';"
+        existing = set(itertools.chain.from_iterable(self._sql_select(query)))
+        for name, definition in indexes:
+            if name not in existing:
+                self._sql_insert(f"CREATE INDEX IF NOT EXISTS {name} ON url_states {definition};")
+
+    def init_db(self, debug=False, lazy=False):
+        """
+        :param lazy: if True, the hierarchy is loaded on first use instead
+        """
         if debug:
             print('Initializing data...')
-        self._set_classes_db()
+        self._migrate()
+        if not lazy:
+            self._set_classes_db()
 
     def cache_urls(self, wnids):
         """
@@ -205,30 +341,89 @@ class ClassDistributer:
             'total': len(urls)
         }
 
+        # url lists of many wnids are written together, and only new urls get a state row
+        writer = UrlsWriter(self.db, self.release, batch_size=self.urls_batch_size)
+
         def print_stats():
-            print(f'\r[LOADING URLS] [LOADED/TOTAL] {stats["loaded"]}/{stats["total"]}', end='')
+            print(f'\r[LOADING URLS] [LOADED/TOTAL] {stats["loaded"]}/{stats["total"]} ({writer.stats_line()})',
+                  end='')
 
         def on_fetch(response):
             (url, wnid), data = response
-            urls_list_str = [(wnid, u.replace("'", "''")) for u in re.split(r'[\n\r]+', data.decode('utf-8'))]
+            writer.add(wnid, (u for u in re.split(r'[\n\r]+', data.decode('utf-8')) if u))
 
-            query = f"INSERT INTO urls (release, wnid, url) VALUES " + \
-                    ','.join([
-                        f"('{self.release}', '{wnid}', '{url}')" for wnid, url in urls_list_str
-                    ]) + f" ON CONFLICT DO NOTHING;"
-            self._sql_insert(query)
+            stats["loaded"] += 1
 
-            query = f"INSERT INTO url_states (url_id, state_id) " \
-                    f"    (SELECT url.id as url_id, 1 as state_id FROM urls url " \
-                    f"     WHERE url.wnid = '{wnid}') " \
-                    f"ON CONFLICT (url_id) DO UPDATE SET state_id = EXCLUDED.state_id;"
-            self._sql_insert(query)
+            print_stats()
 
-            stats["loaded"] += 1
+        with writer:
+            util.fetch_with_callback(urls, on_fetch, on_fail=URL_ON_FAIL_RETRY, async_limit=self.max_async_requests,
+                                     host_limits=self.host_limits)
+        print_stats()
+
+    def _find_urls_dump(self):
+        for name in URLS_DUMP_NAMES:
+            if self.directory and os.path.isfile(os.path.join(self.directory, name)):
+                return os.path.join(self.directory, name)
+        raise Exception(f'Urls dump not found, expected one of {", ".join(URLS_DUMP_NAMES)} in "{self.directory}"')
+
+    def _iter_dump_chunks(self, path):
+        if path.endswith('.txt'):
+            with open(path, 'rb') as fp:
+                yield from _read_chunks(fp, IMPORT_CHUNK_SIZE)
+            return
+        # the archive is read as a stream, it is never unpacked to disk
+        with tarfile.open(path, mode='r|*') as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith('.txt'):
+                    yield from _read_chunks(tar.extractfile(member), IMPORT_CHUNK_SIZE)
+
+    def import_urls(self, path=None, wnids=None, workers=IMPORT_WORKERS_DEFAULT):
+        """
+        Imports urls from a local dump (fall11_urls.txt, or a .tgz of it) instead of requesting url lists of
+        every wnid. The dump is read in chunks, which are parsed by a process pool, and urls are written by
+        UrlsWriter. Urls which are already cached are skipped, so the import may be repeated.
+        :param path: path of the dump, by default it is looked for in the images directory
+        :param wnids: if given, only urls of these wnids are imported
+        :param workers: number of parsing processes
+        :return: dictionary of stats
+        """
+        path = path or self._find_urls_dump()
+        # urls reference classes, which are cached on the first load
+        self._ensure_loaded()
+        if wnids is None:
+            wnids = [row[0] for row in self._sql_select('SELECT wnid FROM classes;')]
+        print(f'Importing urls from {path}...')
 
+        stats = {'chunks': 0, 'skipped': 0}
+        writer = UrlsWriter(self.db, self.release, batch_size=self.urls_batch_size)
+
+        def print_stats():
+            print(f'\r[IMPORTING URLS] [CHUNKS/SKIPPED LINES] {stats["chunks"]}/{stats["skipped"]} '
+                  f'({writer.stats_line()})', end='')
+
+        def on_parsed(future):
+            rows, skipped = future.result()
+            writer.add_rows(rows)
+            stats['chunks'] += 1
+            stats['skipped'] += skipped
             print_stats()
 
-        util.fetch_with_callback(urls, on_fetch, on_fail=URL_ON_FAIL_RETRY, async_limit=self.max_async_requests)
+        with writer, concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                            initializer=_init_import_worker,
+                                                            initargs=(frozenset(wnids),)) as pool:
+            pending = []
+            for chunk in self._iter_dump_chunks(path):
+                pending.append(pool.submit(_parse_urls_chunk, chunk))
+                # a few chunks per worker are in flight, so that memory doesn't depend on the dump size
+                if len(pending) >= workers * 2:
+                    on_parsed(pending.pop(0))
+            for future in pending:
+                on_parsed(future)
+        print_stats()
+        print()
+        stats.update({'urls': writer.received, 'new': writer.inserted})
+        return stats
 
     def get_classes_info(self, wnids, recursive=False, deep=None):
         """
@@ -239,6 +434,7 @@ class ClassDistributer:
         :return: array of (wnid, short_name, full_name, path)
         """
         # get_wnids returns array of (wnid, short_name, full_name, path)
+        self._ensure_loaded()
         if recursive:
             childs = [self.get_wnids(parent=wnid, deep=deep) for wnid in wnids]
             childs = list(itertools.chain.from_iterable(childs))
@@ -247,36 +443,35 @@ class ClassDistributer:
             wnids = wnids + childs
         return self._get_classes_info(wnids)
 
+    def get_subtree_totals(self, counts):
+        """
+        :param counts: dictionary of wnid: tuple of numbers
+        :return: dictionary of wnid: tuple of sums of "counts" over wnid and its descendants, for every wnid
+        """
+        self._ensure_loaded()
+        return self.hierarchy.subtree_totals(counts)
+
     def get_wnids(self, parent=None, deep=None):
         """
         Returns list of wnids
-        :param parent: if specified, list of "parent"s childred returned.
+        :param parent: if specified, list of "parent"s childred returned, each child once.
         Note that "parent" is not returned within the list.
         :param deep: if "parent" specified, "deep" specifies how deep hierarchy of children
         :return: list of wnids
         """
-
-        def _get_childs(parent, deep, level):
-            if parent not in self.parent_children:
-                return []
-
-            childs = self.parent_children[parent]
-
-            if not deep or level < deep:
-                for child in childs:
-                    childs = childs + _get_childs(child, deep, level + 1)
-
-            return childs
+        self._ensure_loaded()
 
         if parent:
-            return _get_childs(parent, deep, 1)
+            return self.hierarchy.get_descendants(parent, deep)
 
         return self.wnids
 
-    def get_urls(self, wnid):
+    def get_urls(self, wnid, stream=False, batch_size=GET_URLS_BATCH_SIZE_DEFAULT):
         """
         returns array of (url_id, wnid, url, state_id)
         :param wnid:
+        :param stream: if True, returns a generator which reads rows from a server-side cursor in batches of
+        "batch_size", so that memory doesn't depend on the number of urls
         :return:
         """
 
@@ -288,19 +483,25 @@ class ClassDistributer:
             wnids = wnid
             self.cache_urls(wnids)  # this function checks cache state of given wnids.
 
-        wnids_str = [f"'{wnid}'" for wnid in wnids]
+        # wnids are passed as a single array parameter, so the query text (and its planning time) doesn't grow
+        # with the number of classes. Urls without a state row haven't been requested yet, they come first.
         query = f"SELECT url.id, url.wnid, url.url, ust.state_id " \
                 f"FROM urls url " \
                 f"     LEFT OUTER JOIN url_states ust " \
                 f"          ON ust.url_id = url.id " \
-                f"WHERE ust.state_id not in (3, 4)" \
-                f"  AND url.wnid in ({','.join(wnids_str)})" \
-                f"ORDER BY ust.state_id, url.wnid;"  # state_id(4) - downloaded, state_id(3) - not jpeg
-        data = self._sql_select(query)
+                f"WHERE url.release = '{self.release}' " \
+                f"  AND url.wnid = ANY(%(wnids)s::varchar[]) " \
+                f"  AND (ust.state_id IS NULL OR ust.state_id NOT IN ({','.join(map(str, URL_STATES_DONE))})) " \
+                f"ORDER BY ust.state_id NULLS FIRST, url.wnid;"
+        params = {'wnids': list(wnids)}
+        if stream:
+            return self.db.stream(query, params, batch_size=batch_size)
+        data = self._sql_select(query, params)
 
         return data
 
     def clean(self):
+        self._loaded = False
         queries = [
             f"TRUNCATE url_states CASCADE;",
             f"TRUNCATE urls CASCADE;",
@@ -1,3 +1,5 @@
+import os
+
 IMGNETAPI_CHILDS = 'http://www.image-net.org/api/text/wordnet.structure.hyponym?wnid={0}'
 IMGNETAPI_ALL_CHILDS = IMGNETAPI_CHILDS + '&full=1'
 IMGNETAPI_URLS = 'http://www.image-net.org/api/text/imagenet.synset.geturls?wnid={0}'
@@ -16,15 +18,143 @@ MODE_SAVE_CLASSES = 2
 MODE_CACHE_URLS = 4
 MODE_CLEAR_IMAGES = 8
 MODE_CLEAR_DATABASE = 16
+MODE_EXPORT = 32
+MODE_IMPORT_URLS = 64
+MODE_WORK = 128
+MODE_STATS = 256
 
 MAX_ASYNC_REQUESTS_DEFAULT = 150
 MAX_RECONNECT_ATTEMPTS = 3
+FETCH_QUEUE_SIZE_FACTOR = 2  # work queue holds at most FETCH_QUEUE_SIZE_FACTOR * async_limit elements
+FETCH_ROWS_CHUNK = 1000  # url rows read (and checked against stored images) by a thread at once
+
+# streamed response bodies (see util.BodyPolicy)
+MAX_BODY_SIZE_DEFAULT = 32 << 20  # bytes
+BODY_CHUNK_SIZE = 64 << 10  # bytes
+SNIFF_SIZE = 12  # bytes needed to recognize image types by their magic bytes
+SPOOL_DIR_NAME = '.incoming'  # bodies being received, in the images directory
+
+# per-host AIMD concurrency limiter (see util.HostLimiter)
+HOST_INITIAL_CONCURRENCY_DEFAULT = 4
+HOST_MAX_CONCURRENCY_DEFAULT = 30
+HOST_DECREASE_FACTOR_DEFAULT = 0.5
+HOST_LATENCY_TARGET_DEFAULT = 5.0  # seconds, slower responses decrease host concurrency
+HOST_MAX_FAILURES_DEFAULT = 5  # consecutive failures before the host is put on a cooldown
+HOST_COOLDOWN_DEFAULT = 30.0  # seconds
+HOST_MAX_COOLDOWN_DEFAULT = 600.0  # seconds
+HOST_MAX_COOLDOWNS_DEFAULT = 3  # cooldowns in a row before the host is considered dead
+HOST_MAX_PARKED_DEFAULT = 10000
+HOST_EWMA_ALPHA = 0.2
 
 URL_ON_FAIL_IGNORE = 0
 URL_ON_FAIL_RETRY = 1
 URL_SUCCESS = 1
 URL_FAILED = 0
 
+# ref_url_states
+URL_STATE_NONE = 1
+URL_STATE_FAILED = 2
+URL_STATE_NON_IMAGE = 3
+URL_STATE_SAVED = 4
+URL_STATE_DEAD = 5  # retry policy gave up on the url, it is skipped by later runs
+URL_STATES_DONE = (URL_STATE_NON_IMAGE, URL_STATE_SAVED, URL_STATE_DEAD)
+URL_STATS_COLUMNS = ('urls', 'saved', 'failed', 'non_image', 'dead')  # see ImagesWorker.url_counts
+STATS_FORMAT_TABLE = 'table'
+STATS_FORMAT_JSON = 'json'
+
+# classes of fetch errors (see util.classify_exception, util.classify_status)
+FETCH_ERROR_DNS = 'dns'
+FETCH_ERROR_NOT_FOUND = 'not-found'  # 404, 410
+FETCH_ERROR_CLIENT = 'client'  # other 4xx
+FETCH_ERROR_SERVER = 'server'  # 5xx, 429
+FETCH_ERROR_TIMEOUT = 'timeout'
+FETCH_ERROR_CONNECTION = 'connection'
+FETCH_ERROR_HOST_DEAD = 'host-dead'  # the host was given up by util.HostLimiter
+FETCH_ERROR_OTHER = 'other'
+FETCH_ERROR_NON_IMAGE = 'non-image'  # the body doesn't start with magic bytes of an accepted image type
+FETCH_ERROR_TOO_LARGE = 'too-large'  # the body exceeds the maximum body size
+
+# hierarchy snapshots (see snapshot.py)
+SNAPSHOT_DIR_DEFAULT = os.path.join(os.path.expanduser('~'), '.cache', 'imagenet_pkg')
+SNAPSHOT_VERSION = 1
+
+# image storage (see image_store.py)
+STORAGE_DIRECTORY = 'dir'
+STORAGE_PACK = 'pack'
+PACK_DIR_NAME = 'packs'
+PACK_MAX_SHARD_SIZE_DEFAULT = 1 << 30  # bytes
+CONTENT_INDEX_NAME = 'content-index.sqlite3'  # see content_index.ContentIndex
+
+# per-class manifests of stored images (see image_store.DirectoryStore)
+MANIFEST_NAME = '.manifest'  # per-class list of stored images, in the class directory
+MANIFEST_READ_WORKERS_DEFAULT = 16  # threads reading manifests of a subtree
+
+# save stage (see images_puller._SaveStage)
+SAVE_EXECUTOR_THREAD = 'thread'
+SAVE_EXECUTOR_PROCESS = 'process'
+SAVE_WORKERS_DEFAULT = 4
+SAVE_QUEUE_SIZE_DEFAULT = 256  # downloaded images waiting to be saved
+
+# decode and verify stage of the save pool (see verify.ImageVerifier)
+VERIFY_QUALITY_DEFAULT = 90  # JPEG quality of downscaled images
+
+# url states writer (see state_writer.UrlStatesWriter)
+STATES_BATCH_SIZE_DEFAULT = 5000
+STATES_FLUSH_INTERVAL_DEFAULT = 5.0  # seconds
+
+# leasing of pending urls by workers (see ImagesWorker.work)
+LEASE_BATCH_SIZE_DEFAULT = 1000
+LEASE_TIMEOUT_DEFAULT = 600  # seconds, urls leased by a crashed worker are leased again after that
+LEASE_POLL_INTERVAL = 10  # seconds
+LEASE_RENEWALS_PER_TIMEOUT = 3  # leases of urls in flight are renewed this many times per lease timeout
+
+# offline urls import (see ClassDistributer.import_urls)
+URLS_DUMP_NAMES = ('fall11_urls.txt', 'fall11_urls.tgz', 'fall11_urls.tar.gz')
+IMPORT_CHUNK_SIZE = 16 << 20  # bytes of the dump parsed by a worker at once
+IMPORT_WORKERS_DEFAULT = os.cpu_count() or 4
+URLS_BATCH_SIZE_DEFAULT = 200000  # urls written per transaction by url_writer.UrlsWriter
+GET_URLS_BATCH_SIZE_DEFAULT = 10000  # rows per round trip of get_urls(stream=True)
+DB_POOL_SIZE_DEFAULT = 8  # connections of db.Database, e.g. states writer, leasing and a streamed query at once
+
+# resume (see images_puller.ImagesWorker.reconcile)
+RESUME_SCAN_WORKERS_DEFAULT = 16
+RESUME_CHUNK_WNIDS = 500  # classes reconciled at once
+
+# tar shards export (see exporter.py)
+EXPORT_SHARD_SIZE_DEFAULT = 1 << 30  # bytes
+EXPORT_WORKERS_DEFAULT = 4
+EXPORT_SHUFFLE_BUFFER_DEFAULT = 100000  # samples
+EXPORT_MANIFEST_NAME = 'manifest.json'
+EXPORT_KEYS_NAME = 'exported.txt'
+
+# dataset reader (see reader.DatasetReader)
+READER_WORKERS_DEFAULT = 16
+READER_PREFETCH_DEFAULT = 256  # images read ahead
+
+# balanced pull planning (see planner.PullPlanner)
+PLAN_STRATEGY_LEAVES = 'leaves'
+PLAN_STRATEGY_DEPTH = 'depth'
+PLAN_STRATEGY_STRATIFIED = 'stratified'
+PLAN_STRATEGIES = (PLAN_STRATEGY_LEAVES, PLAN_STRATEGY_DEPTH, PLAN_STRATEGY_STRATIFIED)
+PLAN_SUCCESS_RATE_DEFAULT = 0.5  # expected share of saved images before anything was requested
+PLAN_PRIOR_WEIGHT = 20  # requests after which a host's (class') own success rate outweighs the broader one
+
+# retry policy (see util.RetryPolicy)
+RETRY_MAX_ATTEMPTS_DEFAULT = 5
+RETRY_BASE_DELAY_DEFAULT = 2.0  # seconds
+RETRY_MAX_DELAY_DEFAULT = 120.0  # seconds
+RETRY_ATTEMPTS_BY_ERROR = {
+    FETCH_ERROR_DNS: 2,
+    FETCH_ERROR_NOT_FOUND: 1,
+    FETCH_ERROR_CLIENT: 1,
+    FETCH_ERROR_SERVER: 5,
+    FETCH_ERROR_TIMEOUT: 4,
+    FETCH_ERROR_CONNECTION: 4,
+    FETCH_ERROR_OTHER: 3,
+    FETCH_ERROR_NON_IMAGE: 1,
+    FETCH_ERROR_TOO_LARGE: 1,
+}
+
 LEVEL_1_WNIDS = (
 
 )
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import threading
+
+
+class ContentIndex:
+    """
+    Index of saved images by sha256 of their content, kept in an SQLite file next to the images, so that save
+    pool threads and processes can share it without the postgres connection. Images with known content are
+    stored as references to the first copy (see DirectoryStore.link, PackStore.link) instead of being written
+    again. The object is picklable, every thread opens its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL;')
+            conn.execute('PRAGMA synchronous=NORMAL;')
+            conn.execute('CREATE TABLE IF NOT EXISTS content ('
+                         '    hash TEXT PRIMARY KEY,'
+                         '    wnid TEXT NOT NULL,'
+                         '    key TEXT NOT NULL,'
+                         '    size INTEGER NOT NULL,'
+                         '    refs INTEGER NOT NULL DEFAULT 0);')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def lookup(self, digest):
+        """
+        :return: (wnid, key) of the image with content hash "digest", or None
+        """
+        row = self._connection().execute('SELECT wnid, key FROM content WHERE hash = ?;', (digest,)).fetchone()
+        return tuple(row) if row else None
+
+    def add(self, digest, wnid, key, size):
+        """
+        Registers a written image. It replaces an entry of the same content, whose image is gone or can't be
+        linked (otherwise the image would have been stored as a reference), the number of references is kept.
+        """
+        self._connection().execute('INSERT OR REPLACE INTO content (hash, wnid, key, size, refs) '
+                                   'VALUES (?, ?, ?, ?, COALESCE((SELECT refs FROM content WHERE hash = ?), 0));',
+                                   (digest, wnid, key, size, digest))
+
+    def add_reference(self, digest):
+        self._connection().execute('UPDATE content SET refs = refs + 1 WHERE hash = ?;', (digest,))
+
+    def report(self):
+        """
+        :return: dictionary of unique images, duplicates stored as references and bytes saved by them
+        """
+        row = self._connection().execute('SELECT COUNT(*), COALESCE(SUM(refs), 0), COALESCE(SUM(refs * size), 0) '
+                                         'FROM content;').fetchone()
+        return {'unique': row[0], 'duplicates': row[1], 'bytes_saved': row[2]}
+
+    def clean(self):
+        if os.path.isfile(self.path):
+            self._connection().execute('DELETE FROM content;')
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
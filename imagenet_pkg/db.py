@@ -0,0 +1,162 @@
+import itertools
+import threading
+import contextlib
+from imagenet_pkg.constants import *
+from imagenet_pkg.bulk import bulk_insert
+import psycopg2 as pspg
+import psycopg2.pool
+import psycopg2.extensions
+
+
+class Database:
+    """
+    Data access shared by ClassDistributer, ImagesWorker and the url writers. Given a dsn, it owns a pool of
+    "pool_size" connections, so that e.g. the url states writer thread, leasing and a streamed url query run
+    concurrently, each on its own connection. Given an open connection, all work is serialized on it (the
+    behaviour of sessions created with a connection). Every connection() block is a transaction: it is
+    committed at the end and rolled back on error, so callers never see an aborted transaction.
+    """
+
+    def __init__(self, dsn=None, conn=None, pool_size=DB_POOL_SIZE_DEFAULT):
+        """
+        :param dsn: libpq connection string, connections are pooled
+        :param conn: an open psycopg2 connection, used instead of a pool. It is not closed by close()
+        :param pool_size: maximum number of pooled connections, further users wait for a free one
+        """
+        if (dsn is None) == (conn is None):
+            raise Exception('Either dsn or conn must be given')
+        self.conn: pspg.extensions.connection = conn
+        self.pool = pspg.pool.ThreadedConnectionPool(1, pool_size, dsn) if dsn is not None else None
+        # ThreadedConnectionPool raises when it is exhausted instead of waiting
+        self._slots = threading.BoundedSemaphore(pool_size) if dsn is not None else None
+        self._conn_lock = threading.RLock()
+
+        self._prepared = {}  # id(connection): names of statements prepared on it
+        self._cursor_numbers = itertools.count()
+
+    @property
+    def shared(self):
+        """
+        True if all work is serialized on a single connection
+        """
+        return self.pool is None
+
+    def _get(self):
+        if self.shared:
+            self._conn_lock.acquire()
+            return self.conn
+        self._slots.acquire()
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _put(self, conn):
+        if self.shared:
+            self._conn_lock.release()
+            return
+        if conn.closed:
+            self._prepared.pop(id(conn), None)
+        self.pool.putconn(conn, close=bool(conn.closed))
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Yields a connection for a single transaction
+        """
+        conn = self._get()
+        try:
+            # a connection of an interrupted caller may be left inside a transaction
+            conn.rollback()
+            yield conn
+            conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._put(conn)
+
+    def execute(self, query, params=None, fetch=False):
+        """
+        Runs "query" in its own transaction
+        :param fetch: if True, returns all rows of the result
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall() if fetch else None
+
+    def select(self, query, params=None):
+        return self.execute(query, params, fetch=True)
+
+    def execute_prepared(self, name, query, params=(), fetch=False):
+        """
+        Runs a statement which is prepared once per connection, for queries which are repeated many times
+        (e.g. leasing). "query" uses $1, $2... placeholders, "params" are passed in that order.
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                prepared = self._prepared.setdefault(id(conn), set())
+                if name not in prepared:
+                    cursor.execute(f'PREPARE {name} AS {query}')
+                    prepared.add(name)
+                args = f' ({", ".join(["%s"] * len(params))})' if params else ''
+                cursor.execute(f'EXECUTE {name}{args};', tuple(params))
+                return cursor.fetchall() if fetch else None
+
+    def bulk_insert(self, table, columns, rows, on_conflict='ON CONFLICT DO NOTHING', returning=None):
+        """
+        bulk.bulk_insert in its own transaction
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                return bulk_insert(cursor, table, columns, rows, on_conflict=on_conflict, returning=returning)
+
+    def stream(self, query, params=None, batch_size=GET_URLS_BATCH_SIZE_DEFAULT):
+        """
+        Yields rows of "query" from a named (server-side) cursor, "batch_size" rows per round trip. A pooled
+        connection is kept by the generator until it is exhausted or closed. On a shared connection the cursor
+        is declared WITH HOLD, so that it survives commits of other users between batches.
+        """
+        name = f'stream_{next(self._cursor_numbers)}'
+        if not self.shared:
+            with self.connection() as conn:
+                with conn.cursor(name=name) as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(query, params)
+                    yield from cursor
+            return
+
+        with self.connection() as conn:
+            cursor = conn.cursor(name=name, withhold=True)
+            cursor.execute(query, params)
+        try:
+            while True:
+                with self._conn_lock:
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            with self._conn_lock:
+                cursor.close()
+                self.conn.commit()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+
+
+def create_database(db_conn, pool_size=DB_POOL_SIZE_DEFAULT):
+    """
+    :param db_conn: a Database (returned as is), a dsn string (connections are pooled)
+    or an open psycopg2 connection (work is serialized on it)
+    """
+    if isinstance(db_conn, Database):
+        return db_conn
+    if isinstance(db_conn, str):
+        return Database(dsn=db_conn, pool_size=pool_size)
+    return Database(conn=db_conn)
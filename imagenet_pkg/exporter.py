@@ -0,0 +1,231 @@
+import os
+import io
+import re
+import glob
+import json
+import queue
+import random
+import tarfile
+import tempfile
+import threading
+from imagenet_pkg.constants import *
+
+
+def _tar_size(length):
+    # member header + data padded to 512 bytes blocks
+    return tarfile.BLOCKSIZE + (length + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+
+class _ShardWriter:
+    """
+    Writes samples to consecutive shards, each shard is written as <name>.tar.tmp and renamed when finished,
+    so that a crashed export never leaves a partial shard behind.
+    """
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.tar = None
+        self.path = None
+        self.size = 0
+        self.keys = []
+
+    def _open(self):
+        self.path = self.exporter.next_shard_path()
+        self.tar = tarfile.open(self.path + '.tmp', mode='w')
+        self.size = 0
+        self.keys = []
+
+    def _add_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def write(self, wnid, key, img_bytes, label, meta):
+        cls = str(label).encode('ascii')
+        meta = json.dumps(meta).encode('utf-8')
+        size = _tar_size(len(img_bytes)) + _tar_size(len(cls)) + _tar_size(len(meta))
+        if self.tar is None or (self.keys and self.size + size > self.exporter.shard_size):
+            self.finish()
+            self._open()
+
+        sample_key = f'{wnid}_{key}'
+        self._add_member(sample_key + '.jpg', img_bytes)
+        self._add_member(sample_key + '.cls', cls)
+        self._add_member(sample_key + '.json', meta)
+        self.size += size
+        self.keys.append(f'{wnid}/{key}')
+
+    def finish(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.exporter.shard_done(self.path, self.keys)
+        self.tar = None
+
+
+class ShardExporter:
+    """
+    Exports saved images into WebDataset style tar shards of up to "shard_size" bytes: every sample is
+    <wnid>_<key>.jpg, .cls (label index) and .json (wnid, label, name, path). Samples of all classes are shuffled
+    through a buffer of "shuffle_buffer" samples, and shards are written by "workers" threads.
+    The export is incremental: exported keys are appended to exported.txt and label indices are kept in
+    manifest.json, so that a next run writes only new images, into new shards.
+    """
+
+    def __init__(self, api, output_dir, shard_size=EXPORT_SHARD_SIZE_DEFAULT, workers=EXPORT_WORKERS_DEFAULT,
+                 shuffle_buffer=EXPORT_SHUFFLE_BUFFER_DEFAULT, seed=None):
+        """
+        :param api: api.ApiSession, images and class info are read through it
+        :param shuffle_buffer: samples are shuffled through a buffer of that size, 0 disables shuffling
+        """
+        self.api = api
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.workers = workers
+        self.shuffle_buffer = shuffle_buffer
+        self.random = random.Random(seed)
+
+        self.manifest = None
+        self._lock = threading.Lock()
+        self._shard_no = 0
+        self._error = None
+        self.stats = {'exported': 0, 'shards': 0}
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.output_dir, EXPORT_MANIFEST_NAME)
+
+    @property
+    def keys_path(self):
+        return os.path.join(self.output_dir, EXPORT_KEYS_NAME)
+
+    def _load(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        # shards of an interrupted export
+        for path in glob.glob(os.path.join(self.output_dir, 'shard-*.tar.tmp')):
+            os.unlink(path)
+
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r') as fp:
+                self.manifest = json.load(fp)
+        else:
+            self.manifest = {'classes': {}, 'shards': [], 'samples': 0}
+
+        numbers = [int(m.group(1)) for m in (re.search(r'shard-(\d+)\.tar$', p)
+                                             for p in glob.glob(os.path.join(self.output_dir, 'shard-*.tar'))) if m]
+        self._shard_no = max(numbers) + 1 if numbers else 0
+
+        exported = set()
+        if os.path.isfile(self.keys_path):
+            with open(self.keys_path, 'r') as fp:
+                exported.update(line.strip() for line in fp if line.strip())
+        return exported
+
+    def _save_manifest(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.output_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self.manifest, fp, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def next_shard_path(self):
+        with self._lock:
+            number, self._shard_no = self._shard_no, self._shard_no + 1
+        return os.path.join(self.output_dir, f'shard-{number:06d}.tar')
+
+    def shard_done(self, path, keys):
+        with self._lock:
+            with open(self.keys_path, 'a') as fp:
+                fp.write(''.join(key + '\n' for key in keys))
+            self.manifest['shards'].append({'name': os.path.basename(path),
+                                            'samples': len(keys),
+                                            'size': os.path.getsize(path)})
+            self.manifest['samples'] += len(keys)
+            self._save_manifest()
+            self.stats['exported'] += len(keys)
+            self.stats['shards'] += 1
+            self._print_stats()
+
+    def _print_stats(self):
+        print(f'\r[EXPORTED/SHARDS] {self.stats["exported"]}/{self.stats["shards"]}', end='')
+
+    def _samples(self, wnids, exported):
+        """
+        Yields (wnid, key) of images not exported yet, shuffled through the buffer
+        """
+        wnids = list(wnids)
+        if self.shuffle_buffer:
+            self.random.shuffle(wnids)
+
+        buffer = []
+        for wnid in wnids:
+            for key in self.api.images_keys_iter(wnid):
+                if f'{wnid}/{key}' in exported:
+                    continue
+                if not self.shuffle_buffer:
+                    yield wnid, key
+                    continue
+                buffer.append((wnid, key))
+                if len(buffer) >= self.shuffle_buffer:
+                    i = self.random.randrange(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield buffer.pop()
+        self.random.shuffle(buffer)
+        yield from buffer
+
+    def _work(self, samples):
+        writer = _ShardWriter(self)
+        while True:
+            sample = samples.get()
+            if sample is None:
+                break
+            if self._error is not None:
+                continue  # keep draining, so that the producer doesn't block
+            wnid, key, label, meta = sample
+            try:
+                writer.write(wnid, key, self.api.read_image(wnid, key), label, meta)
+            except Exception as ex:
+                self._error = ex
+        if self._error is None:
+            try:
+                writer.finish()
+            except Exception as ex:
+                self._error = ex
+
+    def export(self, wnids):
+        """
+        :param wnids: list of wnids to export
+        :return: dictionary of stats (exported samples, written shards)
+        """
+        exported = self._load()
+
+        classes = self.manifest['classes']
+        info = {x[0]: x for x in self.api.get_wnid_info(list(wnids))}
+        # label indices of already exported classes never change
+        for wnid in sorted(info):
+            if wnid not in classes:
+                classes[wnid] = len(classes)
+
+        samples = queue.Queue(maxsize=self.workers * 64)
+        threads = [threading.Thread(target=self._work, args=(samples,)) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for wnid, key in self._samples(info, exported):
+                if self._error is not None:
+                    break
+                _, short_name, _, path = info[wnid]
+                samples.put((wnid, key, classes[wnid],
+                             {'wnid': wnid, 'label': classes[wnid], 'name': short_name, 'path': path}))
+        finally:
+            for _ in threads:
+                samples.put(None)
+            for thread in threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+        with self._lock:
+            self._save_manifest()
+        print()
+        return self.stats
@@ -0,0 +1,202 @@
+import os
+import bisect
+from array import array
+
+
+class HierarchyIndex:
+    """
+    Precomputed index of the class hierarchy. Every wnid gets an integer id, and the tree given by
+    "child_parent" (the one class paths are built from) is laid out by an iterative DFS: entry/exit times of the
+    Euler tour, depths and parent pointers are kept in compact arrays. The subtree of a node is then a contiguous
+    range of the DFS order, which makes descendant enumeration linear in output size and "is-descendant-of"
+    checks O(1).
+    Some synsets have several parents. Edges which are not part of the tree are kept aside, and descendant queries
+    follow them too, so that the result is the same as walking "parent_children".
+    """
+
+    def __init__(self, wnids, child_parent, parent_children):
+        """
+        :param wnids: list of all wnids
+        :param child_parent: dictionary of child wnid: parent wnid
+        :param parent_children: dictionary of parent wnid: list of children wnids
+        """
+        self.wnids = list(wnids)
+        self.ids = {wnid: i for i, wnid in enumerate(self.wnids)}
+        n = len(self.wnids)
+
+        self.parent = array('i', [-1]) * n
+        for child, parent in child_parent.items():
+            self.parent[self.ids[child]] = self.ids[parent]
+
+        tree_children = [[] for _ in range(n)]
+        extra_children = {}
+        for parent, children in parent_children.items():
+            for child in children:
+                if child_parent.get(child) == parent:
+                    tree_children[self.ids[parent]].append(self.ids[child])
+                else:
+                    extra_children.setdefault(self.ids[parent], []).append(self.ids[child])
+
+        self.tin = array('i', [-1]) * n
+        self.tout = array('i', [-1]) * n
+        self.depth = array('i', [0]) * n
+        self.order = array('i')  # node ids in DFS order, order[tin[x]] == x
+
+        # roots first, then whatever is left (e.g. nodes on a parent cycle)
+        roots = [i for i in range(n) if self.parent[i] == -1]
+        for root in roots + list(range(n)):
+            if self.tin[root] != -1:
+                continue
+            self._dfs(root, tree_children)
+
+        self.extra_children = extra_children
+        # entry times of nodes having extra children, to find them inside a subtree range with bisect
+        self.extra_tins = array('i', sorted(self.tin[x] for x in extra_children))
+
+    def _dfs(self, root, tree_children):
+        self.depth[root] = 0 if self.parent[root] == -1 or self.tin[self.parent[root]] == -1 \
+            else self.depth[self.parent[root]] + 1
+        stack = [(root, 0)]
+        self.tin[root] = len(self.order)
+        self.order.append(root)
+        while stack:
+            node, i = stack[-1]
+            children = tree_children[node]
+            if i < len(children):
+                stack[-1] = (node, i + 1)
+                child = children[i]
+                if self.tin[child] != -1:
+                    continue
+                self.depth[child] = self.depth[node] + 1
+                self.tin[child] = len(self.order)
+                self.order.append(child)
+                stack.append((child, 0))
+            else:
+                self.tout[node] = len(self.order)
+                stack.pop()
+
+    def __contains__(self, wnid):
+        return wnid in self.ids
+
+    def get_depth(self, wnid):
+        """
+        :return: depth of wnid, where roots have depth 0
+        """
+        return self.depth[self.ids[wnid]]
+
+    def get_parent(self, wnid):
+        parent = self.parent[self.ids[wnid]]
+        return self.wnids[parent] if parent != -1 else None
+
+    def get_ancestors(self, wnid):
+        """
+        :return: list of ancestors of wnid, from the direct parent up to the root
+        """
+        result = []
+        node = self.parent[self.ids[wnid]]
+        while node != -1:
+            result.append(self.wnids[node])
+            node = self.parent[node]
+        return result
+
+    def is_descendant(self, wnid, ancestor):
+        """
+        O(1) check whether "wnid" lies in the subtree of "ancestor" (wnid itself excluded),
+        following the tree class paths are built from.
+        """
+        node, anc = self.ids[wnid], self.ids[ancestor]
+        return self.tin[anc] < self.tin[node] < self.tout[anc]
+
+    def _subtree(self, root, deep, base, levels, result):
+        # base is level of "root" below the queried node, levels keeps the lowest level every node was reached at
+        tin, tout, depth, order = self.tin, self.tout, self.depth, self.order
+        root_depth = depth[root]
+        pos, end = tin[root] + 1, tout[root]
+        while pos < end:
+            node = order[pos]
+            level = depth[node] - root_depth + base
+            if deep and level > deep:
+                pos = tout[node]  # skip the whole subtree
+                continue
+            if node in levels:
+                if not deep or levels[node] <= level:
+                    pos = tout[node]  # the subtree has already been walked
+                    continue
+            else:
+                result.append(node)
+            levels[node] = level
+            pos += 1
+
+        # follow edges which are not part of the tree
+        nested = []
+        if self.extra_children:
+            lo = bisect.bisect_left(self.extra_tins, tin[root])
+            hi = bisect.bisect_left(self.extra_tins, end)
+            for source_tin in self.extra_tins[lo:hi]:
+                source = order[source_tin]
+                level = depth[source] - root_depth + base
+                if deep and level >= deep:
+                    continue
+                nested.extend((child, level + 1) for child in self.extra_children[source])
+        return nested
+
+    def get_descendants(self, wnid, deep=None):
+        """
+        Returns list of descendants of wnid (wnid itself excluded) in DFS order, each wnid once.
+        :param deep: if specified, only descendants at most "deep" levels below wnid are returned
+        """
+        if wnid not in self.ids:
+            return []
+
+        levels = {}
+        result = []
+        stack = [(self.ids[wnid], 0)]
+        while stack:
+            root, base = stack.pop()
+            if base:
+                if root in levels:
+                    if not deep or levels[root] <= base:
+                        continue
+                else:
+                    result.append(root)
+                levels[root] = base
+            stack.extend(reversed(self._subtree(root, deep, base, levels, result)))
+        return [self.wnids[x] for x in result]
+
+    def subtree_totals(self, counts):
+        """
+        Sums "counts" over the subtree of every node in one bottom-up pass (reversed DFS order), following the
+        tree class paths are built from: a synset with several parents is counted under its path's parent only.
+        :param counts: dictionary of wnid: tuple of numbers, missing wnids count as zeros
+        :return: dictionary of wnid: tuple of sums over wnid and its descendants, for every wnid
+        """
+        width = len(next(iter(counts.values()))) if counts else 0
+        totals = [[0] * width for _ in range(len(self.wnids))]
+        for wnid, values in counts.items():
+            if wnid in self.ids:
+                totals[self.ids[wnid]] = list(values)
+        for node in reversed(self.order):
+            parent = self.parent[node]
+            # a parent entered later closes a parent cycle, it isn't an ancestor in the tree
+            if parent != -1 and self.tin[parent] < self.tin[node]:
+                parent_totals = totals[parent]
+                for i, value in enumerate(totals[node]):
+                    parent_totals[i] += value
+        return {wnid: tuple(totals[i]) for i, wnid in enumerate(self.wnids)}
+
+    def get_paths(self):
+        """
+        :return: dictionary of wnid: path, where path is wnids from the root joined by os.path.join
+        """
+        paths = [''] * len(self.wnids)
+        for node in self.order:
+            parent = self.parent[node]
+            paths[node] = os.path.join(paths[parent], self.wnids[node]) if parent != -1 and paths[parent] \
+                else self.wnids[node]
+        return {wnid: paths[i] for i, wnid in enumerate(self.wnids)}
+
+    def get_levels(self):
+        """
+        :return: dictionary of wnid: level, where level is number of wnids in its path
+        """
+        return {wnid: self.depth[i] + 1 for i, wnid in enumerate(self.wnids)}
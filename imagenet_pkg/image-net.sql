@@ -86,7 +86,13 @@ ALTER TABLE public.structure OWNER TO postgres;
 
 CREATE TABLE public.url_states (
     url_id integer NOT NULL,
-    state_id integer NOT NULL
+    state_id integer NOT NULL,
+    etag character varying(500),
+    last_modified character varying(100),
+    lease_until timestamp with time zone,
+    lease_owner character varying(200),
+    width integer,
+    height integer
 );
 
 
@@ -159,6 +165,7 @@ COPY public.ref_url_states (id, name) FROM stdin;
 2	failed
 3	non-image
 4	saved
+5	dead
 \.
 
 
@@ -174,7 +181,7 @@ COPY public.structure (release, parent_wnid, child_wnid) FROM stdin;
 -- Data for Name: url_states; Type: TABLE DATA; Schema: public; Owner: postgres
 --
 
-COPY public.url_states (url_id, state_id) FROM stdin;
+COPY public.url_states (url_id, state_id, etag, last_modified, lease_until, lease_owner, width, height) FROM stdin;
 \.
 
 
@@ -255,6 +262,20 @@ ALTER TABLE ONLY public.urls
 CREATE INDEX urls_index ON public.urls USING btree (release, wnid);
 
 
+--
+-- Name: url_states_state_index; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX url_states_state_index ON public.url_states USING btree (state_id);
+
+
+--
+-- Name: url_states_pending_index; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX url_states_pending_index ON public.url_states USING btree (url_id) WHERE (state_id <> ALL (ARRAY[3, 4, 5]));
+
+
 --
 -- Name: structure structure_child_wnid_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
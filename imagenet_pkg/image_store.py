@@ -0,0 +1,482 @@
+import os
+import re
+import mmap
+import uuid
+import glob
+import fcntl
+import shutil
+import struct
+import threading
+from imagenet_pkg.constants import *
+
+
+def _manifest_line(key, size, digest=None, dims=None):
+    width, height = dims or ('', '')
+    return f'{key}\t{size}\t{digest or ""}\t{width}\t{height}\n'
+
+
+def _parse_manifest(data):
+    """
+    :return: dictionary of key: (key, size, sha256, width, height), a key written again replaces its older entry
+    """
+    entries = {}
+    for line in data.decode('ascii', errors='replace').splitlines():
+        fields = line.split('\t')
+        try:
+            key, size, digest, width, height = fields
+            entries[key] = (key, int(size), digest or None, int(width) if width else None,
+                            int(height) if height else None)
+        except ValueError:
+            continue  # a partially written last line
+    return entries
+
+
+class DirectoryStore:
+    """
+    One file per image: <directory>/<wnid>/<key>.jpg
+    Every class directory has a manifest (MANIFEST_NAME), a line of key, size, sha256, width and height per
+    image, appended when the image is stored, so that counting and listing a class reads one file instead of
+    listing the directory. A missing manifest (e.g. of images stored by an older version) is built by listing
+    the directory once, scan() rebuilds it after files were added or removed by hand.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @property
+    def spool_dir(self):
+        """
+        Directory of bodies being downloaded, on the same filesystem, so that save_file() is a rename
+        """
+        return os.path.join(self.directory, SPOOL_DIR_NAME)
+
+    def save(self, wnid, key, img_bytes, digest=None, dims=None):
+        """
+        :param digest: sha256 of the image, hex, written to the manifest
+        :param dims: (width, height) of the image, written to the manifest
+        """
+        directory = os.path.join(self.directory, wnid)
+        # create class directory if it doesn't exist
+        os.makedirs(directory, exist_ok=True)
+        # replaced rather than overwritten, the file may be a hardlink shared with other classes
+        path = os.path.join(directory, key + '.jpg')
+        with open(path + '.tmp', 'wb') as fp:
+            fp.write(img_bytes)
+        os.replace(path + '.tmp', path)
+        self._record(wnid, key, len(img_bytes), digest, dims)
+
+    def save_file(self, wnid, key, file_path, digest=None, dims=None):
+        """
+        Moves the file "file_path" (e.g. a spooled body) into the store as "key" of "wnid"
+        """
+        directory = os.path.join(self.directory, wnid)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, key + '.jpg')
+        os.replace(file_path, path)
+        self._record(wnid, key, os.path.getsize(path), digest, dims)
+
+    def link(self, wnid, key, source_wnid, source_key, digest=None, dims=None):
+        """
+        Stores the image "source_key" of "source_wnid" also as "key" of "wnid", as a hardlink
+        """
+        directory = os.path.join(self.directory, wnid)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, key + '.jpg')
+        # linked to a temporary name and replaced, so that an older image of "key" (e.g. of a changed url) goes
+        tmp_path = path + '.link'
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        os.link(os.path.join(self.directory, source_wnid, source_key + '.jpg'), tmp_path)
+        os.replace(tmp_path, path)
+        self._record(wnid, key, os.path.getsize(path), digest, dims)
+
+    def _open_manifest(self, wnid):
+        """
+        Opens the manifest of wnid for appending, locked against other threads and processes
+        """
+        path = os.path.join(self.directory, wnid, MANIFEST_NAME)
+        while True:
+            fp = open(path, 'ab')
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(fp.fileno()).st_ino:
+                    return fp
+            except FileNotFoundError:
+                pass
+            # replaced by _rebuild() while waiting for the lock
+            fp.close()
+
+    def _scan_data(self, wnid, previous):
+        """
+        :param previous: entries of the current manifest, their sha256 and dimensions are kept
+        :return: manifest of files of the class directory
+        """
+        lines = []
+        for entry in os.scandir(os.path.join(self.directory, wnid)):
+            if not entry.name.lower().endswith('.jpg'):
+                continue
+            key = entry.name[:-len('.jpg')]
+            _, _, digest, width, height = previous.get(key, (None, None, None, None, None))
+            lines.append(_manifest_line(key, entry.stat().st_size, digest, (width, height) if width else None))
+        return ''.join(lines).encode('ascii')
+
+    def _record(self, wnid, key, size, digest=None, dims=None):
+        with self._open_manifest(wnid) as fp:
+            if fp.seek(0, os.SEEK_END) == 0:
+                # a new manifest, images stored before it (including this one) are listed into it
+                fp.write(self._scan_data(wnid, {}))
+            fp.write(_manifest_line(key, size, digest, dims).encode('ascii'))
+
+    def _rebuild(self, wnid):
+        path = os.path.join(self.directory, wnid, MANIFEST_NAME)
+        with self._open_manifest(wnid):
+            with open(path, 'rb') as current:
+                data = self._scan_data(wnid, _parse_manifest(current.read()))
+            with open(path + '.tmp', 'wb') as tmp:
+                tmp.write(data)
+            os.replace(path + '.tmp', path)
+        return _parse_manifest(data)
+
+    def refresh(self):
+        """
+        Nothing is cached, scan() lists class directories
+        """
+        pass
+
+    def scan(self, wnid):
+        """
+        Lists the class directory of wnid and rewrites its manifest
+        :return: list of keys of stored images
+        """
+        if not os.path.isdir(os.path.join(self.directory, wnid)):
+            return []
+        return list(self._rebuild(wnid))
+
+    def entries(self, wnid):
+        """
+        :return: list of (key, size, sha256, width, height) of images of wnid, from its manifest, sha256 and
+        dimensions are None if they aren't known. None if nothing was stored for wnid
+        """
+        try:
+            with open(os.path.join(self.directory, wnid, MANIFEST_NAME), 'rb') as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            if not os.path.isdir(os.path.join(self.directory, wnid)):
+                return None
+            data = b''
+        if not data:
+            return list(self._rebuild(wnid).values())
+        return list(_parse_manifest(data).values())
+
+    def filenames_iter(self, wnid):
+        directory = os.path.join(self.directory, wnid)
+        for key, _, _, _, _ in self.entries(wnid) or ():
+            yield os.path.join(directory, key + '.jpg')
+
+    def data_iter(self, wnid):
+        for filename in self.filenames_iter(wnid):
+            with open(filename, mode='rb') as fp:
+                yield fp.read()
+
+    def keys_iter(self, wnid):
+        for key, _, _, _, _ in self.entries(wnid) or ():
+            yield key
+
+    def read(self, wnid, key):
+        with open(os.path.join(self.directory, wnid, key + '.jpg'), mode='rb') as fp:
+            return fp.read()
+
+    def exists(self, wnid, key):
+        return os.path.isfile(os.path.join(self.directory, wnid, key + '.jpg'))
+
+    def count(self, wnid):
+        entries = self.entries(wnid)
+        return len(entries) if entries is not None else None
+
+    def clean(self):
+        if os.path.isdir(self.directory):
+            for folder in os.listdir(self.directory):
+                if re.fullmatch(r'n\d{8}', folder):
+                    shutil.rmtree(os.path.join(self.directory, folder))
+            if os.path.isdir(self.spool_dir):
+                shutil.rmtree(self.spool_dir)
+
+    def close(self):
+        pass
+
+
+# index record: key (sha256(url)[:20] as 10 bytes), wnid, offset in shard, length
+_PACK_RECORD = struct.Struct('<10s9sQI')
+# reference record: key, wnid, key and wnid of the image it refers to
+_PACK_REF = struct.Struct('<10s9s10s9s')
+
+
+class _PackWriter:
+    """
+    Appends images to the shards of a single writer. Every process gets its own writer (and shards),
+    so that save pool processes never write to the same file.
+    """
+
+    def __init__(self, directory, max_shard_size):
+        self.directory = directory
+        self.max_shard_size = max_shard_size
+        self.prefix = uuid.uuid4().hex[:12]
+        self.shard_no = -1
+        self.data_fp = None
+        self.index_fp = None
+        self.refs_fp = None
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def _rotate(self):
+        self.close()
+        self.shard_no += 1
+        name = os.path.join(self.directory, f'shard-{self.prefix}-{self.shard_no:05d}')
+        self.data_fp = open(name + '.pack', 'ab', buffering=0)
+        self.index_fp = open(name + '.idx', 'ab', buffering=0)
+        self.size = 0
+
+    def append(self, wnid, key, img_bytes):
+        with self.lock:
+            if self.data_fp is None or self.size + len(img_bytes) > self.max_shard_size:
+                self._rotate()
+            offset = self.size
+            self.data_fp.write(img_bytes)
+            self.size += len(img_bytes)
+            # the index record goes after the data, so it never points at bytes which weren't written
+            self.index_fp.write(_PACK_RECORD.pack(bytes.fromhex(key), wnid.encode('ascii'), offset, len(img_bytes)))
+            return self.data_fp.name, offset
+
+    def append_ref(self, wnid, key, source_wnid, source_key):
+        with self.lock:
+            if self.refs_fp is None:
+                self.refs_fp = open(os.path.join(self.directory, f'shard-{self.prefix}.refs'), 'ab', buffering=0)
+            self.refs_fp.write(_PACK_REF.pack(bytes.fromhex(key), wnid.encode('ascii'),
+                                              bytes.fromhex(source_key), source_wnid.encode('ascii')))
+
+    def close(self):
+        if self.data_fp is not None:
+            self.data_fp.close()
+            self.index_fp.close()
+            self.data_fp = self.index_fp = None
+        if self.refs_fp is not None:
+            self.refs_fp.close()
+            self.refs_fp = None
+
+
+_pack_writers = {}
+_pack_writers_lock = threading.Lock()
+
+
+class PackStore:
+    """
+    Images are appended to shard files of up to "max_shard_size" bytes in <directory>/packs. Every shard has an
+    index file of fixed size records (key, wnid, offset, length). Images are read without copying through mmap.
+    The object is picklable, so it may be passed to save pool processes.
+    Bodies are not spooled to files (spool_dir is None), they are appended to shards from memory.
+    """
+    spool_dir = None
+
+    def __init__(self, directory, max_shard_size=PACK_MAX_SHARD_SIZE_DEFAULT):
+        self.directory = directory
+        self.max_shard_size = max_shard_size
+        self._index = None  # wnid: dictionary of key: (shard, key, offset, length)
+        self._read = {}  # index or refs file: number of its bytes already in _index
+        self._unresolved = []  # references to images which weren't in _index yet
+        # images are saved by save pool threads while others look them up
+        self._lock = threading.Lock()
+        self._maps = {}
+
+    @property
+    def packs_dir(self):
+        return os.path.join(self.directory, PACK_DIR_NAME)
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'max_shard_size': self.max_shard_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _writer(self):
+        key = (os.getpid(), self.packs_dir)
+        with _pack_writers_lock:
+            writer = _pack_writers.get(key)
+            if writer is None:
+                os.makedirs(self.packs_dir, exist_ok=True)
+                writer = _pack_writers[key] = _PackWriter(self.packs_dir, self.max_shard_size)
+        return writer
+
+    def save(self, wnid, key, img_bytes, digest=None, dims=None):
+        """
+        "digest" and "dims" are not kept, the index of pack files lists images of a class
+        """
+        shard, offset = self._writer().append(wnid, key, img_bytes)
+        with self._lock:
+            # a loaded index is updated in place, so lookups never read index files again
+            if self._index is not None:
+                self._index.setdefault(wnid, {})[key] = (shard, key, offset, len(img_bytes))
+
+    def link(self, wnid, key, source_wnid, source_key, digest=None, dims=None):
+        """
+        Stores the image "source_key" of "source_wnid" also as "key" of "wnid", as a reference record.
+        Raises FileNotFoundError if the source image isn't stored, so that the caller stores the image itself
+        """
+        with self._lock:
+            index = self._loaded_index()
+            source = index.get(source_wnid, {}).get(source_key)
+            if source is None:
+                # e.g. saved by another save pool process after the index was read
+                self._refresh()
+                source = index.get(source_wnid, {}).get(source_key)
+            if source is None:
+                raise FileNotFoundError(f'Image {source_key} of {source_wnid} is not stored')
+            self._writer().append_ref(wnid, key, source_wnid, source_key)
+            shard, _, offset, length = source
+            index.setdefault(wnid, {})[key] = (shard, key, offset, length)
+
+    def _read_new(self, path, record):
+        # records appended to "path" since it was read last, a partially written last record is left for later
+        offset = self._read.get(path, 0)
+        with open(path, 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read()
+        data = data[:len(data) - len(data) % record.size]
+        self._read[path] = offset + len(data)
+        return record.iter_unpack(data)
+
+    def _refresh(self):
+        """
+        Adds records appended to index and refs files since they were read, the caller holds the lock
+        """
+        for index_path in sorted(glob.glob(os.path.join(self.packs_dir, '*.idx'))):
+            shard = index_path[:-len('.idx')] + '.pack'
+            # a key written again (e.g. a changed image) replaces its older record
+            for key, wnid, offset, length in self._read_new(index_path, _PACK_RECORD):
+                self._index.setdefault(wnid.decode('ascii'), {})[key.hex()] = (shard, key.hex(), offset, length)
+
+        refs = self._unresolved
+        for refs_path in sorted(glob.glob(os.path.join(self.packs_dir, '*.refs'))):
+            refs.extend((wnid.decode('ascii'), key.hex(), source_wnid.decode('ascii'), source_key.hex())
+                        for key, wnid, source_key, source_wnid in self._read_new(refs_path, _PACK_REF))
+        self._unresolved = []
+        for wnid, key, source_wnid, source_key in refs:
+            source = self._index.get(source_wnid, {}).get(source_key)
+            if source is None:
+                self._unresolved.append((wnid, key, source_wnid, source_key))
+                continue
+            shard, _, offset, length = source
+            self._index.setdefault(wnid, {})[key] = (shard, key, offset, length)
+
+    def _loaded_index(self):
+        """
+        Reads index files on first use, the caller holds the lock
+        """
+        if self._index is None:
+            self._index = {}
+            self._refresh()
+        return self._index
+
+    def _reset_index(self):
+        with self._lock:
+            self._index = None
+            self._read = {}
+            self._unresolved = []
+
+    def refresh(self):
+        """
+        Reads index and refs files again, e.g. once before listing classes with scan()
+        """
+        with self._lock:
+            self._index = {}
+            self._read = {}
+            self._unresolved = []
+            self._refresh()
+
+    def _records(self, wnid):
+        """
+        :return: list of (shard, key, offset, length) of images of wnid, None if nothing was stored for wnid
+        """
+        with self._lock:
+            records = self._loaded_index().get(wnid)
+            return list(records.values()) if records else None
+
+    def _map(self, shard):
+        mapped = self._maps.get(shard)
+        if mapped is None or len(mapped) < os.path.getsize(shard):
+            with open(shard, 'rb') as fp:
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[shard] = mapped
+        return mapped
+
+    def keys_iter(self, wnid):
+        for shard, key, offset, length in self._records(wnid) or ():
+            yield key
+
+    def read(self, wnid, key):
+        with self._lock:
+            shard, key, offset, length = self._loaded_index()[wnid][key]
+        return memoryview(self._map(shard))[offset:offset + length]
+
+    def exists(self, wnid, key):
+        with self._lock:
+            return key in self._loaded_index().get(wnid, ())
+
+    def filenames_iter(self, wnid):
+        raise Exception('Images are stored in pack files, use images_data_iter() instead.')
+
+    def entries(self, wnid):
+        """
+        :return: list of (key, size, None, None, None) of images of wnid, None if nothing was stored for wnid
+        """
+        records = self._records(wnid)
+        return [(key, length, None, None, None) for _, key, _, length in records] if records else None
+
+    def scan(self, wnid):
+        """
+        Lists images of wnid in the loaded index, call refresh() first to see changes of other processes
+        :return: list of keys of stored images
+        """
+        return list(self.keys_iter(wnid))
+
+    def data_iter(self, wnid):
+        """
+        Yields memoryview of every image of wnid, backed by mmap of the shard
+        """
+        for shard, key, offset, length in self._records(wnid) or ():
+            yield memoryview(self._map(shard))[offset:offset + length]
+
+    def count(self, wnid):
+        records = self._records(wnid)
+        return len(records) if records else None
+
+    def clean(self):
+        self.close()
+        with _pack_writers_lock:
+            writer = _pack_writers.pop((os.getpid(), self.packs_dir), None)
+        if writer is not None:
+            writer.close()
+        if os.path.isdir(self.packs_dir):
+            shutil.rmtree(self.packs_dir)
+
+    def close(self):
+        # memoryviews handed out by data_iter() keep their maps alive
+        self._maps = {}
+        self._reset_index()
+        with _pack_writers_lock:
+            writer = _pack_writers.get((os.getpid(), self.packs_dir))
+        if writer is not None:
+            with writer.lock:
+                writer.close()
+
+
+def create_store(storage, directory, **kwargs):
+    """
+    :param storage: STORAGE_DIRECTORY or STORAGE_PACK
+    """
+    if storage == STORAGE_PACK:
+        return PackStore(directory, **kwargs)
+    if storage == STORAGE_DIRECTORY:
+        return DirectoryStore(directory)
+    raise Exception(f'Invalid storage {storage}')
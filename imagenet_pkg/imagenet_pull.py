@@ -1,10 +1,12 @@
+import os
 import sys
 import getopt
 import re
+import json
 from imagenet_pkg.constants import *
-import psycopg2 as pspg
-import psycopg2.extensions
 from imagenet_pkg.api import ApiSession
+from imagenet_pkg.util import RetryPolicy
+from imagenet_pkg.verify import ImageVerifier, load_placeholder_hashes
 
 env = {}
 
@@ -14,12 +16,49 @@ def _set_args():
     env['recursive'] = False
     env['deep'] = None
     env['max-classes'] = None
-    # env['pictures-per-class'] = None
+    env['pictures-per-class'] = None
+    env['plan-strategy'] = None
     env['dir'] = ''
     env['mode'] = MODE_LOAD_PICTURES
     env['fetch_ratio'] = 0.8
     env['release'] = 'fall2011'
     env['max-async-requests'] = MAX_ASYNC_REQUESTS_DEFAULT
+    env['host-max-concurrency'] = HOST_MAX_CONCURRENCY_DEFAULT
+    env['host-latency-target'] = HOST_LATENCY_TARGET_DEFAULT
+    env['host-max-failures'] = HOST_MAX_FAILURES_DEFAULT
+    env['host-cooldown'] = HOST_COOLDOWN_DEFAULT
+    env['max-attempts'] = RETRY_MAX_ATTEMPTS_DEFAULT
+    env['retry-max-delay'] = RETRY_MAX_DELAY_DEFAULT
+    env['save-executor'] = None  # a process pool if images are verified, else a thread pool
+    env['save-workers'] = SAVE_WORKERS_DEFAULT
+    env['states-batch-size'] = STATES_BATCH_SIZE_DEFAULT
+    env['states-flush-interval'] = STATES_FLUSH_INTERVAL_DEFAULT
+    env['db-pool-size'] = DB_POOL_SIZE_DEFAULT
+    env['max-body-size'] = MAX_BODY_SIZE_DEFAULT
+
+    env['snapshot-dir'] = SNAPSHOT_DIR_DEFAULT
+    env['storage'] = STORAGE_DIRECTORY
+    env['dedup'] = False
+    env['verify'] = False
+    env['max-side'] = None
+    env['quality'] = VERIFY_QUALITY_DEFAULT
+    env['placeholders'] = None
+    env['resume'] = False
+    env['revalidate'] = False
+
+    env['lease-size'] = LEASE_BATCH_SIZE_DEFAULT
+    env['lease-timeout'] = LEASE_TIMEOUT_DEFAULT
+
+    env['urls-file'] = None
+    env['import-workers'] = IMPORT_WORKERS_DEFAULT
+
+    env['export-dir'] = None
+    env['shard-size'] = EXPORT_SHARD_SIZE_DEFAULT
+    env['export-workers'] = EXPORT_WORKERS_DEFAULT
+    env['shuffle-buffer'] = EXPORT_SHUFFLE_BUFFER_DEFAULT
+    env['seed'] = None
+
+    env['stats-format'] = STATS_FORMAT_TABLE
 
     env['pg_host'] = None
     env['pg_port'] = None
@@ -42,11 +81,44 @@ def _set_args():
                 'fetch-ratio=',
                 'deep=',
                 'max-classes=',
-                # 'pictures-per-class=',
+                'pictures-per-class=',
+                'plan-strategy=',
                 'dir=',
                 'mode=',
                 'release=',
                 'max-async-requests=',
+                'host-max-concurrency=',
+                'host-latency-target=',
+                'host-max-failures=',
+                'host-cooldown=',
+                'max-attempts=',
+                'retry-max-delay=',
+                'save-executor=',
+                'save-workers=',
+                'states-batch-size=',
+                'states-flush-interval=',
+                'db-pool-size=',
+                'max-body-size=',
+                'snapshot-dir=',
+                'no-snapshot',
+                'storage=',
+                'dedup',
+                'verify',
+                'max-side=',
+                'quality=',
+                'placeholders=',
+                'resume',
+                'revalidate',
+                'lease-size=',
+                'lease-timeout=',
+                'urls-file=',
+                'import-workers=',
+                'export-dir=',
+                'shard-size=',
+                'export-workers=',
+                'shuffle-buffer=',
+                'seed=',
+                'stats-format=',
             ])
             print(args[0])
 
@@ -77,8 +149,14 @@ def _set_args():
                     else:
                         print_usage()
 
-                # elif key in ('pictures-per-class', 'p'):
-                #     env['pictures-per-class'] = int(val)
+                elif key in ('pictures-per-class', 'p'):
+                    env['pictures-per-class'] = int(val)
+
+                elif key in ('plan-strategy',):
+                    if val in PLAN_STRATEGIES:
+                        env['plan-strategy'] = val
+                    else:
+                        print_usage()
 
                 elif key in ('dir', 'd'):
                     env['dir'] = val
@@ -101,6 +179,111 @@ def _set_args():
                 elif key in ('max-async-requests', 'n'):
                     env['max-async-requests'] = int(val)
 
+                elif key in ('host-max-concurrency',):
+                    env['host-max-concurrency'] = int(val)
+
+                elif key in ('host-latency-target',):
+                    env['host-latency-target'] = float(val)
+
+                elif key in ('host-max-failures',):
+                    env['host-max-failures'] = int(val)
+
+                elif key in ('host-cooldown',):
+                    env['host-cooldown'] = float(val)
+
+                elif key in ('max-attempts',):
+                    env['max-attempts'] = int(val)
+
+                elif key in ('retry-max-delay',):
+                    env['retry-max-delay'] = float(val)
+
+                elif key in ('save-executor',):
+                    if val in (SAVE_EXECUTOR_THREAD, SAVE_EXECUTOR_PROCESS):
+                        env['save-executor'] = val
+                    else:
+                        print_usage()
+
+                elif key in ('save-workers',):
+                    env['save-workers'] = int(val)
+
+                elif key in ('states-batch-size',):
+                    env['states-batch-size'] = int(val)
+
+                elif key in ('states-flush-interval',):
+                    env['states-flush-interval'] = float(val)
+
+                elif key in ('db-pool-size',):
+                    env['db-pool-size'] = int(val)
+
+                elif key in ('max-body-size',):
+                    env['max-body-size'] = int(val)
+
+                elif key in ('snapshot-dir',):
+                    env['snapshot-dir'] = val
+
+                elif key in ('no-snapshot',):
+                    env['snapshot-dir'] = None
+
+                elif key in ('storage',):
+                    if val in (STORAGE_DIRECTORY, STORAGE_PACK):
+                        env['storage'] = val
+                    else:
+                        print_usage()
+
+                elif key in ('dedup',):
+                    env['dedup'] = True
+
+                elif key in ('verify',):
+                    env['verify'] = True
+
+                elif key in ('max-side',):
+                    env['max-side'] = int(val)
+
+                elif key in ('quality',):
+                    env['quality'] = int(val)
+
+                elif key in ('placeholders',):
+                    env['placeholders'] = val
+
+                elif key in ('resume',):
+                    env['resume'] = True
+
+                elif key in ('revalidate',):
+                    env['revalidate'] = True
+
+                elif key in ('lease-size',):
+                    env['lease-size'] = int(val)
+
+                elif key in ('lease-timeout',):
+                    env['lease-timeout'] = int(val)
+
+                elif key in ('urls-file',):
+                    env['urls-file'] = val
+
+                elif key in ('import-workers',):
+                    env['import-workers'] = int(val)
+
+                elif key in ('export-dir',):
+                    env['export-dir'] = val
+
+                elif key in ('shard-size',):
+                    env['shard-size'] = int(val)
+
+                elif key in ('export-workers',):
+                    env['export-workers'] = int(val)
+
+                elif key in ('shuffle-buffer',):
+                    env['shuffle-buffer'] = int(val)
+
+                elif key in ('seed',):
+                    env['seed'] = int(val)
+
+                elif key in ('stats-format',):
+                    if val in (STATS_FORMAT_TABLE, STATS_FORMAT_JSON):
+                        env['stats-format'] = val
+                    else:
+                        print_usage()
+
                 elif key in ('mode', 'm'):
                     if val == 'urls':
                         env['mode'] = MODE_CACHE_URLS
@@ -110,12 +293,23 @@ def _set_args():
                         env['mode'] = MODE_CLEAR_CACHE
                     elif val == 'clear-images':
                         env['mode'] = MODE_CLEAR_IMAGES
+                    elif val == 'export':
+                        env['mode'] = MODE_EXPORT
+                    elif val == 'import-urls':
+                        env['mode'] = MODE_IMPORT_URLS
+                    elif val == 'work':
+                        env['mode'] = MODE_WORK
+                    elif val == 'stats':
+                        env['mode'] = MODE_STATS
                     else:
                         print_usage()
 
-            if not env['classes'] and env['mode'] != MODE_CLEAR_CACHE and env['mode'] != MODE_CLEAR_IMAGES:
+            if env['save-executor'] is None:
+                env['save-executor'] = SAVE_EXECUTOR_PROCESS if env['verify'] else SAVE_EXECUTOR_THREAD
+            if not env['classes'] and env['mode'] not in (MODE_CLEAR_CACHE, MODE_CLEAR_IMAGES, MODE_IMPORT_URLS,
+                                                                MODE_STATS):
                 print_usage()
-            if env['max-classes'] and env['max-classes'] > len(env['classes']):
+            if not env['recursive'] and env['max-classes'] and env['max-classes'] > len(env['classes']):
                 print('Error: \'max-classes\' cannot be greater than number of classes specified.')
                 print_usage()
         except Exception as ex:
@@ -131,7 +325,7 @@ def print_usage(exit_code=1):
           '[-r FETCH_RATIO] '
           '[-R] '
           '[-C MAX_CLASSES] '
-          # '[-p PICTURES_PER_CLASS] '
+          '[-p PICTURES_PER_CLASS] '
           '[-v IMAGENET_RELEASE] '
           '[-n MAX_ASYNC_REQUESTS] '
           '[-m MODE]\n'
@@ -145,9 +339,42 @@ def print_usage(exit_code=1):
           '[--fetch-ratio FETCH_RATIO] '
           '[--recursive] '
           '[--deep RECURSIVITY_DEEP] '
-          '[--max-classes] '
-          # '[--pictures-per-class PICTURES_PER_CLASS] '
+          '[--max-classes MAX_CLASSES] '
+          '[--pictures-per-class PICTURES_PER_CLASS] '
+          '[--plan-strategy PLAN_STRATEGY] '
           '[--max-async-requests MAX_ASYNC_REQUESTS] '
+          '[--host-max-concurrency HOST_MAX_CONCURRENCY] '
+          '[--host-latency-target HOST_LATENCY_TARGET] '
+          '[--host-max-failures HOST_MAX_FAILURES] '
+          '[--host-cooldown HOST_COOLDOWN] '
+          '[--max-attempts MAX_ATTEMPTS] '
+          '[--retry-max-delay RETRY_MAX_DELAY] '
+          '[--save-executor SAVE_EXECUTOR] '
+          '[--save-workers SAVE_WORKERS] '
+          '[--states-batch-size STATES_BATCH_SIZE] '
+          '[--states-flush-interval STATES_FLUSH_INTERVAL] '
+          '[--db-pool-size DB_POOL_SIZE] '
+          '[--max-body-size MAX_BODY_SIZE] '
+          '[--snapshot-dir SNAPSHOT_DIR] '
+          '[--no-snapshot] '
+          '[--storage STORAGE] '
+          '[--dedup] '
+          '[--verify] '
+          '[--max-side MAX_SIDE] '
+          '[--quality QUALITY] '
+          '[--placeholders PLACEHOLDERS_FILE] '
+          '[--resume] '
+          '[--revalidate] '
+          '[--lease-size LEASE_SIZE] '
+          '[--lease-timeout LEASE_TIMEOUT] '
+          '[--urls-file URLS_FILE] '
+          '[--import-workers IMPORT_WORKERS] '
+          '[--export-dir EXPORT_DIR] '
+          '[--shard-size SHARD_SIZE] '
+          '[--export-workers EXPORT_WORKERS] '
+          '[--shuffle-buffer SHUFFLE_BUFFER] '
+          '[--seed SEED] '
+          '[--stats-format STATS_FORMAT] '
           '[--mode MODE] '
           '[--release IMAGENET_RELEASE]\n'
           '\n'
@@ -157,18 +384,113 @@ def print_usage(exit_code=1):
           '\n'
           'CLASSES: class WNIDs separated by comma. E.g.: --classes="n00000001, n00000002, n00000003"\n'
           'FETCH_RATIO: for example given n classes, which totally contains m urls, FETCH_RATIO tells, '
-          'we have to fetch at least FETCH_RATIO * m images (default 0.8)\n'
+          'we have to fetch at least FETCH_RATIO * m images. Urls of a class are not requested anymore once '
+          'FETCH_RATIO of its urls are saved (default 0.8)\n'
           'RECURSIVITY_DEEP: hierarchy deepness\n'
+          'MAX_CLASSES: with MODE=urls, images or work, only MAX_CLASSES classes (of CLASSES and, with -R, their '
+          'subclasses) are pulled, picked by PLAN_STRATEGY evenly over the hierarchy.\n'
+          f'PLAN_STRATEGY: \'{PLAN_STRATEGY_LEAVES}\' picks leaf classes, \'{PLAN_STRATEGY_DEPTH}\' picks the '
+          f'shallowest classes first, \'{PLAN_STRATEGY_STRATIFIED}\' gives every subtree of CLASSES an equal share '
+          f'of leaf classes. SEED shifts the picked classes. Default \'{PLAN_STRATEGY_STRATIFIED}\'.\n'
           'MAX_ASYNC_REQUESTS: how many requests may be executing simultaneously. '
           f'Default {MAX_ASYNC_REQUESTS_DEFAULT}.\n'
-          # 'PICTURES_PER_CLASS: maximum number of pictures per class\n'
+          'HOST_MAX_CONCURRENCY: maximum simultaneous requests to a single host. Concurrency of every host '
+          'grows while its responses are fast and is halved on errors or slow responses. '
+          f'Default {HOST_MAX_CONCURRENCY_DEFAULT}.\n'
+          'HOST_LATENCY_TARGET: responses slower than HOST_LATENCY_TARGET seconds decrease host concurrency. '
+          f'Default {HOST_LATENCY_TARGET_DEFAULT}.\n'
+          'HOST_MAX_FAILURES: consecutive failures after which a host is put on a cooldown. '
+          f'Default {HOST_MAX_FAILURES_DEFAULT}.\n'
+          'HOST_COOLDOWN: initial cooldown of a failing host in seconds, doubles on every next cooldown. '
+          f'Default {HOST_COOLDOWN_DEFAULT}.\n'
+          'MAX_ATTEMPTS: maximum attempts per url, urls failed that many times are marked \'dead\' and skipped by '
+          'later runs. Missing (404, 410) urls are never retried, DNS failures are retried once. '
+          f'Default {RETRY_MAX_ATTEMPTS_DEFAULT}.\n'
+          'RETRY_MAX_DELAY: maximum delay between attempts in seconds, delays grow exponentially. '
+          f'Default {RETRY_MAX_DELAY_DEFAULT}.\n'
+          f'SAVE_EXECUTOR: \'{SAVE_EXECUTOR_THREAD}\' or \'{SAVE_EXECUTOR_PROCESS}\', pool which validates and '
+          f'writes downloaded images. Default \'{SAVE_EXECUTOR_PROCESS}\' with --verify, '
+          f'else \'{SAVE_EXECUTOR_THREAD}\'.\n'
+          f'SAVE_WORKERS: number of workers of the save pool. Default {SAVE_WORKERS_DEFAULT}.\n'
+          'STATES_BATCH_SIZE, STATES_FLUSH_INTERVAL: url states are written to database in batches of '
+          'STATES_BATCH_SIZE rows, or every STATES_FLUSH_INTERVAL seconds. '
+          f'Default {STATES_BATCH_SIZE_DEFAULT}, {STATES_FLUSH_INTERVAL_DEFAULT}.\n'
+          'DB_POOL_SIZE: maximum number of database connections, so that url states, leases and url queries are '
+          f'written and read concurrently. Default {DB_POOL_SIZE_DEFAULT}.\n'
+          'MAX_BODY_SIZE: downloads larger than MAX_BODY_SIZE bytes are aborted, 0 for no limit. Downloads which '
+          f'don\'t start like a jpeg are aborted after their first bytes. Default {MAX_BODY_SIZE_DEFAULT}.\n'
+          'SNAPSHOT_DIR: directory where the class hierarchy is cached between runs, it is rebuilt whenever '
+          f'classes or structure change in database. --no-snapshot disables it. Default {SNAPSHOT_DIR_DEFAULT}.\n'
+          f'STORAGE: \'{STORAGE_DIRECTORY}\' stores a file per image in IMAGES_DIRECTORY/WNID, '
+          f'\'{STORAGE_PACK}\' appends images to shard files in IMAGES_DIRECTORY/{PACK_DIR_NAME}. '
+          f'Default \'{STORAGE_DIRECTORY}\'.\n'
+          '--dedup: images whose content was already saved (under another url or class) are stored as '
+          'hardlinks, or references in pack files, instead of copies. A report of saved bytes is printed.\n'
+          '--verify: images are fully decoded (requires Pillow) before they are saved, corrupt images and '
+          'placeholders are marked as non-images, dimensions of saved images are recorded in url_states.\n'
+          'MAX_SIDE, QUALITY: with --verify, images with a side longer than MAX_SIDE pixels are downscaled and '
+          f're-encoded with JPEG quality QUALITY. Default: sizes are kept, {VERIFY_QUALITY_DEFAULT}.\n'
+          'PLACEHOLDERS_FILE: with --verify, sha256 hashes (one per line) of placeholder images, e.g. "photo '
+          'unavailable" images of image hosts, which are rejected.\n'
+          '--resume: before MODE=images, url states are reconciled with images already stored, and stored images '
+          'are never requested again.\n'
+          '--revalidate: with MODE=images, saved images are also requested again with If-None-Match / '
+          'If-Modified-Since, only changed images are downloaded.\n'
+          'LEASE_SIZE, LEASE_TIMEOUT: in MODE=work, urls are leased in batches of LEASE_SIZE, urls leased by a '
+          'crashed worker are leased again after LEASE_TIMEOUT seconds. '
+          f'Default {LEASE_BATCH_SIZE_DEFAULT}, {LEASE_TIMEOUT_DEFAULT}.\n'
+          'URLS_FILE: local urls dump (fall11_urls.txt or a .tgz of it) imported by MODE=import-urls. By default '
+          f'one of {", ".join(URLS_DUMP_NAMES)} in IMAGES_DIRECTORY.\n'
+          f'IMPORT_WORKERS: number of processes parsing the urls dump. Default {IMPORT_WORKERS_DEFAULT}.\n'
+          'EXPORT_DIR: directory of tar shards written by MODE=export. Default IMAGES_DIRECTORY/shards.\n'
+          'SHARD_SIZE: maximum size of a tar shard in bytes. '
+          f'Default {EXPORT_SHARD_SIZE_DEFAULT}.\n'
+          f'EXPORT_WORKERS: number of threads writing shards. Default {EXPORT_WORKERS_DEFAULT}.\n'
+          'SHUFFLE_BUFFER: exported samples of all classes are shuffled through a buffer of that many samples, '
+          f'0 disables shuffling. Default {EXPORT_SHUFFLE_BUFFER_DEFAULT}.\n'
+          'SEED: seed of shuffling of MODE=export and of class selection by MAX_CLASSES.\n'
+          f'STATS_FORMAT: \'{STATS_FORMAT_TABLE}\' or \'{STATS_FORMAT_JSON}\', output of MODE=stats. '
+          f'Default \'{STATS_FORMAT_TABLE}\'.\n'
+          'PICTURES_PER_CLASS: with MODE=images, number of pictures per class. Only urls expected to give that '
+          'many pictures are requested, over-provisioned by the failure rate of their hosts and class measured '
+          'by earlier pulls, and a class is not requested anymore once it has PICTURES_PER_CLASS pictures. '
+          'Replaces FETCH_RATIO.\n'
           'IMAGENET_RELEASE: default fall2011\n'
           'MODE: set the mode. If MODE=urls, downloads urls, else if MODE=images, downloads images, '
-          'else if MODE=clear, clears database, else if MODE=clear-images, clears images only. '
+          'else if MODE=clear, clears database, else if MODE=clear-images, clears images only, '
+          'else if MODE=work, downloads images as one of many workers, which may run on several machines '
+          'against the same database (urls must be cached with MODE=urls or MODE=import-urls first), '
+          'else if MODE=import-urls, imports urls of CLASSES (all classes if not given) from URLS_FILE, '
+          'else if MODE=export, exports saved images into WebDataset tar shards (only images which were not '
+          'exported into EXPORT_DIR before), '
+          'else if MODE=stats, prints numbers of urls, saved, failed, non-image and dead urls over the subtree of '
+          'CLASSES (every class if not given). '
           'Default \'MODE=images\'\n')
     sys.exit(exit_code)
 
 
+def _print_stats(stats, stats_format):
+    if stats_format == STATS_FORMAT_JSON:
+        print(json.dumps(stats, indent=2))
+        return
+    columns = ('wnid', 'level') + URL_STATS_COLUMNS
+    print(''.join(f'{column.upper():>12}' for column in columns) + f'{"COVERAGE":>12}')
+    for row in stats:
+        coverage = row['saved'] / row['urls'] if row['urls'] else 0
+        print(''.join(f'{str(row[column]):>12}' for column in columns) + f'{coverage:>12.1%}')
+
+
+def _select_classes(api, wnids):
+    if not env['max-classes'] and not env['plan-strategy']:
+        return wnids
+    wnids = api.select_classes(wnids,
+                               max_classes=env['max-classes'],
+                               strategy=env['plan-strategy'] or PLAN_STRATEGY_STRATIFIED,
+                               seed=env['seed'])
+    print(f'{len(wnids)} classes selected')
+    return wnids
+
+
 def main():
     global env
 
@@ -176,30 +498,89 @@ def main():
 
     _set_args()
 
-    env['db_conn'] = pspg.connect(f'host={env["pg_host"]} '
-                                  f'port={env["pg_port"]} '
-                                  f'dbname={env["pg_dbname"]} '
-                                  f'user={env["pg_user"]} '
-                                  f'password={env["pg_password"]}')
-
+    # a dsn, so that the session uses a connection pool
+    env['db_conn'] = f'host={env["pg_host"]} ' \
+                     f'port={env["pg_port"]} ' \
+                     f'dbname={env["pg_dbname"]} ' \
+                     f'user={env["pg_user"]} ' \
+                     f'password={env["pg_password"]}'
+
+    verifier = None
+    if env['verify']:
+        verifier = ImageVerifier(max_side=env['max-side'],
+                                 quality=env['quality'],
+                                 placeholder_hashes=load_placeholder_hashes(env['placeholders'])
+                                 if env['placeholders'] else ())
+
+    # the hierarchy is loaded only by modes which need it
     with ApiSession(env['db_conn'],
                     images_dir=env['dir'],
+                    lazy_init=True,
+                    snapshot_dir=env['snapshot-dir'],
                     url_on_fail=URL_ON_FAIL_RETRY,
-                    max_async_requests=env['max-async-requests']) as api:
+                    max_async_requests=env['max-async-requests'],
+                    host_limits={
+                        'max_concurrency': env['host-max-concurrency'],
+                        'latency_target': env['host-latency-target'],
+                        'max_failures': env['host-max-failures'],
+                        'cooldown': env['host-cooldown'],
+                    },
+                    retry_policy=RetryPolicy(max_attempts=env['max-attempts'],
+                                             max_delay=env['retry-max-delay']),
+                    save_executor=env['save-executor'],
+                    save_workers=env['save-workers'],
+                    states_batch_size=env['states-batch-size'],
+                    states_flush_interval=env['states-flush-interval'],
+                    storage=env['storage'],
+                    dedup=env['dedup'],
+                    db_pool_size=env['db-pool-size'],
+                    max_body_size=env['max-body-size'],
+                    verifier=verifier) as api:
         if env['mode'] == MODE_CLEAR_CACHE:
             api.clean_all()
         elif env['mode'] == MODE_CLEAR_IMAGES:
             api.clean_images()
         elif env['mode'] == MODE_CACHE_URLS:
             classes = api.get_wnid_info(env['classes'], env['recursive'], env['deep'])
-            wnids = [c[0] for c in classes]
+            wnids = _select_classes(api, [c[0] for c in classes])
             api.cache_urls(wnids)
         elif env['mode'] == MODE_LOAD_PICTURES:
             print('load')
+            classes = api.get_wnid_info(env['classes'], env['recursive'], env['deep'])
+            wnids = _select_classes(api, [c[0] for c in classes])
+            if env['resume']:
+                api.reconcile(wnids)
+            if env['pictures-per-class']:
+                urls, targets = api.plan_urls(wnids, env['pictures-per-class'])
+                print(f'{len(urls)} urls planned for {sum(targets.values())} pictures')
+            else:
+                # urls are streamed from the database while they are downloaded, until FETCH_RATIO of every class
+                # is saved
+                urls = api.get_urls(wnids, stream=True)
+                targets = api.fetch_targets(wnids, env['fetch_ratio'])
+            api.fetch(urls, skip_existing=env['resume'], targets=targets)
+            if env['revalidate']:
+                api.revalidate(wnids)
+        elif env['mode'] == MODE_WORK:
+            classes = api.get_wnid_info(env['classes'], env['recursive'], env['deep'])
+            wnids = _select_classes(api, [c[0] for c in classes])
+            api.work(wnids, batch_size=env['lease-size'], lease_timeout=env['lease-timeout'])
+        elif env['mode'] == MODE_IMPORT_URLS:
+            wnids = None
+            if env['classes']:
+                wnids = [c[0] for c in api.get_wnid_info(env['classes'], env['recursive'], env['deep'])]
+            api.import_urls(env['urls-file'], wnids=wnids, workers=env['import-workers'])
+        elif env['mode'] == MODE_EXPORT:
             classes = api.get_wnid_info(env['classes'], env['recursive'], env['deep'])
             wnids = [c[0] for c in classes]
-            urls = api.get_urls(wnids)
-            api.fetch(urls)
+            api.export(wnids,
+                       env['export-dir'] or os.path.join(env['dir'], 'shards'),
+                       shard_size=env['shard-size'],
+                       workers=env['export-workers'],
+                       shuffle_buffer=env['shuffle-buffer'],
+                       seed=env['seed'])
+        elif env['mode'] == MODE_STATS:
+            _print_stats(api.url_stats(env['classes'], env['recursive'], env['deep']), env['stats-format'])
 
     print('\nDone')
 
@@ -1,137 +1,623 @@
 import os
+import time
+import socket
+import threading
 import hashlib
+import math
 from imagenet_pkg.constants import *
 from imagenet_pkg.class_distributer import ClassDistributer
+from imagenet_pkg.state_writer import UrlStatesWriter
+from imagenet_pkg.db import Database, create_database
+from imagenet_pkg.image_store import create_store
+from imagenet_pkg.content_index import ContentIndex
 import imagenet_pkg.util as util
-import imghdr
-import psycopg2 as pspg
-import psycopg2.extensions
-import shutil
-import re
+import asyncio
+import concurrent.futures
+
+
+def _sha256(text):
+    return hashlib.sha256(bytes(text, 'utf-8')).hexdigest()
+
+
+def _store_body(store, wnid, key, body, digest, dims):
+    if isinstance(body, util.SpooledBody):
+        store.save_file(wnid, key, body.path, digest=digest, dims=dims)
+    else:
+        store.save(wnid, key, body, digest=digest, dims=dims)
+
+
+def _save_image(store, url, wnid, body, content_index=None, verifier=None):
+    """
+    Validates and writes a single image. Runs in a save stage worker.
+    :param store: image_store.DirectoryStore or image_store.PackStore
+    :param body: bytes, or util.SpooledBody, whose file is moved into the store (or removed)
+    :param content_index: content_index.ContentIndex, if given, images already saved (under any url or wnid)
+    are stored as references to the saved copy
+    :param verifier: verify.ImageVerifier, if given, images are decoded, and may be rejected or downscaled
+    :return: (url state, (width, height) of the saved image or None if it wasn't verified)
+    """
+    spool = body if isinstance(body, util.SpooledBody) else None
+    spooled = spool is not None
+    size = None
+    try:
+        # spooled bodies have been sniffed while they were received
+        if (body.kind if spooled else util.sniff_image(body[:SNIFF_SIZE])) != 'jpeg':
+            return URL_STATE_NON_IMAGE, None
+        digest = body.digest if spooled else hashlib.sha256(body).hexdigest()
+        if verifier is not None:
+            result = verifier.verify(body.read() if spooled else body, digest)
+            if result is None:
+                return URL_STATE_NON_IMAGE, None
+            resized, size = result
+            if resized is not None:
+                body, spooled = resized, False
+                digest = hashlib.sha256(body).hexdigest()
+
+        # to avoid name conflicts, set hash as name
+        key = _sha256(url)[:20]
+        if content_index is None:
+            _store_body(store, wnid, key, body, digest, size)
+            return URL_STATE_SAVED, size
+
+        original = content_index.lookup(digest)
+        if original == (wnid, key):
+            return URL_STATE_SAVED, size
+        if original is not None:
+            try:
+                store.link(wnid, key, *original, digest=digest, dims=size)
+                content_index.add_reference(digest)
+                return URL_STATE_SAVED, size
+            except OSError:
+                pass  # the original is gone or can't be linked, write a copy
+        _store_body(store, wnid, key, body, digest, size)
+        # registered after the write, so the index never refers to an image which doesn't exist
+        content_index.add(digest, wnid, key, body.size if spooled else len(body))
+        return URL_STATE_SAVED, size
+    finally:
+        if spool is not None:
+            spool.discard()
+
+
+# store, content index and verifier of a save pool process, set once when the process starts
+_save_worker = None
+
+
+def _init_save_worker(store, content_index, verifier):
+    global _save_worker
+    _save_worker = (store, content_index, verifier)
+
+
+def _save_image_in_worker(url, wnid, body):
+    """
+    _save_image() in a save pool process, only the image is passed to every task
+    """
+    store, content_index, verifier = _save_worker
+    return _save_image(store, url, wnid, body, content_index, verifier)
+
+
+class _SaveStage:
+    """
+    Validates and writes downloaded images in a thread or process pool, so that the event loop keeps
+    downloading. At most "queue_size" images wait for the pool, submit() waits for a free place, which slows
+    the network stage down when disks can't keep up. Url states are written by a single db thread.
+    """
+
+    def __init__(self, store, content_index, verifier, executor, workers, queue_size, on_saved):
+        self.store = store
+        self.content_index = content_index
+        self.verifier = verifier
+        self.queue_size = queue_size
+        self.on_saved = on_saved
+
+        self._processes = executor == SAVE_EXECUTOR_PROCESS
+        if self._processes:
+            # the store and the content index are set up once per process, not pickled with every image
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_save_worker,
+                                                                initargs=(store, content_index, verifier))
+        else:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._db_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self._slots = None
+        self._pending = set()
+
+    def _track(self, future):
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+
+    async def submit(self, url, url_id, wnid, img_bytes, validators=None):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.queue_size)
+        await self._slots.acquire()
+
+        loop = asyncio.get_running_loop()
+        if self._processes:
+            future = loop.run_in_executor(self._pool, _save_image_in_worker, url, wnid, img_bytes)
+        else:
+            future = loop.run_in_executor(self._pool, _save_image, self.store, url, wnid, img_bytes,
+                                          self.content_index, self.verifier)
+        # resolved once the outcome of the save is handled, a failed save doesn't abort join()
+        handled = loop.create_future()
+
+        def done(f):
+            self._slots.release()
+            if f.cancelled():
+                handled.cancel()
+                return
+            try:
+                state, size = f.result()
+            except Exception as ex:
+                # e.g. a full disk, the url is requested again by a later run
+                print(f'\nCannot save image {url}: {ex!r}')
+                state, size = URL_STATE_FAILED, None
+            self.on_saved(url, url_id, wnid, state, validators, size)
+            handled.set_result(None)
+
+        future.add_done_callback(done)
+        self._track(handled)
+
+    def save_states(self, states, save):
+        self._track(asyncio.get_running_loop().run_in_executor(self._db_pool, save, states))
+
+    async def join(self):
+        while self._pending:
+            await asyncio.gather(*self._pending)
+
+    def close(self):
+        self._pool.shutdown()
+        self._db_pool.shutdown()
 
 
 class ImagesWorker:
     def __init__(self, class_manager, db_conn, directory, imagenet_release=DEFAULT_RELEASE,
-                 url_on_fail=URL_ON_FAIL_IGNORE, max_async_requests=MAX_ASYNC_REQUESTS_DEFAULT):
+                 url_on_fail=URL_ON_FAIL_IGNORE, max_async_requests=MAX_ASYNC_REQUESTS_DEFAULT, host_limits=None,
+                 retry_policy=None, save_executor=SAVE_EXECUTOR_THREAD, save_workers=SAVE_WORKERS_DEFAULT,
+                 save_queue_size=SAVE_QUEUE_SIZE_DEFAULT, states_batch_size=STATES_BATCH_SIZE_DEFAULT,
+                 states_flush_interval=STATES_FLUSH_INTERVAL_DEFAULT, storage=STORAGE_DIRECTORY, dedup=False,
+                 max_body_size=MAX_BODY_SIZE_DEFAULT, verifier=None):
+        """
+        :param db_conn: db.Database, a dsn or an open psycopg2 connection (see db.create_database)
+        :param max_body_size: downloads larger than that many bytes are aborted, 0 for no limit
+        :param verifier: verify.ImageVerifier, which decodes (and may downscale) images before they are saved
+        """
         self.class_manager: ClassDistributer = class_manager
-        self.db_conn: pspg.extensions.connection = db_conn
-        self.cursor: pspg.extensions.cursor = self.db_conn.cursor()
+        self.db: Database = create_database(db_conn)
         self.directory = directory
+        self.store = create_store(storage, directory)
+        self.content_index = ContentIndex(os.path.join(directory, CONTENT_INDEX_NAME)) if dedup else None
+        # bodies are sniffed while they are received, and spooled to files if the store can take them over
+        self.body = util.BodyPolicy(max_size=max_body_size, spool_dir=self.store.spool_dir)
+        self.verifier = verifier
 
         self.release = imagenet_release
         self.url_on_fail = url_on_fail
         self.max_async_requests = max_async_requests
+        self.host_limits = host_limits
+        self.retry_policy = retry_policy
+        self.save_executor = save_executor
+        self.save_workers = save_workers
+        self.save_queue_size = save_queue_size
+        self.states_writer = UrlStatesWriter(self.db,
+                                             batch_size=states_batch_size,
+                                             flush_interval=states_flush_interval)
 
     def _sha256(self, text):
-        return hashlib.sha256(bytes(text, 'utf-8')).hexdigest()
+        return _sha256(text)
 
     def _save_images(self, data):
         """
         :param data: list of (url, url_id, wnid, bytes)
         :return: dictionary of url_id: (url_id, wnid, url, state)
         """
-
-        # classes valid images counts
-        result = {}
-        for url, url_id, wnid, img_bytes in data:
-            # if bytes are a valid jpeg image
-            if imghdr.what(None, img_bytes) == 'jpeg':
-                # get class metadata
-                wnid, shortname, fullname, path = self.class_manager.get_classes_info([wnid])[0]
-                directory = os.path.join(self.directory, wnid)
-                # create class directory if it doesn't exist
-                if not os.path.isdir(directory):
-                    os.makedirs(directory)
-                # to avoid name conflicts, set hash as name
-                filename = self._sha256(url)[:20] + '.jpg'
-                with open(os.path.join(directory, filename), 'wb') as fp:
-                    fp.write(img_bytes)
-                result[url_id] = (url_id, wnid, url, 4)  # where 4 is 'downloaded' state
-            else:
-                result[url_id] = (url_id, wnid, url, 3)  # where 3 is 'invalid data' state
-
-        return result
+        return {
+            url_id: (url_id, wnid, url, _save_image(self.store, url, wnid, img_bytes, self.content_index,
+                                                    self.verifier)[0])
+            for url, url_id, wnid, img_bytes in data
+        }
 
     def _save_states(self, states):
         """
-        :param states: an array of (url_id, state_id)
+        Buffers states, they are written by self.states_writer in batches
+        :param states: an array of (url_id, state_id[, etag, last_modified[, width, height]])
         :return:
         """
-        data_str = [f"({url_id}, {state_id})" for url_id, state_id in states]
-        query = f"INSERT INTO url_states (url_id, state_id) VALUES " \
-                f"{','.join(data_str)} " \
-                f"ON CONFLICT (url_id) DO UPDATE SET state_id = EXCLUDED.state_id;"
+        self.states_writer.add(states)
 
-        if data_str:
-            self.cursor.execute('ROLLBACK')
-            self.cursor.execute(query)
-            self.db_conn.commit()
+    def _fetch(self, urls, skip_existing=False, targets=None):
+        asyncio.run(self._fetch_async(urls, skip_existing=skip_existing, targets=targets))
 
-    def _fetch(self, urls):
+    async def _fetch_async(self, urls, skip_existing=False, targets=None):
         """
-        :param urls: a dictionary of (url_id, wnid, url, state_id)
+        Nothing here blocks the event loop: url rows are read by threads in chunks (see util.iterate_chunks),
+        images are validated and written by the save stage, and url states by its db thread.
+        :param urls: an iterable or async iterable of (url_id, wnid, url, state_id), or of
+        (url_id, wnid, url, state_id, etag, last_modified) to request urls conditionally
+        :param skip_existing: if True, urls whose image is already stored are not requested, but marked as saved
+        :param targets: dictionary of wnid: number of images to save, urls of a class are not requested anymore
+        once its target is reached, and fetching stops once every target is reached (see fetch_targets)
         :return:
         """
 
         stats = {
             'saved': 0,
+            'skipped': 0,
             'fetched': 0,
+            'rejected': 0,
             'failed': 0,
-            'total': len(urls)
+            'dead': 0,
+            'total': len(urls) if hasattr(urls, '__len__') else '?'
         }
 
-        print(f'Start fetching {len(urls)} urls...')
+        print(f'Start fetching {stats["total"]} urls...')
 
-        def print_stats():
-            print(f'\r[SAVED/FETCHED/FAILED/TOTAL] '
-                  f'{stats["saved"]}/{stats["fetched"]}/{stats["failed"]}/{stats["total"]}', end='')
+        # images still to save per class, classes are removed once their target is reached
+        remaining = {wnid: count for wnid, count in targets.items() if count > 0} if targets is not None else None
 
-        def on_fetch(response):
-            # response is ((url, url_id, wnid), data)
-            stats['fetched'] += 1
-            (url, url_id, wnid), data = response
+        def count_saved(wnid, count=1):
+            if remaining is not None and wnid in remaining:
+                remaining[wnid] -= count
+                if remaining[wnid] <= 0:
+                    del remaining[wnid]
 
-            save_state = self._save_images([(url, url_id, wnid, data)])
-            url_id, wnid, url, state = save_state[url_id]
+        def print_stats():
+            print(f'\r[SAVED/SKIPPED/FETCHED/REJECTED/FAILED/DEAD/TOTAL] '
+                  f'{stats["saved"]}/{stats["skipped"]}/{stats["fetched"]}/{stats["rejected"]}/{stats["failed"]}/'
+                  f'{stats["dead"]}/{stats["total"]}', end='')
 
-            self._save_states([(url_id, state)])
+        def on_saved(url, url_id, wnid, state, validators, size):
+            # validators are kept only for saved images, they are what conditional requests compare against
+            if state == URL_STATE_SAVED and (validators or size):
+                stage.save_states([(url_id, state, *(validators or (None, None)), *(size or (None, None)))],
+                                  self._save_states)
+            else:
+                stage.save_states([(url_id, state)], self._save_states)
 
-            if state == 4:
+            if state == URL_STATE_SAVED:
                 stats['saved'] += 1
+                count_saved(wnid)
 
             print_stats()
 
-        def on_fail(response):
-            # response is (url, url_id, wnid)
-            stats['failed'] += 1
-            url, url_id, wnid = response
+        stage = _SaveStage(self.store, self.content_index, self.verifier, self.save_executor, self.save_workers,
+                           self.save_queue_size, on_saved)
 
-            self._save_states([(url_id, 2)])  # where 2 is 'failed'
+        async def on_fetch(response):
+            # response is ((url, url_id, wnid[, validators]), data, validators), data is None if not modified
+            (url, url_id, wnid, *_), data, validators = response
+            if data is None:
+                stats['skipped'] += 1
+                print_stats()
+                return
+            stats['fetched'] += 1
+
+            await stage.submit(url, url_id, wnid, data, validators)
+
+        def on_fail(response, error, dead):
+            # response is (url, url_id, wnid[, validators])
+            url, url_id, wnid = response[:3]
+            if error in (FETCH_ERROR_NON_IMAGE, FETCH_ERROR_TOO_LARGE):
+                stats['rejected'] += 1
+                stage.save_states([(url_id, URL_STATE_NON_IMAGE)], self._save_states)
+            elif dead:
+                stats['dead'] += 1
+                stage.save_states([(url_id, URL_STATE_DEAD)], self._save_states)
+            else:
+                stats['failed'] += 1
+                stage.save_states([(url_id, URL_STATE_FAILED)], self._save_states)
 
             print_stats()
 
-        urls = [(url, url_id, wnid) for url_id, wnid, url, state_id in urls]
-        util.fetch_with_callback(urls,
-                                 on_fetch,
-                                 on_fail,
-                                 on_fail=self.url_on_fail,
-                                 async_limit=self.max_async_requests)
+        def split_existing(rows):
+            # runs in a thread, stored images are looked up on disk
+            existing = [row for row in rows if self.store.exists(row[1], _sha256(row[2])[:20])]
+            ids = {row[0] for row in existing}
+            return [row for row in rows if row[0] not in ids], existing
+
+        async def elements():
+            loop = asyncio.get_running_loop()
+            async for rows in util.iterate_chunks(urls, FETCH_ROWS_CHUNK):
+                if skip_existing:
+                    rows, existing = await loop.run_in_executor(None, split_existing, rows)
+                    if existing:
+                        stats['skipped'] += len(existing)
+                        stage.save_states([(row[0], URL_STATE_SAVED) for row in existing], self._save_states)
+                        for row in existing:
+                            count_saved(row[1])
+                        print_stats()
+                for row in rows:
+                    url_id, wnid, url = row[:3]
+                    if remaining is not None and wnid not in remaining:
+                        continue
+                    yield (url, url_id, wnid, tuple(row[4:6])) if len(row) > 4 else (url, url_id, wnid)
+
+        def validators_of(data):
+            # validators of every response are recorded, even if the request itself isn't conditional
+            return data[3] if len(data) > 3 else (None, None)
 
-    def fetch(self, urls):
+        self.states_writer.start()
+        try:
+            await util.fetch_with_callback_async(elements(),
+                                                 on_fetch,
+                                                 on_fail,
+                                                 on_fail=self.url_on_fail,
+                                                 async_limit=self.max_async_requests,
+                                                 host_limits=self.host_limits,
+                                                 retry_policy=self.retry_policy,
+                                                 on_complete=stage.join,
+                                                 conditional=validators_of,
+                                                 body=self.body,
+                                                 stop=(lambda: not remaining) if remaining is not None else None)
+        finally:
+            # runs on Ctrl-C and on cancellation too, so that states of saved images are not lost
+            await asyncio.get_running_loop().run_in_executor(None, self._close_stage, stage)
+
+        if self.content_index is not None:
+            self.print_dedup_report()
+
+    def _close_stage(self, stage):
+        stage.close()
+        self.states_writer.close()
+
+    def fetch(self, urls, skip_existing=False, targets=None):
         """
-        :param urls: a dictionary of (url_id, wnid, url, state_id)
+        :param urls: an iterable of (url_id, wnid, url, state_id)
+        :param skip_existing: if True, urls whose image is already stored are marked as saved without a request
+        :param targets: dictionary of wnid: number of images to save, fetching of a class stops once it is reached
         :return:
         """
+        self._fetch(urls, skip_existing=skip_existing, targets=targets)
+
+    async def fetch_async(self, urls, skip_existing=False, targets=None):
+        """
+        fetch() as a coroutine, which runs in the caller's event loop
+        :param urls: an iterable or async iterable of (url_id, wnid, url, state_id)
+        """
+        await self._fetch_async(urls, skip_existing=skip_existing, targets=targets)
+
+    def url_counts(self, wnids=None):
+        """
+        Counts urls of every class by state, in one grouped query
+        :param wnids: list of wnids, all classes if None
+        :return: dictionary of wnid: (urls, saved, failed, non-image, dead), see URL_STATS_COLUMNS
+        """
+        condition = "AND url.wnid = ANY(%(wnids)s::varchar[])" if wnids is not None else ''
+        query = f"SELECT url.wnid, " \
+                f"       COUNT(*), " \
+                f"       COUNT(*) FILTER (WHERE ust.state_id = {URL_STATE_SAVED}), " \
+                f"       COUNT(*) FILTER (WHERE ust.state_id = {URL_STATE_FAILED}), " \
+                f"       COUNT(*) FILTER (WHERE ust.state_id = {URL_STATE_NON_IMAGE}), " \
+                f"       COUNT(*) FILTER (WHERE ust.state_id = {URL_STATE_DEAD}) " \
+                f"FROM urls url " \
+                f"     LEFT OUTER JOIN url_states ust " \
+                f"          ON ust.url_id = url.id " \
+                f"WHERE url.release = '{self.release}' {condition} " \
+                f"GROUP BY url.wnid;"
+        rows = self.db.select(query, {'wnids': list(wnids)} if wnids is not None else None)
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def fetch_targets(self, wnids, fetch_ratio):
+        """
+        :return: dictionary of wnid: number of images still to save, so that "fetch_ratio" of urls of every
+        class of "wnids" are saved
+        """
+        counts = self.url_counts(wnids)
+        return {
+            wnid: max(0, math.ceil(fetch_ratio * counts[wnid][0]) - counts[wnid][1]) if wnid in counts else 0
+            for wnid in wnids
+        }
+
+    def _select_urls(self, wnids, condition=''):
+        query = f"SELECT url.id, url.wnid, url.url, ust.state_id, ust.etag, ust.last_modified " \
+                f"FROM urls url " \
+                f"     LEFT OUTER JOIN url_states ust " \
+                f"          ON ust.url_id = url.id " \
+                f"WHERE url.release = '{self.release}' " \
+                f"  AND url.wnid = ANY(%(wnids)s::varchar[]) {condition};"
+        return self.db.select(query, {'wnids': list(wnids)})
+
+    def get_url_states(self, wnids):
+        """
+        :return: list of (url_id, wnid, url, state_id, etag, last_modified) of all urls of wnids, state_id is None
+        if the url was never requested
+        """
+        wnids = list(wnids)
+        return [row for i in range(0, len(wnids), RESUME_CHUNK_WNIDS)
+                for row in self._select_urls(wnids[i:i + RESUME_CHUNK_WNIDS])]
+
+    def reconcile(self, wnids, workers=RESUME_SCAN_WORKERS_DEFAULT):
+        """
+        Brings url_states in line with stored images: urls whose image is stored are marked as saved, saved urls
+        whose image is missing are reset. The store is refreshed once, then stored images of classes are scanned
+        in parallel, which also rebuilds their manifests (see image_store.DirectoryStore.scan).
+        :param wnids: list of wnids
+        :param workers: number of threads listing classes
+        :return: dictionary of numbers of urls marked as saved and reset
+        """
+        stats = {'saved': 0, 'reset': 0}
+        wnids = list(wnids)
+        self.store.refresh()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for i in range(0, len(wnids), RESUME_CHUNK_WNIDS):
+                chunk = wnids[i:i + RESUME_CHUNK_WNIDS]
+                stored = dict(zip(chunk, pool.map(lambda wnid: set(self.store.scan(wnid)), chunk)))
+
+                states = []
+                for url_id, wnid, url, state_id, _, _ in self._select_urls(chunk):
+                    if _sha256(url)[:20] in stored[wnid]:
+                        if state_id != URL_STATE_SAVED:
+                            states.append((url_id, URL_STATE_SAVED))
+                            stats['saved'] += 1
+                    elif state_id == URL_STATE_SAVED:
+                        states.append((url_id, URL_STATE_NONE))
+                        stats['reset'] += 1
+                self.states_writer.add(states)
+                print(f'\r[RECONCILE] [CLASSES/SAVED/RESET] {i + len(chunk)}/{stats["saved"]}/{stats["reset"]}',
+                      end='')
+        self.states_writer.flush()
+        print()
+        return stats
+
+    def revalidate(self, wnids):
+        """
+        Requests saved images of wnids again, conditionally on their ETag / Last-Modified, so that only
+        changed images are downloaded. Images saved without validators are not requested.
+        :param wnids: list of wnids
+        """
+        condition = f"AND ust.state_id = {URL_STATE_SAVED} " \
+                    f"AND (ust.etag IS NOT NULL OR ust.last_modified IS NOT NULL)"
+        urls = [row for i in range(0, len(wnids), RESUME_CHUNK_WNIDS)
+                for row in self._select_urls(wnids[i:i + RESUME_CHUNK_WNIDS], condition)]
         self._fetch(urls)
 
+    def _execute(self, query, params=None, fetch=False):
+        return self.db.execute(query, params, fetch=fetch)
+
+    def _lease(self, wnids, batch_size, lease_timeout, owner):
+        """
+        Leases up to "batch_size" pending urls of wnids, which are not leased by anyone else. Locked rows are
+        skipped, so that concurrent workers never wait for each other and never get the same urls. Urls whose
+        released lease still names "owner" failed in this worker already, they are left to other workers. The
+        query runs once per batch, it is prepared once per connection.
+        :return: list of (url_id, wnid, url, state_id)
+        """
+        query = f"WITH leased AS (" \
+                f"    SELECT ust.url_id FROM url_states ust " \
+                f"         JOIN urls url ON url.id = ust.url_id " \
+                f"    WHERE url.release = $1::varchar " \
+                f"      AND url.wnid = ANY($2::varchar[]) " \
+                f"      AND ust.state_id NOT IN ({','.join(map(str, URL_STATES_DONE))}) " \
+                f"      AND (ust.lease_until IS NULL OR ust.lease_until < now()) " \
+                f"      AND ust.lease_owner IS DISTINCT FROM $5::varchar " \
+                f"    LIMIT $3::integer " \
+                f"    FOR UPDATE OF ust SKIP LOCKED) " \
+                f"UPDATE url_states ust " \
+                f"SET lease_until = now() + $4::double precision * interval '1 second', lease_owner = $5::varchar " \
+                f"FROM leased, urls url " \
+                f"WHERE ust.url_id = leased.url_id AND url.id = ust.url_id " \
+                f"RETURNING url.id, url.wnid, url.url, ust.state_id"
+        return self.db.execute_prepared('lease_urls', query,
+                                        (self.release, wnids, batch_size, lease_timeout, owner), fetch=True)
+
+    def _leased_urls(self, wnids, batch_size, lease_timeout, owner):
+        """
+        Yields leased urls, the next batch is leased when the download engine has taken the previous one
+        """
+        while True:
+            rows = self._lease(wnids, batch_size, lease_timeout, owner)
+            if not rows:
+                return
+            yield from rows
+
+    def _update_leases(self, wnids, owner, assignments, condition=''):
+        query = f"UPDATE url_states ust SET {assignments} " \
+                f"FROM urls url " \
+                f"WHERE url.id = ust.url_id " \
+                f"  AND url.release = '{self.release}' " \
+                f"  AND url.wnid = ANY(%(wnids)s::varchar[]) " \
+                f"  AND ust.state_id NOT IN ({','.join(map(str, URL_STATES_DONE))}) " \
+                f"  AND ust.lease_owner = %(owner)s {condition};"
+        self._execute(query, {'wnids': wnids, 'owner': owner})
+
+    def _renew_leases(self, wnids, lease_timeout, owner):
+        """
+        Extends leases of "owner" on urls which are still pending, e.g. urls waiting for retries
+        """
+        self._update_leases(wnids, owner, f"lease_until = now() + {float(lease_timeout)} * interval '1 second'",
+                            'AND ust.lease_until IS NOT NULL')
+
+    def _release_leases(self, wnids, owner):
+        """
+        Ends leases of "owner" on urls which are still pending (i.e. failed), so that other workers may take them.
+        The owner is kept, so that the worker itself doesn't lease them again
+        """
+        self._update_leases(wnids, owner, 'lease_until = NULL')
+
+    def _forget_leases(self, wnids, owner):
+        """
+        Clears leases and released leases of "owner", e.g. of a previous call, so that its urls are leased again
+        """
+        self._update_leases(wnids, owner, 'lease_until = NULL, lease_owner = NULL')
+
+    def _foreign_lease_wait(self, wnids, owner):
+        """
+        :return: seconds until the first active lease of another worker on a pending url expires, or None if
+        there is no such lease
+        """
+        query = f"SELECT EXTRACT(EPOCH FROM MIN(ust.lease_until) - now()) FROM url_states ust " \
+                f"     JOIN urls url ON url.id = ust.url_id " \
+                f"WHERE url.release = '{self.release}' " \
+                f"  AND url.wnid = ANY(%(wnids)s::varchar[]) " \
+                f"  AND ust.state_id NOT IN ({','.join(map(str, URL_STATES_DONE))}) " \
+                f"  AND ust.lease_until > now() AND ust.lease_owner <> %(owner)s;"
+        wait = self._execute(query, {'wnids': wnids, 'owner': owner}, fetch=True)[0][0]
+        return float(wait) if wait is not None else None
+
+    def work(self, wnids, batch_size=LEASE_BATCH_SIZE_DEFAULT, lease_timeout=LEASE_TIMEOUT_DEFAULT, owner=None):
+        """
+        Worker mode: any number of processes (on any number of machines) may work on the same wnids. Every worker
+        leases batches of pending urls in url_states and downloads them, states written by the worker end its
+        leases. Leases of urls in flight (e.g. waiting for retries) are renewed by a thread, so urls of a crashed
+        worker are leased again "lease_timeout" seconds after it stopped. A worker doesn't lease its own failed
+        urls again: their leases are released once the worker has gone through its leases, but keep the owner,
+        so that other workers (or a next call) may try them.
+        The call returns when there is nothing left to lease and no other worker holds a lease.
+        :param wnids: list of wnids
+        :param batch_size: urls leased at once
+        :param lease_timeout: seconds
+        :param owner: name of the worker written to leases, host:pid by default
+        """
+        wnids = list(wnids)
+        owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        # leases are kept in url_states, so every url needs a state row
+        self._execute(f"INSERT INTO url_states (url_id, state_id) "
+                      f"SELECT url.id, {URL_STATE_NONE} FROM urls url "
+                      f"WHERE url.release = '{self.release}' AND url.wnid = ANY(%(wnids)s::varchar[]) "
+                      f"ON CONFLICT DO NOTHING;", {'wnids': wnids})
+        self._forget_leases(wnids, owner)
+
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(lease_timeout / LEASE_RENEWALS_PER_TIMEOUT):
+                try:
+                    self._renew_leases(wnids, lease_timeout, owner)
+                except Exception as ex:
+                    print(f'\nCannot renew leases: {ex!r}')
+
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            while True:
+                self._fetch(self._leased_urls(wnids, batch_size, lease_timeout, owner))
+                self._release_leases(wnids, owner)
+                # urls leased by other workers are taken over if their leases expire
+                wait = self._foreign_lease_wait(wnids, owner)
+                if wait is None:
+                    break
+                print(f'\nWaiting for leases of other workers ({wait:.0f} s left)...')
+                time.sleep(min(max(wait, 0), LEASE_POLL_INTERVAL))
+        finally:
+            stop.set()
+            renewer.join()
+
+    def dedup_report(self):
+        """
+        :return: dictionary of unique images, duplicates stored as references and bytes saved by them,
+        or None if deduplication is off
+        """
+        if self.content_index is None:
+            return None
+        return self.content_index.report()
+
+    def print_dedup_report(self):
+        report = self.dedup_report()
+        print(f'\n[DEDUP] unique images: {report["unique"]}, duplicates: {report["duplicates"]}, '
+              f'saved: {report["bytes_saved"] / (1 << 20):.1f} MiB')
+
     def clean(self):
-        if os.path.isdir(self.directory):
-            lst_files = os.listdir(self.directory)
-            for folder in lst_files:
-                if re.fullmatch(r'n\d{8}', folder):
-                    shutil.rmtree(os.path.join(self.directory, folder))
-
-        query = f"UPDATE url_states SET state_id = 1"
-        self.cursor.execute('ROLLBACK;')
-        self.cursor.execute(query)
-        self.db_conn.commit()
+        self.store.clean()
+        if self.content_index is not None:
+            self.content_index.clean()
+
+        query = f"UPDATE url_states SET state_id = {URL_STATE_NONE}"
+        self._execute(query)
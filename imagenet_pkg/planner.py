@@ -0,0 +1,118 @@
+import os
+import random
+import itertools
+import collections
+from urllib.parse import urlsplit
+from imagenet_pkg.constants import *
+
+
+def _spread(items, count, offset=0.5):
+    """
+    :return: "count" items evenly spaced over "items", "offset" (0 to 1) shifts the positions within a step
+    """
+    if count >= len(items):
+        return list(items)
+    step = len(items) / count
+    return [items[int((i + offset) * step)] for i in range(count)]
+
+
+class PullPlanner:
+    """
+    Plans a pull of a balanced subset: picks at most "max_classes" classes spread over the hierarchy, and the urls
+    of every class needed to save "per_class" images. Pending urls are weighted by the success rate of their host
+    measured in url_states (smoothed towards the rate of their class, which is smoothed towards the overall
+    rate), urls of reliable hosts come first, and urls are planned until the expected number of saved images
+    reaches the quota, so quotas are over-provisioned by the expected failure rate.
+    """
+
+    def __init__(self, max_classes=None, per_class=None, strategy=PLAN_STRATEGY_STRATIFIED, seed=None):
+        """
+        :param strategy: PLAN_STRATEGY_LEAVES picks leaf classes evenly over the hierarchy, PLAN_STRATEGY_DEPTH
+        picks the shallowest classes first, PLAN_STRATEGY_STRATIFIED gives every subtree below the shallowest
+        classes an equal share of leaf classes
+        :param seed: shifts the picked classes, the same seed gives the same plan
+        """
+        if strategy not in PLAN_STRATEGIES:
+            raise Exception(f'Invalid plan strategy {strategy}')
+        self.max_classes = max_classes
+        self.per_class = per_class
+        self.strategy = strategy
+        self.offset = random.Random(seed).random() if seed is not None else 0.5
+
+    def select_classes(self, classes):
+        """
+        :param classes: list of (wnid, short_name, full_name, path) of candidate classes
+        :return: list of selected wnids
+        """
+        paths = {wnid: path.split(os.sep) if path else [wnid] for wnid, _, _, path in classes}
+        # paths sort in DFS order, so that evenly spaced picks are spread over the hierarchy
+        wnids = sorted(paths, key=lambda wnid: paths[wnid])
+        # leaves of the candidates, the deepest classes of a pull limited by depth included
+        ancestors = {wnid for parts in paths.values() for wnid in parts[:-1]}
+        leaves = [wnid for wnid in wnids if wnid not in ancestors]
+        count = self.max_classes or len(wnids)
+
+        if self.strategy == PLAN_STRATEGY_LEAVES:
+            return _spread(leaves, count, self.offset)
+
+        if self.strategy == PLAN_STRATEGY_DEPTH:
+            selected = []
+            by_level = sorted(wnids, key=lambda wnid: len(paths[wnid]))  # stable, DFS order within a level
+            for _, level in itertools.groupby(by_level, key=lambda wnid: len(paths[wnid])):
+                if len(selected) >= count:
+                    break
+                selected.extend(_spread(list(level), count - len(selected), self.offset))
+            return selected
+
+        top = min(len(parts) for parts in paths.values()) if paths else 0
+        strata = collections.defaultdict(list)
+        for wnid in leaves:
+            strata[tuple(paths[wnid][:top + 1])].append(wnid)
+        # classes are dealt to strata one by one, strata with fewer leaves than their share leave the rest to others
+        quotas = dict.fromkeys(strata, 0)
+        left = min(count, len(leaves))
+        while left:
+            for stratum, members in strata.items():
+                if left and quotas[stratum] < len(members):
+                    quotas[stratum] += 1
+                    left -= 1
+        return [wnid for stratum, members in strata.items() for wnid in _spread(members, quotas[stratum], self.offset)]
+
+    def select_urls(self, wnids, rows):
+        """
+        :param wnids: selected wnids
+        :param rows: (url_id, wnid, url, state_id, ...) of all urls of "wnids", requested or not
+        :return: (list of (url_id, wnid, url, state_id) to request, dictionary of wnid: number of images still
+        to save, see ImagesWorker.fetch)
+        """
+        stats = collections.defaultdict(lambda: [0, 0])  # None, wnid or host: [saved, requested]
+        pending = collections.defaultdict(list)
+        for row in rows:
+            url_id, wnid, url, state_id = row[:4]
+            host = urlsplit(url).hostname
+            if state_id is not None and state_id != URL_STATE_NONE:
+                for key in (None, wnid, ('host', host)):
+                    stats[key][0] += state_id == URL_STATE_SAVED
+                    stats[key][1] += 1
+            if state_id not in URL_STATES_DONE:
+                pending[wnid].append((host, (url_id, wnid, url, state_id)))
+
+        def rate(key, prior):
+            saved, requested = stats.get(key, (0, 0))
+            return (saved + PLAN_PRIOR_WEIGHT * prior) / (requested + PLAN_PRIOR_WEIGHT)
+
+        overall_rate = rate(None, PLAN_SUCCESS_RATE_DEFAULT)
+        urls = []
+        targets = {}
+        for wnid in wnids:
+            targets[wnid] = needed = max(0, self.per_class - stats.get(wnid, (0, 0))[0])
+            class_rate = rate(wnid, overall_rate)
+            weighted = sorted(((rate(('host', host), class_rate), row) for host, row in pending[wnid]),
+                              key=lambda item: -item[0])
+            expected = 0
+            for success_rate, row in weighted:
+                if expected >= needed:
+                    break
+                urls.append(row)
+                expected += success_rate
+        return urls, targets
@@ -0,0 +1,155 @@
+import io
+import random
+import itertools
+import collections
+import concurrent.futures
+from imagenet_pkg.constants import *
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception('Decoded images and batches require NumPy (pip install numpy)')
+    return numpy
+
+
+def _decode(data, image_size=None):
+    """
+    :return: HxWx3 uint8 array of an encoded image, resized to "image_size" (width, height) if given
+    """
+    numpy = _numpy()
+    try:
+        import PIL.Image as image_module
+    except ImportError:
+        raise Exception('Decoding images requires Pillow (pip install Pillow)')
+    with image_module.open(io.BytesIO(data)) as img:
+        img = img.convert('RGB')
+        if image_size:
+            img = img.resize(image_size, image_module.BILINEAR)
+        return numpy.asarray(img)
+
+
+class DatasetReader:
+    """
+    Reads saved images of many classes: samples of all classes are listed once (classes in parallel), shuffled
+    with a seed which is the same on every rank, split between "world_size" ranks, and read ahead by "workers"
+    threads. Images may be decoded into NumPy arrays by the same threads, Pillow releases the GIL while decoding.
+    Iterating yields (image, label, wnid), where image is bytes (memoryview with STORAGE_PACK) or, if decoded,
+    an HxWx3 uint8 array. If "batch_size" is given, (images, labels, wnids) batches are yielded instead, where
+    labels is an array, and images is an NxHxWx3 array if decoded, else a list.
+    Labels are indices of wnids in sorted order.
+    """
+
+    def __init__(self, api, wnids, recursive=False, deep=None, decode=False, image_size=None, batch_size=None,
+                 shuffle=True, seed=0, rank=0, world_size=1, drop_last=False, workers=READER_WORKERS_DEFAULT,
+                 prefetch=READER_PREFETCH_DEFAULT):
+        """
+        :param api: api.ApiSession
+        :param recursive: if True, descendants of "wnids" are read too, "deep" limits the depth
+        :param image_size: (width, height) decoded images are resized to, required for batches of decoded images
+        :param seed: seed of shuffling, the order of epoch N is shuffled with seed + N (see set_epoch)
+        :param rank: index of this reader among "world_size" readers, every rank gets a disjoint part of samples
+        :param drop_last: if True, samples which don't fill every rank (and the last partial batch) are dropped,
+        else ranks are filled up with samples from the beginning, so that every rank reads the same number
+        :param prefetch: number of images read ahead
+        """
+        if decode and batch_size and not image_size:
+            raise Exception('Batches of decoded images require image_size')
+        if not 0 <= rank < world_size:
+            raise Exception(f'Invalid rank {rank} of world size {world_size}')
+
+        if recursive:
+            wnids = [info[0] for info in api.get_wnid_info(list(wnids), recursive=True, deep=deep)]
+        self.api = api
+        self.wnids = sorted(set(wnids))
+        self.labels = {wnid: label for label, wnid in enumerate(self.wnids)}
+        self.decode = decode
+        self.image_size = image_size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.workers = workers
+        self.prefetch = prefetch
+
+        self.epoch = 0
+        self._samples = None
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch whose order is read next, every epoch has its own shuffle
+        """
+        self.epoch = epoch
+
+    def _list(self):
+        if self._samples is None:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                keys = pool.map(lambda wnid: sorted(self.api.images_keys_iter(wnid)), self.wnids)
+                self._samples = [(wnid, key) for wnid, wnid_keys in zip(self.wnids, keys) for key in wnid_keys]
+        return self._samples
+
+    def samples(self):
+        """
+        :return: list of (wnid, key) read by this rank in the current epoch
+        """
+        samples = list(self._list())
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(samples)
+
+        if self.drop_last:
+            samples = samples[:len(samples) // self.world_size * self.world_size]
+        elif samples and len(samples) % self.world_size:
+            padding = self.world_size - len(samples) % self.world_size
+            samples += (samples * padding)[:padding]
+        return samples[self.rank::self.world_size]
+
+    def __len__(self):
+        count = len(self.samples())
+        if not self.batch_size:
+            return count
+        return count // self.batch_size if self.drop_last else -(-count // self.batch_size)
+
+    def _load(self, wnid, key):
+        data = self.api.read_image(wnid, key)
+        if self.decode:
+            data = _decode(data, self.image_size)
+        return data, self.labels[wnid], wnid
+
+    def _items(self):
+        samples = iter(self.samples())
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                for wnid, key in itertools.islice(samples, self.prefetch):
+                    pending.append(pool.submit(self._load, wnid, key))
+                while pending:
+                    item = pending.popleft().result()
+                    sample = next(samples, None)
+                    if sample is not None:
+                        pending.append(pool.submit(self._load, *sample))
+                    yield item
+            finally:
+                # the consumer may stop early
+                for future in pending:
+                    future.cancel()
+
+    def _collate(self, batch):
+        numpy = _numpy()
+        images = numpy.stack([item[0] for item in batch]) if self.decode else [item[0] for item in batch]
+        return images, numpy.array([item[1] for item in batch], dtype=numpy.int64), [item[2] for item in batch]
+
+    def __iter__(self):
+        if not self.batch_size:
+            yield from self._items()
+            return
+        batch = []
+        for item in self._items():
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield self._collate(batch)
+                batch = []
+        if batch and not self.drop_last:
+            yield self._collate(batch)
@@ -0,0 +1,43 @@
+import os
+import pickle
+import tempfile
+from imagenet_pkg.constants import *
+
+
+def snapshot_path(directory, release):
+    return os.path.join(directory, f'hierarchy-{release}.v{SNAPSHOT_VERSION}.pickle')
+
+
+def load_snapshot(directory, release, fingerprint):
+    """
+    Returns data saved by save_snapshot(), or None if there is no snapshot, or it was made by another
+    format version or from different database contents.
+    :param fingerprint: value describing database contents (e.g. row counts and checksums)
+    """
+    path = snapshot_path(directory, release)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as fp:
+            snapshot = pickle.load(fp)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('fingerprint') != fingerprint:
+        return None
+    return snapshot['data']
+
+
+def save_snapshot(directory, release, fingerprint, data):
+    """
+    Atomically writes "data" as the snapshot of "release"
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'fingerprint': fingerprint, 'data': data},
+                        fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path(directory, release))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
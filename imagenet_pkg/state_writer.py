@@ -0,0 +1,90 @@
+import threading
+from imagenet_pkg.constants import *
+from imagenet_pkg.db import Database
+
+# columns which may come with a state, they are never overwritten by empty values
+_OPTIONAL_COLUMNS = ('etag', 'last_modified', 'width', 'height')
+
+
+class UrlStatesWriter:
+    """
+    Buffers url state transitions and writes them to url_states in bulk (see bulk.bulk_insert): rows are
+    copied into a temporary table and merged with a single upsert. The buffer is flushed when it reaches
+    "batch_size" rows, and every "flush_interval" seconds by a background thread. Only the latest state
+    of every url is kept. Validators (etag, last_modified) of a response may come with the state, they are
+    kept in url_states for conditional requests, and so may dimensions of verified images (width, height).
+    They are never overwritten by empty ones.
+    """
+
+    def __init__(self, db, batch_size=STATES_BATCH_SIZE_DEFAULT, flush_interval=STATES_FLUSH_INTERVAL_DEFAULT):
+        """
+        :param db: db.Database, with a pooled one, flushes don't wait for other users of the database
+        """
+        self.db: Database = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._buffer = {}  # url_id: (state_id, etag, last_modified)
+        self._buffer_lock = threading.Lock()
+        # flushes of the periodic thread and of the caller are written in order
+        self._flush_lock = threading.Lock()
+        self._stop = None
+        self._thread = None
+
+        self.flushed = 0
+
+    def _periodic_flush(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        """
+        Starts periodic flushing
+        """
+        if self._thread is None and self.flush_interval:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._periodic_flush, daemon=True)
+            self._thread.start()
+
+    def add(self, states):
+        """
+        :param states: an array of (url_id, state_id), (url_id, state_id, etag, last_modified) or
+        (url_id, state_id, etag, last_modified, width, height)
+        """
+        with self._buffer_lock:
+            self._buffer.update((row[0], tuple(row[1:]) + (None,) * (len(_OPTIONAL_COLUMNS) + 2 - len(row)))
+                                for row in states)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._buffer_lock:
+                rows, self._buffer = self._buffer, {}
+            if not rows:
+                return
+
+            updates = ''.join(f', {column} = COALESCE(EXCLUDED.{column}, url_states.{column})'
+                              for column in _OPTIONAL_COLUMNS)
+            self.db.bulk_insert('url_states', ('url_id', 'state_id', *_OPTIONAL_COLUMNS),
+                                ((url_id, *row) for url_id, row in rows.items()),
+                                on_conflict=f'ON CONFLICT (url_id) DO UPDATE SET state_id = EXCLUDED.state_id{updates}')
+            self.flushed += len(rows)
+
+    def close(self):
+        """
+        Stops periodic flushing and writes everything buffered
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
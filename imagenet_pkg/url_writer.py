@@ -0,0 +1,81 @@
+import time
+import threading
+from imagenet_pkg.constants import *
+from imagenet_pkg.bulk import bulk_insert
+from imagenet_pkg.db import Database
+
+
+class UrlsWriter:
+    """
+    Buffers url lists of many wnids and writes them with a single transaction per "batch_size" urls: urls are
+    copied into urls (see bulk.bulk_insert), and state rows are created only for ids of urls which were actually
+    inserted, so that states of already known urls (e.g. saved images) are never reset.
+    """
+
+    def __init__(self, db, release, batch_size=URLS_BATCH_SIZE_DEFAULT):
+        """
+        :param db: db.Database
+        """
+        self.db: Database = db
+        self.release = release
+        self.batch_size = batch_size
+
+        self._buffer = []  # (release, wnid, url)
+        self._lock = threading.Lock()
+
+        self.received = 0
+        self.inserted = 0
+        self.started = time.monotonic()
+
+    def add(self, wnid, urls):
+        """
+        :param urls: iterable of urls of wnid
+        """
+        with self._lock:
+            size = len(self._buffer)
+            self._buffer.extend((self.release, wnid, url) for url in urls)
+            self.received += len(self._buffer) - size
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def add_rows(self, rows):
+        """
+        :param rows: list of (wnid, url) of any wnids
+        """
+        with self._lock:
+            self._buffer.extend((self.release, wnid, url) for wnid, url in rows)
+            self.received += len(rows)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+            if not rows:
+                return
+
+            with self.db.connection() as conn, conn.cursor() as cursor:
+                ids = bulk_insert(cursor, 'urls', ('release', 'wnid', 'url'), rows, returning='id')
+                bulk_insert(cursor, 'url_states', ('url_id', 'state_id'),
+                            ((url_id, URL_STATE_NONE) for url_id, in ids))
+            self.inserted += len(ids)
+
+    def rate(self):
+        """
+        :return: received urls per second since the writer was created
+        """
+        return self.received / max(time.monotonic() - self.started, 1e-9)
+
+    def stats_line(self):
+        return f'urls: {self.received}, new: {self.inserted}, {self.rate():.0f} urls/s'
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -5,6 +5,15 @@ import time
 import asyncio
 import aiohttp
 import socket
+import collections
+import urllib.parse
+import heapq
+import itertools
+import random
+import inspect
+import hashlib
+import os
+import tempfile
 
 
 def get(url, max_retries=MAX_RECONNECT_ATTEMPTS, timeout=10):
@@ -46,9 +55,183 @@ async def _fetch(session, url, timeout):
         return (url,)
 
 
-async def _fetch_v2(session, data_in, timeout):
+def classify_status(status):
     """
-    If success, returns (URL_SUCCESS, data_in, bytes), if failed, returns (URL_FAILED, data_in)
+    Returns FETCH_ERROR_* class of an HTTP status, or None if the status is not an error
+    """
+    if status in (404, 410):
+        return FETCH_ERROR_NOT_FOUND
+    if status >= 500 or status == 429:
+        return FETCH_ERROR_SERVER
+    if status >= 400:
+        return FETCH_ERROR_CLIENT
+    return None
+
+
+def classify_exception(ex):
+    """
+    Returns FETCH_ERROR_* class of an exception raised by a request
+    """
+    if isinstance(ex, asyncio.TimeoutError):
+        return FETCH_ERROR_TIMEOUT
+    if isinstance(ex, aiohttp.ClientConnectorError):
+        if isinstance(ex.os_error, socket.gaierror):
+            return FETCH_ERROR_DNS
+        return FETCH_ERROR_CONNECTION
+    if isinstance(ex, (aiohttp.ClientError, OSError)):
+        return FETCH_ERROR_CONNECTION
+    return FETCH_ERROR_OTHER
+
+
+def _conditional_headers(validators):
+    etag, last_modified = validators
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def sniff_image(head):
+    """
+    :param head: first SNIFF_SIZE bytes of a file
+    :return: image type by its magic bytes ('jpeg', 'png', 'gif' or 'webp'), or None
+    """
+    if head[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class SpooledBody:
+    """
+    Response body written to a file while it was received (see BodyPolicy)
+    """
+
+    def __init__(self, path, size, digest, kind):
+        """
+        :param digest: sha256 of the body, hex
+        :param kind: image type, see sniff_image
+        """
+        self.path = path
+        self.size = size
+        self.digest = digest
+        self.kind = kind
+
+    def read(self):
+        with open(self.path, 'rb') as fp:
+            return fp.read()
+
+    def discard(self):
+        """
+        Removes the file, unless it has been moved away already
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _Spool:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self.fp = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, chunks):
+        for chunk in chunks:
+            self.fp.write(chunk)
+            self.digest.update(chunk)
+            self.size += len(chunk)
+
+    def finish(self, kind):
+        self.fp.close()
+        return SpooledBody(self.path, self.size, self.digest.hexdigest(), kind)
+
+    def discard(self):
+        self.fp.close()
+        os.unlink(self.path)
+
+
+class BodyPolicy:
+    """
+    How fetch_with_callback reads response bodies: in chunks of "chunk_size", the body is aborted as soon as its
+    first bytes show it isn't an image of "kinds" (see sniff_image), or once it exceeds "max_size" bytes (at once,
+    if Content-Length says so). If "spool_dir" is given, accepted bodies are written to files in it while they are
+    received, and are passed on as SpooledBody instead of bytes, so that memory doesn't grow with body sizes.
+    """
+
+    def __init__(self, kinds=('jpeg',), max_size=MAX_BODY_SIZE_DEFAULT, spool_dir=None, chunk_size=BODY_CHUNK_SIZE):
+        """
+        :param max_size: maximum body size in bytes, 0 or None for no limit
+        """
+        self.kinds = kinds
+        self.max_size = max_size
+        self.spool_dir = spool_dir
+        self.chunk_size = chunk_size
+
+    async def read(self, response):
+        """
+        :return: (bytes or SpooledBody, None), or (None, FETCH_ERROR_NON_IMAGE or FETCH_ERROR_TOO_LARGE) if the body
+        was rejected, the rest of a rejected body is never read
+        """
+        if self.max_size and (response.content_length or 0) > self.max_size:
+            return None, FETCH_ERROR_TOO_LARGE
+
+        head, size, kind = b'', 0, None
+        chunks = []
+        spool = None
+        # spool files are created and written by threads, disk I/O never blocks the event loop
+        loop = asyncio.get_running_loop()
+        try:
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                size += len(chunk)
+                if self.max_size and size > self.max_size:
+                    return None, FETCH_ERROR_TOO_LARGE
+                chunks.append(chunk)
+                if kind is None:
+                    head = (head + chunk)[:SNIFF_SIZE]
+                    if len(head) < SNIFF_SIZE:
+                        continue
+                    kind = sniff_image(head)
+                    if kind not in self.kinds:
+                        return None, FETCH_ERROR_NON_IMAGE
+                if self.spool_dir:
+                    spool = spool or await loop.run_in_executor(None, _Spool, self.spool_dir)
+                    await loop.run_in_executor(None, spool.write, chunks)
+                    chunks = []
+
+            if kind is None:
+                # bodies shorter than SNIFF_SIZE
+                kind = sniff_image(head)
+                if kind not in self.kinds:
+                    return None, FETCH_ERROR_NON_IMAGE
+            if not self.spool_dir:
+                return b''.join(chunks), None
+            spool = spool or await loop.run_in_executor(None, _Spool, self.spool_dir)
+            await loop.run_in_executor(None, spool.write, chunks)
+            body, spool = await loop.run_in_executor(None, spool.finish, kind), None
+            return body, None
+        finally:
+            if spool is not None:
+                await loop.run_in_executor(None, spool.discard)
+
+
+async def _fetch_v2(session, data_in, timeout, validators=None, body=None):
+    """
+    If success, returns (URL_SUCCESS, data_in, bytes), if failed, returns (URL_FAILED, data_in, FETCH_ERROR_*)
+    :param validators: if not None, (etag, last_modified) of a conditional request, in that case success
+    returns (URL_SUCCESS, data_in, bytes, (etag, last_modified) of the response), where bytes are None if the
+    server answered 304 Not Modified
+    :param body: BodyPolicy the body is read with, if None the whole body is read into memory
     """
     if isinstance(data_in, str):
         url = data_in
@@ -58,11 +241,287 @@ async def _fetch_v2(session, data_in, timeout):
         kwargs = {'url': url}
         if timeout:
             kwargs['timeout'] = timeout
+        if validators is not None:
+            kwargs['headers'] = _conditional_headers(validators)
         async with session.get(**kwargs) as response:
-            data = await response.read()
+            if validators is not None and response.status == 304:
+                return URL_SUCCESS, data_in, None, validators
+            error = classify_status(response.status)
+            if error:
+                return URL_FAILED, data_in, error
+            if body is None:
+                data = await response.read()
+            else:
+                data, error = await body.read(response)
+                if error:
+                    # the connection is closed rather than drained
+                    response.close()
+                    return URL_FAILED, data_in, error
+            if validators is not None:
+                return URL_SUCCESS, data_in, data, (response.headers.get('ETag'),
+                                                    response.headers.get('Last-Modified'))
             return URL_SUCCESS, data_in, data
-    except BaseException as ex:
-        return URL_FAILED, data_in
+    except Exception as ex:
+        return URL_FAILED, data_in, classify_exception(ex)
+
+
+class RetryPolicy:
+    """
+    Decides whether a failed element is requested again and when. Every error class has its own
+    attempts limit (see RETRY_ATTEMPTS_BY_ERROR), but no more than "max_attempts". Delays grow
+    exponentially from "base_delay" up to "max_delay" with full jitter.
+    """
+
+    def __init__(self,
+                 max_attempts=RETRY_MAX_ATTEMPTS_DEFAULT,
+                 base_delay=RETRY_BASE_DELAY_DEFAULT,
+                 max_delay=RETRY_MAX_DELAY_DEFAULT,
+                 attempts_by_error=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempts_by_error = attempts_by_error if attempts_by_error is not None else RETRY_ATTEMPTS_BY_ERROR
+
+    def attempts_allowed(self, error):
+        return min(self.max_attempts, self.attempts_by_error.get(error, self.max_attempts))
+
+    def next_delay(self, error, attempt):
+        """
+        :param error: FETCH_ERROR_* class of the failure
+        :param attempt: number of attempts already made (starting from 1)
+        :return: delay in seconds before the next attempt, or None if the element should not be retried
+        """
+        if attempt >= self.attempts_allowed(error):
+            return None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class _HostState:
+    def __init__(self, concurrency):
+        self.concurrency = float(concurrency)
+        self.active = 0
+        self.ready = 0
+        self.parked = collections.deque()
+        self.consecutive_failures = 0
+        self.cooldowns = 0
+        self.cooldown_until = 0.0
+        self.latency = None
+        self.error_rate = 0.0
+        self.dead = False
+
+
+class HostLimiter:
+    """
+    Per-host concurrency limiter. Every host has its own number of slots, which grows by one slot
+    per "window" of successful fast responses (additive increase) and is multiplied by "decrease_factor"
+    on an error or a slow response (multiplicative decrease). Hosts which failed "max_failures" times
+    in a row are put on a cooldown, which doubles every time the host fails again. After "max_cooldowns"
+    cooldowns in a row the host is considered dead, and its elements are dropped without requests.
+    Elements for saturated or cooling down hosts are parked, so that workers may take other hosts' elements.
+    """
+
+    def __init__(self,
+                 initial_concurrency=HOST_INITIAL_CONCURRENCY_DEFAULT,
+                 max_concurrency=HOST_MAX_CONCURRENCY_DEFAULT,
+                 decrease_factor=HOST_DECREASE_FACTOR_DEFAULT,
+                 latency_target=HOST_LATENCY_TARGET_DEFAULT,
+                 max_failures=HOST_MAX_FAILURES_DEFAULT,
+                 cooldown=HOST_COOLDOWN_DEFAULT,
+                 max_cooldown=HOST_MAX_COOLDOWN_DEFAULT,
+                 max_cooldowns=HOST_MAX_COOLDOWNS_DEFAULT,
+                 max_parked=HOST_MAX_PARKED_DEFAULT):
+        self.initial_concurrency = max(1, initial_concurrency)
+        self.max_concurrency = max(self.initial_concurrency, max_concurrency)
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_cooldowns = max_cooldowns
+        self.max_parked = max_parked
+
+        self._hosts = {}
+        self._ready = collections.deque()
+        self._dropped = collections.deque()
+        self._ready_event = asyncio.Event()
+        self._slot_freed = asyncio.Event()
+        self._parked = 0
+
+    @staticmethod
+    def host_of(data_in):
+        url = data_in if isinstance(data_in, str) else data_in[0]
+        return urllib.parse.urlsplit(url).hostname or ''
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = _HostState(self.initial_concurrency)
+            self._hosts[host] = state
+        return state
+
+    def _available(self, state):
+        return state.cooldown_until <= time.monotonic() and state.active + state.ready < int(state.concurrency)
+
+    def _promote(self, host):
+        # move parked elements of the host to the ready queue while it has free slots
+        state = self._hosts[host]
+        if state.dead:
+            self._parked -= len(state.parked)
+            self._dropped.extend(state.parked)
+            state.parked.clear()
+        while state.parked and self._available(state):
+            self._ready.append((host, state.parked.popleft()))
+            state.ready += 1
+            self._parked -= 1
+        if self._ready or self._dropped:
+            self._ready_event.set()
+
+    def has_dropped(self):
+        return bool(self._dropped)
+
+    def pop_dropped(self):
+        """
+        Returns an element of a dead host, which should be reported as failed.
+        """
+        data_in = self._dropped.popleft()
+        if not self._ready and not self._dropped:
+            self._ready_event.clear()
+        return data_in
+
+    def has_ready(self):
+        return bool(self._ready)
+
+    def has_parked(self):
+        return self._parked > 0
+
+    def pop_ready(self):
+        """
+        Returns a parked element whose host has got a free slot. The slot is taken by the caller.
+        """
+        host, data_in = self._ready.popleft()
+        if not self._ready and not self._dropped:
+            self._ready_event.clear()
+        state = self._hosts[host]
+        state.ready -= 1
+        state.active += 1
+        return data_in
+
+    async def wait_ready(self):
+        await self._ready_event.wait()
+
+    async def try_acquire(self, data_in):
+        """
+        Takes a slot of the element's host. If the host is saturated or on a cooldown, parks the element
+        and returns False. If too many elements are parked already, waits for the slot instead.
+        Elements of dead hosts are dropped, and False is returned.
+        """
+        host = self.host_of(data_in)
+        state = self._state(host)
+        if state.dead:
+            self._dropped.append(data_in)
+            self._ready_event.set()
+            return False
+        if self._available(state):
+            state.active += 1
+            return True
+        if self._parked < self.max_parked:
+            state.parked.append(data_in)
+            self._parked += 1
+            if state.cooldown_until > time.monotonic() and len(state.parked) == 1:
+                asyncio.get_running_loop().call_later(state.cooldown_until - time.monotonic(), self._promote, host)
+            return False
+        while not self._available(state):
+            if state.dead:
+                self._dropped.append(data_in)
+                self._ready_event.set()
+                return False
+            self._slot_freed.clear()
+            delay = state.cooldown_until - time.monotonic()
+            try:
+                await asyncio.wait_for(self._slot_freed.wait(), timeout=delay if delay > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+        state.active += 1
+        return True
+
+    def release(self, data_in, success, latency):
+        """
+        Frees the element's host slot and adjusts the host's concurrency.
+        :param success: whether the request succeeded
+        :param latency: request duration in seconds
+        """
+        host = self.host_of(data_in)
+        state = self._state(host)
+        state.active -= 1
+
+        state.latency = latency if state.latency is None else \
+            HOST_EWMA_ALPHA * latency + (1 - HOST_EWMA_ALPHA) * state.latency
+        state.error_rate = HOST_EWMA_ALPHA * (0 if success else 1) + (1 - HOST_EWMA_ALPHA) * state.error_rate
+
+        if success:
+            state.consecutive_failures = 0
+            state.cooldowns = 0
+            if latency <= self.latency_target:
+                state.concurrency = min(self.max_concurrency, state.concurrency + 1 / state.concurrency)
+            else:
+                state.concurrency = max(1.0, state.concurrency * self.decrease_factor)
+        else:
+            state.consecutive_failures += 1
+            state.concurrency = max(1.0, state.concurrency * self.decrease_factor)
+            if state.consecutive_failures >= self.max_failures:
+                state.consecutive_failures = 0
+                state.cooldowns += 1
+                if state.cooldowns > self.max_cooldowns:
+                    state.dead = True
+                    self._promote(host)
+                    self._slot_freed.set()
+                    return
+                cooldown = min(self.max_cooldown, self.cooldown * 2 ** (state.cooldowns - 1))
+                state.cooldown_until = time.monotonic() + cooldown
+                # probe the host with a single request after the cooldown
+                state.concurrency = 1.0
+                if state.parked:
+                    asyncio.get_running_loop().call_later(cooldown, self._promote, host)
+
+        self._promote(host)
+        self._slot_freed.set()
+
+    def stats(self):
+        """
+        :return: dictionary of host: (concurrency, active, parked, latency, error_rate, in_cooldown, dead)
+        """
+        now = time.monotonic()
+        return {
+            host: (int(state.concurrency), state.active, len(state.parked),
+                   state.latency, state.error_rate, state.cooldown_until > now, state.dead)
+            for host, state in self._hosts.items()
+        }
+
+
+async def iterate_chunks(iterable, chunk_size, executor=None):
+    """
+    Yields lists of up to "chunk_size" elements of a sync or async iterable. A sync iterable is consumed by
+    "executor" threads (the default executor if None), so that iterables which read a database cursor or files
+    never block the event loop.
+    """
+    if hasattr(iterable, '__aiter__'):
+        chunk = []
+        async for element in iterable:
+            chunk.append(element)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    while True:
+        chunk = await loop.run_in_executor(executor, list, itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def fetch_with_callback(list_data,
@@ -70,55 +529,152 @@ def fetch_with_callback(list_data,
                         callback_on_fail=None,
                         **kwargs):
     """
-    :param list_data: string or list of data, where the first element is url
-    :param callback_on_fetch:
-    :param callback_on_fail:
-    :param kwargs:
+    Runs fetch_with_callback_async in a new event loop, see its arguments
+    """
+    asyncio.run(fetch_with_callback_async(list_data, callback_on_fetch, callback_on_fail, **kwargs))
+
+
+async def fetch_with_callback_async(list_data,
+                                    callback_on_fetch,
+                                    callback_on_fail=None,
+                                    **kwargs):
+    """
+    Downloads every element of "list_data" using a fixed pool of "async_limit" worker tasks,
+    which are fed through a bounded queue. "list_data" may be any iterable (including a generator) or an async
+    iterable, it is consumed lazily, so memory usage doesn't depend on its size. The coroutine runs in the
+    caller's event loop.
+    Concurrency per host is controlled by HostLimiter, whose arguments may be passed as "host_limits".
+    If "on_fail" is URL_ON_FAIL_RETRY, failed elements are requested again after a delay given by
+    "retry_policy" (RetryPolicy), until the policy gives up on them.
+    :param list_data: iterable of data, where each element is either url or a tuple whose first element is url
+    :param callback_on_fetch: called with (data_in, bytes) for every downloaded element. Callbacks may
+    return an awaitable, which is awaited by the worker before taking the next element
+    :param callback_on_fail: called with (data_in, error, dead) once an element won't be requested anymore
+    during this call, where "error" is FETCH_ERROR_* class of the last failure, and "dead" tells whether
+    retry policy considers the element permanently failed
+    :param kwargs: timeout, on_fail (URL_ON_FAIL_IGNORE or URL_ON_FAIL_RETRY), async_limit, host_limits,
+    retry_policy, on_complete (coroutine function awaited after all elements are processed), conditional
+    (function returning (etag, last_modified) of an element, which are sent as If-None-Match and
+    If-Modified-Since headers. If given, "callback_on_fetch" is called with (data_in, bytes, (etag, last_modified)
+    of the response), where bytes are None if the element was not modified), body (BodyPolicy which streams
+    response bodies, rejected bodies fail with FETCH_ERROR_NON_IMAGE or FETCH_ERROR_TOO_LARGE), stop (function
+    called before every request, once it returns True no further requests are made, elements which were not
+    requested yet or wait for a retry are dropped without callbacks)
     :return: None
     """
     timeout = kwargs.get('timeout', None)
     on_fail = kwargs.get('on_fail', URL_ON_FAIL_IGNORE)
     async_limit = kwargs.get('async_limit', MAX_ASYNC_REQUESTS_DEFAULT)
+    host_limits = kwargs.get('host_limits', None) or {}
+    retry_policy = kwargs.get('retry_policy', None) or RetryPolicy()
+    on_complete = kwargs.get('on_complete', None)
+    conditional = kwargs.get('conditional', None)
+    body = kwargs.get('body', None)
+    stop = kwargs.get('stop', None)
+    sequence = itertools.count()
 
-    def limited_as_completed(coros, limit):
-        """
-        This function is a simple generator, which returns one-by-one coroutine on finish,
-        executes "limit" coroutines simultaneously.
-        """
-        futures = [asyncio.ensure_future(c) for c in coros[:limit]]
+    async def _produce(queue):
+        if hasattr(list_data, '__aiter__'):
+            async for data in list_data:
+                if stop is not None and stop():
+                    break
+                await queue.put(data)
+        else:
+            for data in list_data:
+                if stop is not None and stop():
+                    break
+                await queue.put(data)
+        # one stop marker per worker
+        for _ in range(async_limit):
+            await queue.put(None)
+
+    async def _call(callback, *args):
+        result = callback(*args)
+        if inspect.isawaitable(result):
+            await result
+
+    def _url_of(data_in):
+        return data_in if isinstance(data_in, str) else data_in[0]
 
-        async def first_to_finish():
-            done, pending = await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
-            obj = list(done)[0]
-            futures.remove(obj)
+    async def _work(session, queue, delayed, attempts, limiter):
+        finished = False
+        while True:
+            if stop is not None and stop():
+                # the queue is drained up to the stop marker, so that the producer isn't blocked
+                while not finished:
+                    finished = await queue.get() is None
+                return
+            # due retries and parked elements are taken before new ones, so that they don't starve
+            acquired = False
+            if limiter.has_dropped():
+                # elements of dead hosts are reported as failed, but never retried during this call
+                data = limiter.pop_dropped()
+                attempts.pop(_url_of(data), None)
+                if callback_on_fail:
+                    await _call(callback_on_fail, data, FETCH_ERROR_HOST_DEAD, False)
+                continue
+            if delayed and delayed[0][0] <= time.monotonic():
+                data = heapq.heappop(delayed)[2]
+            elif limiter.has_ready():
+                data = limiter.pop_ready()
+                acquired = True
+            elif not finished:
+                data = await queue.get()
+                if data is None:
+                    finished = True
+                    continue
+            elif limiter.has_parked() or delayed:
+                wait = delayed[0][0] - time.monotonic() if delayed else None
+                try:
+                    await asyncio.wait_for(limiter.wait_ready(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            else:
+                return
+
+            if not acquired and not await limiter.try_acquire(data):
+                continue  # the element has been parked
 
-            return obj.result()
+            started = time.monotonic()
+            resp = await _fetch_v2(session, data, timeout, conditional(data) if conditional else None, body)
+            status, response = resp[0], resp[1:]
+            # missing urls and rejected bodies on a responsive host don't count against the host
+            limiter.release(data,
+                            status == URL_SUCCESS or response[1] in (FETCH_ERROR_NOT_FOUND, FETCH_ERROR_CLIENT,
+                                                                     FETCH_ERROR_NON_IMAGE, FETCH_ERROR_TOO_LARGE),
+                            time.monotonic() - started)
 
-        add_index = limit
-        while len(futures) > 0:
-            result = first_to_finish()
-            if add_index < len(coros):
-                futures.append(asyncio.ensure_future(coros[add_index]))
-                add_index += 1
-            yield result
+            if status == URL_SUCCESS:
+                attempts.pop(_url_of(data), None)
+                await _call(callback_on_fetch, response)
+            if status == URL_FAILED:
+                error = response[1]
+                url = _url_of(data)
+                attempt = attempts.get(url, 0) + 1
+                delay = retry_policy.next_delay(error, attempt)
+                if delay is not None and on_fail == URL_ON_FAIL_RETRY:
+                    attempts[url] = attempt
+                    heapq.heappush(delayed, (time.monotonic() + delay, next(sequence), data))
+                else:
+                    attempts.pop(url, None)
+                    if callback_on_fail:
+                        await _call(callback_on_fail, data, error, delay is None)
 
-    async def _get(list_data, async_limit, timeout):
-        conn = aiohttp.TCPConnector(limit=1000, limit_per_host=30, family=socket.AF_INET, ssl=False)
+    async def _get():
+        queue = asyncio.Queue(maxsize=async_limit * FETCH_QUEUE_SIZE_FACTOR)
+        delayed = []  # heap of (due time, sequence number, data_in)
+        attempts = {}  # url: number of failed attempts, for elements waiting for a retry
+        limiter = HostLimiter(**host_limits)
+        # per-host limits are enforced by the limiter
+        conn = aiohttp.TCPConnector(limit=1000, limit_per_host=0, family=socket.AF_INET, ssl=False)
         async with aiohttp.ClientSession(connector=conn) as session:
-            # defining coroutines
-            coros = [_fetch_v2(session, data, timeout) for data in list_data]
-            for resp in limited_as_completed(coros, async_limit):
-                resp = await resp
-                status, response = resp[0], resp[1:]
-
-                if status == URL_SUCCESS:
-                    callback_on_fetch(response)
-                if status == URL_FAILED:
-                    callback_on_fail(response[0])
-                    if on_fail == URL_ON_FAIL_RETRY:
-                        coros.append(_fetch_v2(session, response[0], timeout))  # where response[0] is data_in
-
-    asyncio.run(_get(list_data, async_limit, timeout))
+            workers = [_work(session, queue, delayed, attempts, limiter) for _ in range(async_limit)]
+            await asyncio.gather(_produce(queue), *workers)
+            if on_complete:
+                await on_complete()
+
+    await _get()
 
 
 def get_async(urls_list, timeout=10):
@@ -0,0 +1,61 @@
+import io
+from imagenet_pkg.constants import *
+
+
+def _pil():
+    try:
+        import PIL.Image
+    except ImportError:
+        raise Exception('Verification of images requires Pillow (pip install Pillow)')
+    return PIL.Image
+
+
+class ImageVerifier:
+    """
+    Fully decodes every downloaded image with Pillow, so that truncated or corrupt files and known placeholder
+    images (by sha256 of their content) are rejected at pull time. Images with a side longer than "max_side"
+    are downscaled and re-encoded with "quality", other images are stored as downloaded.
+    Runs inside the save stage workers, the object is picklable, so a process pool may be used.
+    """
+
+    def __init__(self, max_side=None, quality=VERIFY_QUALITY_DEFAULT, placeholder_hashes=()):
+        """
+        :param max_side: maximum width and height in pixels, None keeps sizes
+        :param quality: JPEG quality of re-encoded images
+        :param placeholder_hashes: sha256 (hex) of images which are rejected
+        """
+        _pil()
+        self.max_side = max_side
+        self.quality = quality
+        self.placeholder_hashes = frozenset(placeholder_hashes)
+
+    def verify(self, img_bytes, digest):
+        """
+        :param digest: sha256 of "img_bytes", hex
+        :return: (bytes of a re-encoded image or None if the image is kept as is, (width, height)),
+        or None if the image is rejected
+        """
+        if digest in self.placeholder_hashes:
+            return None
+        image_module = _pil()
+        try:
+            with image_module.open(io.BytesIO(img_bytes)) as img:
+                # decodes every pixel, truncated data raises here
+                img.load()
+                if not self.max_side or max(img.size) <= self.max_side:
+                    return None, img.size
+                img = img.convert('RGB')
+                img.thumbnail((self.max_side, self.max_side), image_module.LANCZOS)
+                output = io.BytesIO()
+                img.save(output, format='JPEG', quality=self.quality, optimize=True)
+                return output.getvalue(), img.size
+        except (OSError, SyntaxError, ValueError, image_module.DecompressionBombError):
+            return None
+
+
+def load_placeholder_hashes(path):
+    """
+    Reads sha256 hashes of placeholder images, one per line, lines starting with # are ignored
+    """
+    with open(path, 'r') as fp:
+        return [line.split()[0].lower() for line in fp if line.strip() and not line.lstrip().startswith('#')]
@@ -0,0 +1,251 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import tempfile
+import threading
+import subprocess
+import collections
+import pytest
+from aiohttp import web
+from imagenet_pkg.constants import *
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'imagenet_pkg', 'image-net.sql')
+TEMPLATE_DB = 'imagenet_test_template'
+
+
+def jpeg_bytes(name, padding=0):
+    """
+    Bytes which are recognized as a jpeg by their magic bytes, unique per name
+    """
+    return b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01' + name.encode() + b'\x00' * padding + b'\xff\xd9'
+
+
+def real_jpeg(width, height, color=(200, 30, 30)):
+    """
+    A decodable jpeg, requires Pillow
+    """
+    import io
+    import PIL.Image
+    output = io.BytesIO()
+    PIL.Image.new('RGB', (width, height), color).save(output, format='JPEG')
+    return output.getvalue()
+
+
+class ImageServer:
+    """
+    Local http server of test images. Paths are /<kind>/<name>, where kind is one of:
+    jpeg (an image with an ETag, 304 on If-None-Match), missing (404), html (not an image),
+    flaky (503 for the first "fail" requests of the name), slow (an image after "delay" seconds),
+    big (an image of "size" bytes without Content-Length), urls (url list of a wnid, "n" jpeg urls),
+    text (a document registered in "texts"), real (a decodable <width>x<height> jpeg)
+    """
+
+    def __init__(self):
+        self.base = None
+        self.texts = {}
+        self.hits = collections.Counter()
+        self.not_modified = 0
+        self.active = 0
+        self.max_active = 0
+
+    def url(self, path, host='127.0.0.1'):
+        return self.base.replace('127.0.0.1', host) + path
+
+    def reset(self):
+        self.hits.clear()
+        self.not_modified = 0
+        self.texts.clear()
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, request):
+        kind, name = request.match_info['kind'], request.match_info['name']
+        self.hits[request.path] += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            return await self._respond(request, kind, name)
+        finally:
+            self.active -= 1
+
+    async def _respond(self, request, kind, name):
+        if kind == 'jpeg':
+            etag = f'"{name}"'
+            if request.headers.get('If-None-Match') == etag:
+                self.not_modified += 1
+                return web.Response(status=304, headers={'ETag': etag})
+            return web.Response(body=jpeg_bytes(name), content_type='image/jpeg', headers={'ETag': etag})
+        if kind == 'missing':
+            return web.Response(status=404)
+        if kind == 'html':
+            return web.Response(text='<html><body>not found</body></html>', content_type='text/html')
+        if kind == 'flaky':
+            if self.hits[request.path] <= int(request.query.get('fail', 1)):
+                return web.Response(status=503)
+            return web.Response(body=jpeg_bytes(name), content_type='image/jpeg')
+        if kind == 'slow':
+            await asyncio.sleep(float(request.query.get('delay', 0.1)))
+            return web.Response(body=jpeg_bytes(name), content_type='image/jpeg')
+        if kind == 'big':
+            response = web.StreamResponse()
+            await response.prepare(request)
+            await response.write(jpeg_bytes(name))
+            for _ in range(int(request.query.get('size', 1 << 20)) >> 16):
+                await response.write(b'\x00' * (1 << 16))
+            await response.write_eof()
+            return response
+        if kind == 'urls':
+            urls = [self.url(f'/jpeg/{name}_{i}') for i in range(int(request.query.get('n', 3)))]
+            return web.Response(text='\n'.join(urls) + '\n')
+        if kind == 'real':
+            return web.Response(body=real_jpeg(*map(int, name.split('x'))), content_type='image/jpeg')
+        if kind == 'text' and name in self.texts:
+            return web.Response(text=self.texts[name])
+        return web.Response(status=400)
+
+
+@pytest.fixture(scope='session')
+def _image_server():
+    server = ImageServer()
+    app = web.Application()
+    app.router.add_get('/{kind}/{name}', server.handle)
+    runner = web.AppRunner(app)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    server.base = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+@pytest.fixture
+def http(_image_server):
+    _image_server.reset()
+    return _image_server
+
+
+def _psql_path():
+    try:
+        import pgserver
+        path = os.path.join(os.path.dirname(pgserver.__file__), 'pginstall', 'bin', 'psql')
+        if os.path.exists(path):
+            return path
+    except ImportError:
+        pass
+    return shutil.which('psql')
+
+
+@pytest.fixture(scope='session')
+def _postgres():
+    """
+    dsn of a server with a template database loaded from image-net.sql. The server is given by
+    IMAGENET_TEST_DSN, or started by pgserver (pip install pgserver)
+    """
+    psycopg2 = pytest.importorskip('psycopg2')
+    from psycopg2.extensions import make_dsn
+    server = None
+    dsn = os.environ.get('IMAGENET_TEST_DSN')
+    if not dsn:
+        pgserver = pytest.importorskip('pgserver')
+        server = pgserver.get_server(tempfile.mkdtemp(), cleanup_mode='delete')
+        dsn = server.get_uri()
+    psql = _psql_path()
+    if psql is None:
+        pytest.skip('psql is required to load image-net.sql')
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS {TEMPLATE_DB};')
+        cursor.execute(f'CREATE DATABASE {TEMPLATE_DB};')
+    subprocess.run([psql, '-q', '-v', 'ON_ERROR_STOP=1', '-f', SCHEMA_PATH, make_dsn(dsn, dbname=TEMPLATE_DB)],
+                   check=True, stdout=subprocess.DEVNULL)
+    yield conn, dsn
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS {TEMPLATE_DB} WITH (FORCE);')
+    conn.close()
+    if server is not None:
+        server.cleanup()
+
+
+@pytest.fixture
+def dsn(_postgres):
+    """
+    dsn of a fresh database with the image-net.sql schema
+    """
+    from psycopg2.extensions import make_dsn
+    conn, server_dsn = _postgres
+    name = f'imagenet_test_{uuid.uuid4().hex[:12]}'
+    with conn.cursor() as cursor:
+        cursor.execute(f'CREATE DATABASE {name} TEMPLATE {TEMPLATE_DB};')
+    yield make_dsn(server_dsn, dbname=name)
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE {name} WITH (FORCE);')
+
+
+def seed(dsn, structure, urls=None, release=DEFAULT_RELEASE):
+    """
+    Fills classes and structure, so that nothing is requested from image-net
+    :param structure: dictionary of parent wnid: list of children wnids
+    :param urls: dictionary of wnid: list of urls
+    :return: dictionary of url: url_id
+    """
+    import psycopg2
+    wnids = list(dict.fromkeys(list(structure) + [c for children in structure.values() for c in children]))
+    ids = {}
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cursor:
+        for wnid in wnids:
+            cursor.execute("INSERT INTO classes (wnid, words) VALUES (%s, %s);", (wnid, f'{wnid} words, more'))
+        for parent, children in structure.items():
+            for child in children:
+                cursor.execute("INSERT INTO structure (release, parent_wnid, child_wnid) VALUES (%s, %s, %s);",
+                               (release, parent, child))
+        for wnid, wnid_urls in (urls or {}).items():
+            for url in wnid_urls:
+                cursor.execute("INSERT INTO urls (release, wnid, url) VALUES (%s, %s, %s) RETURNING id;",
+                               (release, wnid, url))
+                ids[url] = cursor.fetchone()[0]
+    conn.close()
+    return ids
+
+
+def query(dsn, sql, params=None):
+    import psycopg2
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall() if cursor.description else None
+    conn.close()
+    return rows
+
+
+def states(dsn):
+    """
+    :return: dictionary of url: state_id
+    """
+    return dict(query(dsn, "SELECT url.url, ust.state_id FROM urls url "
+                           "JOIN url_states ust ON ust.url_id = url.id;"))
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def open_session(dsn, directory, **kwargs):
+    """
+    ApiSession on the test database, used as a context manager, which initializes it
+    """
+    from imagenet_pkg.api import ApiSession
+    kwargs.setdefault('snapshot_dir', None)
+    return ApiSession(dsn, images_dir=str(directory), **kwargs)
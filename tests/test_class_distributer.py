@@ -0,0 +1,203 @@
+import tarfile
+import threading
+import psycopg2
+import imagenet_pkg.class_distributer as cd
+from imagenet_pkg.db import Database
+from imagenet_pkg.bulk import bulk_insert
+from imagenet_pkg.url_writer import UrlsWriter
+from imagenet_pkg.constants import *
+from conftest import seed, query
+
+STRUCTURE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<ImageNetStructure>
+<releaseData>fall2011</releaseData>
+<synset wnid="fall11" words="ImageNet 2011 Fall Release">
+  <synset wnid="n00000001" words="animal">
+    <synset wnid="n00000002" words="dog">
+      <synset wnid="n00000004" words="puppy"/>
+    </synset>
+  </synset>
+  <synset wnid="fa11misc" words="Misc">
+    <synset wnid="n00000003" words="thing">
+      <synset wnid="n00000005" words="stuff"/>
+    </synset>
+  </synset>
+</synset>
+</ImageNetStructure>
+"""
+
+WORDS = 'n00000001\tanimal, animate being\nn00000002\tdog\nn00000003\tthing\\with backslash\n' \
+        'n00000004\tpuppy\nn00000005\tstuff\n'
+
+
+def test_classes_and_structure_are_loaded_with_copy(dsn, http, tmp_path, monkeypatch):
+    (tmp_path / 'structure_released.xml').write_text(STRUCTURE_XML)
+    http.texts['words'] = WORDS
+    monkeypatch.setattr(cd, 'IMGNETAPI_ALLWORDS', http.url('/text/words'))
+
+    manager = cd.ClassDistributer(dsn, directory=str(tmp_path), release=DEFAULT_RELEASE, snapshot_dir=None)
+    manager.init_db()
+
+    assert dict(query(dsn, 'SELECT wnid, words FROM classes;')) == {
+        'n00000001': 'animal, animate being',
+        'n00000002': 'dog',
+        'n00000003': 'thing\\with backslash',
+        'n00000004': 'puppy',
+        'n00000005': 'stuff',
+    }
+    # children of the misc class are base elements
+    assert sorted(query(dsn, 'SELECT parent_wnid, child_wnid FROM structure;')) == [
+        ('n00000001', 'n00000002'), ('n00000002', 'n00000004'), ('n00000003', 'n00000005')]
+    assert query(dsn, 'SELECT COUNT(*) FROM classes WHERE hierarchy IS NULL;')[0][0] == 0
+    assert manager.short_words['n00000001'] == 'animal'
+    assert sorted(manager.get_wnids(parent='n00000001')) == ['n00000002', 'n00000004']
+
+
+def test_bulk_insert_escapes_values(dsn):
+    db = Database(dsn=dsn)
+    rows = [('n00000001', 'tab\there'), ('n00000002', 'new\nline\r\\N'), ('n00000003', None)]
+    try:
+        with db.connection() as conn, conn.cursor() as cursor:
+            assert bulk_insert(cursor, 'classes', ('wnid', 'words'), rows) == 3
+            # conflicting rows are skipped by the default ON CONFLICT clause
+            assert bulk_insert(cursor, 'classes', ('wnid', 'words'), rows[:1]) == 0
+    finally:
+        db.close()
+
+    assert sorted(query(dsn, 'SELECT wnid, words FROM classes;')) == rows
+
+
+def _manager(db_conn):
+    manager = cd.ClassDistributer(db_conn, release=DEFAULT_RELEASE, snapshot_dir=None)
+    manager.init_db()
+    return manager
+
+
+def test_get_urls_streams_from_server_side_cursor(dsn):
+    urls = {'n00000002': [f'http://a/{i}' for i in range(15)], 'n00000003': [f'http://b/{i}' for i in range(10)]}
+    seed(dsn, {'n00000001': ['n00000002', 'n00000003']}, urls)
+    manager = _manager(dsn)
+    try:
+        expected = sorted(manager.get_urls(['n00000002', 'n00000003']))
+        assert len(expected) == 25
+        # pooled connections
+        assert sorted(manager.get_urls(['n00000002', 'n00000003'], stream=True, batch_size=4)) == expected
+    finally:
+        manager.db.close()
+
+    # a shared connection, which is used by other queries between batches
+    conn = psycopg2.connect(dsn)
+    try:
+        manager = _manager(conn)
+        rows = []
+        for row in manager.get_urls(['n00000002', 'n00000003'], stream=True, batch_size=4):
+            rows.append(row)
+            assert manager._is_cached('n00000002')
+        assert sorted(rows) == expected
+    finally:
+        conn.close()
+
+
+def test_get_urls_returns_pending_urls_and_migration_adds_indexes(dsn):
+    # a database created before the indexes were added
+    query(dsn, 'DROP INDEX url_states_state_index; DROP INDEX url_states_pending_index;')
+    ids = seed(dsn, {'n00000001': ['n00000002', 'n00000003']},
+               {'n00000002': ['http://a/0', 'http://a/1', 'http://a/2'], 'n00000003': ['http://b/0', 'http://b/1']})
+    for url, state in (('http://a/0', URL_STATE_SAVED), ('http://a/1', URL_STATE_FAILED),
+                       ('http://b/0', URL_STATE_DEAD)):
+        query(dsn, 'INSERT INTO url_states (url_id, state_id) VALUES (%s, %s);', (ids[url], state))
+
+    manager = _manager(dsn)
+    try:
+        rows = manager.get_urls(['n00000002', 'n00000003'])
+    finally:
+        manager.db.close()
+
+    # urls never requested come first
+    assert [(row[2], row[3]) for row in rows] == [('http://a/2', None), ('http://b/1', None),
+                                                  ('http://a/1', URL_STATE_FAILED)]
+    assert {row[0] for row in query(dsn, "SELECT indexname FROM pg_indexes WHERE tablename = 'url_states';")} >= \
+        {'url_states_state_index', 'url_states_pending_index'}
+
+
+def test_migration_runs_ddl_only_if_something_is_missing(dsn):
+    seed(dsn, {'n00000001': ['n00000002']})
+    # a long transaction reading url_states (e.g. a streamed get_urls of a running pull)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM url_states;')
+        # an up-to-date database is not locked, so the start doesn't wait for the transaction
+        done = []
+        started = threading.Thread(target=lambda: done.append(_manager(dsn).db.close()), daemon=True)
+        started.start()
+        started.join(timeout=5)
+        assert done
+    finally:
+        conn.close()
+
+    query(dsn, 'ALTER TABLE url_states DROP COLUMN width;')
+    _manager(dsn).db.close()
+    assert query(dsn, "SELECT COUNT(*) FROM information_schema.columns "
+                      "WHERE table_name = 'url_states' AND column_name = 'width';") == [(1,)]
+
+
+def test_cache_urls_writes_new_urls_only(dsn, http, monkeypatch):
+    monkeypatch.setattr(cd, 'IMGNETAPI_URLS', http.url('/urls/{0}'))
+    seed(dsn, {'n00000001': ['n00000002', 'n00000003', 'n00000004']})
+    manager = _manager(dsn)
+    manager.urls_batch_size = 4
+    try:
+        manager.cache_urls(['n00000002', 'n00000003'])
+        assert query(dsn, 'SELECT COUNT(*), COUNT(DISTINCT url_id) FROM url_states '
+                          f'WHERE state_id = {URL_STATE_NONE};')[0] == (6, 6)
+        query(dsn, f"UPDATE url_states SET state_id = {URL_STATE_SAVED} "
+                   f"WHERE url_id = (SELECT id FROM urls WHERE url = %s);", (http.url('/jpeg/n00000002_0'),))
+
+        # cached classes aren't requested again, and states of known urls are kept
+        http.reset()
+        manager.cache_urls(['n00000002', 'n00000003', 'n00000004'])
+        assert list(http.hits) == ['/urls/n00000004']
+    finally:
+        manager.db.close()
+
+    assert sorted(query(dsn, 'SELECT url.wnid, COUNT(*), COUNT(*) FILTER (WHERE ust.state_id = %s) '
+                             'FROM urls url JOIN url_states ust ON ust.url_id = url.id GROUP BY url.wnid;',
+                        (URL_STATE_SAVED,))) == [('n00000002', 3, 1), ('n00000003', 3, 0), ('n00000004', 3, 0)]
+
+
+def test_urls_writer_skips_known_urls(dsn):
+    seed(dsn, {'n00000001': ['n00000002']})
+    db = Database(dsn=dsn)
+    try:
+        with UrlsWriter(db, DEFAULT_RELEASE, batch_size=2) as writer:
+            writer.add('n00000002', ['http://a/0', 'http://a/1', 'http://a/2'])
+            writer.add_rows([('n00000002', 'http://a/1'), ('n00000002', 'http://a/3')])
+    finally:
+        db.close()
+
+    assert (writer.received, writer.inserted) == (5, 4)
+    assert query(dsn, 'SELECT COUNT(*) FROM url_states;')[0][0] == 4
+
+
+def test_import_urls_from_dump(dsn, tmp_path):
+    seed(dsn, {'n00000001': ['n00000002', 'n00000003']})
+    lines = [f'n00000002_{i}\thttp://a/{i}\r\n' for i in range(10)] + \
+        ['n00000003_1\thttp://b/1\n', 'n09999999_1\thttp://unknown/1\n', 'malformed line\n', '\n',
+         'n00000003_2\thttp://b/2']
+    (tmp_path / 'fall11_urls.txt').write_text(''.join(lines))
+
+    manager = cd.ClassDistributer(dsn, directory=str(tmp_path), release=DEFAULT_RELEASE, snapshot_dir=None)
+    try:
+        stats = manager.import_urls(workers=2)
+        assert stats == {'chunks': 2, 'skipped': 2, 'urls': 12, 'new': 12}
+        assert query(dsn, 'SELECT COUNT(*) FROM url_states;')[0][0] == 12
+        assert sorted(query(dsn, "SELECT url FROM urls WHERE wnid = 'n00000003';")) == [('http://b/1',), ('http://b/2',)]
+
+        # the same urls packed into an archive, only urls of the given wnids
+        with tarfile.open(tmp_path / 'urls.tgz', 'w:gz') as tar:
+            tar.add(tmp_path / 'fall11_urls.txt', arcname='fall11_urls.txt')
+        stats = manager.import_urls(path=str(tmp_path / 'urls.tgz'), wnids=['n00000003'], workers=1)
+        assert (stats['urls'], stats['new'], stats['skipped']) == (2, 0, 12)
+    finally:
+        manager.db.close()
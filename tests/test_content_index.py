@@ -0,0 +1,63 @@
+import os
+import hashlib
+import pytest
+from imagenet_pkg.content_index import ContentIndex
+from imagenet_pkg.image_store import DirectoryStore, PackStore
+from imagenet_pkg.images_puller import _save_image, _sha256
+from imagenet_pkg.constants import *
+from conftest import jpeg_bytes
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _path(store, wnid, url):
+    return os.path.join(store.directory, wnid, _sha256(url)[:20] + '.jpg')
+
+
+def test_duplicates_are_linked_and_stale_entries_replaced(tmp_path):
+    store = DirectoryStore(str(tmp_path))
+    index = ContentIndex(str(tmp_path / CONTENT_INDEX_NAME))
+    image = jpeg_bytes('same', padding=100)
+
+    assert _save_image(store, 'http://a/1', 'n00000001', image, index) == (URL_STATE_SAVED, None)
+    assert _save_image(store, 'http://b/2', 'n00000002', image, index) == (URL_STATE_SAVED, None)
+    assert os.path.samefile(_path(store, 'n00000001', 'http://a/1'), _path(store, 'n00000002', 'http://b/2'))
+
+    # the original is deleted, the next duplicate is written as a copy and becomes the original
+    os.unlink(_path(store, 'n00000001', 'http://a/1'))
+    os.unlink(_path(store, 'n00000002', 'http://b/2'))
+    assert _save_image(store, 'http://c/3', 'n00000003', image, index) == (URL_STATE_SAVED, None)
+    assert index.lookup(_digest(image)) == ('n00000003', _sha256('http://c/3')[:20])
+
+    assert _save_image(store, 'http://d/4', 'n00000004', image, index) == (URL_STATE_SAVED, None)
+    assert os.path.samefile(_path(store, 'n00000003', 'http://c/3'), _path(store, 'n00000004', 'http://d/4'))
+    assert index.report() == {'unique': 1, 'duplicates': 2, 'bytes_saved': 2 * len(image)}
+    index.close()
+
+
+def test_pack_link_of_missing_image_stores_a_copy(tmp_path):
+    store = PackStore(str(tmp_path))
+    index = ContentIndex(str(tmp_path / CONTENT_INDEX_NAME))
+    image = jpeg_bytes('same')
+    # an entry left by images which are gone
+    index.add(_digest(image), 'n00000001', 'f' * 20, len(image))
+
+    with pytest.raises(FileNotFoundError):
+        store.link('n00000002', '0' * 20, 'n00000001', 'f' * 20)
+
+    assert _save_image(store, 'http://a/1', 'n00000002', image, index) == (URL_STATE_SAVED, None)
+    key = _sha256('http://a/1')[:20]
+    assert bytes(store.read('n00000002', key)) == image
+    assert index.lookup(_digest(image)) == ('n00000002', key)
+
+    # a store of another save pool process, whose index was read before the image was saved
+    other = PackStore(str(tmp_path))
+    assert other.count('n00000002') == 1
+    store.save('n00000003', '1' * 20, jpeg_bytes('other'))
+    other.link('n00000004', '2' * 20, 'n00000003', '1' * 20)
+    assert bytes(other.read('n00000004', '2' * 20)) == jpeg_bytes('other')
+    store.close()
+    other.close()
+    index.close()
@@ -0,0 +1,61 @@
+import pytest
+import threading
+import psycopg2
+import concurrent.futures
+from imagenet_pkg.db import Database, create_database
+from conftest import query
+
+
+def test_pool_waits_for_free_connections(dsn):
+    db = Database(dsn=dsn, pool_size=2)
+    lock = threading.Lock()
+    active = [0, 0]  # current, maximum
+
+    def use(_):
+        with db.connection() as conn, conn.cursor() as cursor:
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            cursor.execute('SELECT pg_sleep(0.02);')
+            with lock:
+                active[0] -= 1
+
+    try:
+        # more concurrent users than connections, none of them fails
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(use, range(16)))
+        assert active == [0, 2]
+    finally:
+        db.close()
+
+
+def test_transactions_are_rolled_back_on_error(dsn):
+    db = Database(dsn=dsn, pool_size=1)
+    try:
+        with pytest.raises(psycopg2.Error):
+            with db.connection() as conn, conn.cursor() as cursor:
+                cursor.execute("INSERT INTO classes (wnid, words) VALUES ('n00000001', 'a');")
+                cursor.execute("SELECT * FROM missing_table;")
+        # the same connection is usable, and the failed transaction left nothing behind
+        db.execute("INSERT INTO classes (wnid, words) VALUES ('n00000002', 'b');")
+    finally:
+        db.close()
+    assert query(dsn, 'SELECT wnid FROM classes;') == [('n00000002',)]
+
+
+def test_shared_connection_serializes_users(dsn):
+    conn = psycopg2.connect(dsn)
+    try:
+        db = create_database(conn)
+        assert db.shared and create_database(db) is db
+        db.execute("CREATE TABLE numbers (n integer);")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(lambda n: db.execute('INSERT INTO numbers VALUES (%s);', (n,)), range(40)))
+        assert db.execute_prepared('count_numbers', 'SELECT COUNT(*) FROM numbers WHERE n >= $1', (10,),
+                                   fetch=True) == [(30,)]
+        assert db.execute_prepared('count_numbers', 'SELECT COUNT(*) FROM numbers WHERE n >= $1', (35,),
+                                   fetch=True) == [(5,)]
+        db.close()
+        assert not conn.closed
+    finally:
+        conn.close()
@@ -0,0 +1,45 @@
+import os
+import json
+import tarfile
+from imagenet_pkg.constants import *
+from conftest import seed, open_session, jpeg_bytes
+
+
+def _members(output_dir):
+    members = {}
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith('.tar'):
+            with tarfile.open(os.path.join(output_dir, name)) as tar:
+                for member in tar:
+                    members[member.name] = tar.extractfile(member).read()
+    return members
+
+
+def test_export_writes_shards_incrementally(dsn, tmp_path):
+    seed(dsn, {'n00000001': ['n00000002', 'n00000003']})
+    output_dir = str(tmp_path / 'shards')
+    with open_session(dsn, tmp_path / 'images', storage=STORAGE_PACK) as api:
+        store = api.imagenet_puller.store
+        for i in range(6):
+            store.save('n00000002' if i % 2 else 'n00000003', f'{i:020x}', jpeg_bytes(str(i), padding=600))
+
+        stats = api.export(['n00000002', 'n00000003'], output_dir, shard_size=8192, workers=1, seed=1)
+        assert stats == {'exported': 6, 'shards': 3}
+        members = _members(output_dir)
+        assert len(members) == 18
+        assert members[f'n00000002_{1:020x}.jpg'] == jpeg_bytes('1', padding=600)
+        assert members[f'n00000002_{1:020x}.cls'] == b'0'
+        assert json.loads(members[f'n00000003_{2:020x}.json']) == {
+            'wnid': 'n00000003', 'label': 1, 'name': 'n00000003 words', 'path': 'n00000001/n00000003'}
+
+        # a next run exports only new images, labels of exported classes are kept
+        store.save('n00000001', f'{6:020x}', jpeg_bytes('6'))
+        stats = api.export(['n00000001', 'n00000002', 'n00000003'], output_dir, workers=2)
+        assert stats == {'exported': 1, 'shards': 1}
+        assert _members(output_dir)[f'n00000001_{6:020x}.cls'] == b'2'
+
+    with open(os.path.join(output_dir, EXPORT_MANIFEST_NAME)) as fp:
+        manifest = json.load(fp)
+    assert manifest['classes'] == {'n00000002': 0, 'n00000003': 1, 'n00000001': 2}
+    assert manifest['samples'] == 7 and len(manifest['shards']) == 4
+    assert not [name for name in os.listdir(output_dir) if name.endswith('.tmp')]
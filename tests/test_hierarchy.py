@@ -0,0 +1,71 @@
+import random
+import collections
+from imagenet_pkg.hierarchy import HierarchyIndex
+
+
+def _index(edges, wnids=None):
+    parent_children = collections.defaultdict(list)
+    for parent, child in edges:
+        parent_children[parent].append(child)
+    # the first parent of a synset is the one its path is built from
+    child_parent = {}
+    for parent, child in edges:
+        child_parent.setdefault(child, parent)
+    wnids = wnids or list(dict.fromkeys([w for edge in edges for w in edge]))
+    return HierarchyIndex(wnids, child_parent, dict(parent_children)), dict(parent_children)
+
+
+def _walk(parent_children, wnid, deep=None):
+    # shortest distances from wnid along parent_children
+    levels = {wnid: 0}
+    queue = collections.deque([wnid])
+    while queue:
+        node = queue.popleft()
+        if deep and levels[node] >= deep:
+            continue
+        for child in parent_children.get(node, ()):
+            if child not in levels:
+                levels[child] = levels[node] + 1
+                queue.append(child)
+    del levels[wnid]
+    return set(levels)
+
+
+def test_descendants_ancestors_and_paths():
+    # "e" has two parents, "b" (its path) and "c"
+    index, _ = _index([('a', 'b'), ('a', 'c'), ('b', 'd'), ('b', 'e'), ('c', 'e'), ('e', 'f'), ('c', 'g')])
+
+    assert index.get_descendants('a') == ['b', 'd', 'e', 'f', 'c', 'g']
+    assert sorted(index.get_descendants('c')) == ['e', 'f', 'g']
+    assert sorted(index.get_descendants('c', deep=1)) == ['e', 'g']
+    assert index.get_descendants('unknown') == []
+    assert index.get_ancestors('f') == ['e', 'b', 'a']
+    assert index.is_descendant('f', 'b') and not index.is_descendant('f', 'c') and not index.is_descendant('b', 'b')
+    assert index.get_paths()['f'] == 'a/b/e/f'
+    assert index.get_levels()['f'] == 4
+    assert index.get_depth('a') == 0 and index.get_parent('a') is None
+
+
+def test_descendants_match_walk_of_random_dag():
+    rnd = random.Random(7)
+    nodes = [f'n{i:08d}' for i in range(300)]
+    edges = []
+    for i in range(1, len(nodes)):
+        for parent in rnd.sample(nodes[:i], k=1 if rnd.random() < 0.9 else 2):
+            edges.append((parent, nodes[i]))
+    index, parent_children = _index(edges, nodes)
+
+    for wnid in rnd.sample(nodes, 40):
+        for deep in (None, 1, 3):
+            result = index.get_descendants(wnid, deep)
+            assert len(result) == len(set(result))
+            assert set(result) == _walk(parent_children, wnid, deep)
+
+
+
+def test_subtree_totals():
+    index, _ = _index([('a', 'b'), ('a', 'c'), ('b', 'd'), ('c', 'd')])
+    totals = index.subtree_totals({'a': (1, 0), 'b': (2, 1), 'd': (4, 2)})
+
+    # "d" is counted under its path's parent "b" only
+    assert totals == {'a': (7, 3), 'b': (6, 3), 'c': (0, 0), 'd': (4, 2)}
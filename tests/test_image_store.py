@@ -0,0 +1,126 @@
+import os
+import pickle
+import concurrent.futures
+from imagenet_pkg.image_store import PackStore, DirectoryStore, create_store
+from imagenet_pkg.constants import *
+from conftest import jpeg_bytes, seed, open_session
+
+
+def _key(i):
+    return f'{i:020x}'
+
+
+def test_pack_store_saves_reads_and_rotates_shards(tmp_path):
+    store = create_store(STORAGE_PACK, str(tmp_path), max_shard_size=64)
+    try:
+        for i in range(10):
+            store.save('n00000001', _key(i), jpeg_bytes(str(i)))
+        store.save('n00000002', _key(10), jpeg_bytes('10'))
+
+        assert store.count('n00000001') == 10
+        assert store.count('n00000003') is None
+        assert bytes(store.read('n00000001', _key(3))) == jpeg_bytes('3')
+        assert store.exists('n00000002', _key(10)) and not store.exists('n00000002', _key(3))
+        assert sorted(bytes(data) for data in store.data_iter('n00000001')) == \
+            sorted(jpeg_bytes(str(i)) for i in range(10))
+        assert len([name for name in os.listdir(store.packs_dir) if name.endswith('.pack')]) > 1
+    finally:
+        store.close()
+
+    # a new store (e.g. in a save pool process) reads the same images from the index files
+    reopened = pickle.loads(pickle.dumps(store))
+    assert sorted(reopened.keys_iter('n00000001')) == [_key(i) for i in range(10)]
+    assert bytes(reopened.read('n00000002', _key(10))) == jpeg_bytes('10')
+    reopened.clean()
+    assert not os.path.exists(store.packs_dir)
+
+
+def test_pack_store_index_is_updated_in_place(tmp_path, monkeypatch):
+    store = PackStore(str(tmp_path))
+    store.save('n00000001', _key(0), jpeg_bytes('0'))
+    assert store.exists('n00000001', _key(0))
+
+    reads = []
+    read_new = PackStore._read_new
+    monkeypatch.setattr(PackStore, '_read_new', lambda self, *args: reads.append(args) or read_new(self, *args))
+
+    def save(i):
+        store.save(f'n0000000{i % 3}', _key(i), jpeg_bytes(str(i)))
+        return store.exists(f'n0000000{i % 3}', _key(i))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        assert all(pool.map(save, range(1, 301)))
+    store.link('n00000009', _key(1000), 'n00000001', _key(1))
+
+    assert reads == []
+    assert sum(store.count(f'n0000000{i}') for i in range(3)) == 301
+    assert bytes(store.read('n00000009', _key(1000))) == jpeg_bytes('1')
+    store.close()
+
+    # a closed store reads index and refs files again
+    assert store.scan('n00000009') == [_key(1000)]
+    assert reads
+
+    # refresh() sees images saved by other stores, scan() only looks them up
+    other = PackStore(str(tmp_path))
+    other.save('n00000008', _key(2000), jpeg_bytes('2000'))
+    other.close()
+    assert store.scan('n00000008') == []
+    store.refresh()
+    assert store.scan('n00000008') == [_key(2000)]
+
+
+def test_directory_store_saves_files(tmp_path):
+    store = DirectoryStore(str(tmp_path))
+    store.save('n00000001', _key(0), jpeg_bytes('0'))
+    store.link('n00000002', _key(1), 'n00000001', _key(0))
+
+    assert store.read('n00000002', _key(1)) == jpeg_bytes('0')
+    assert os.path.samefile(os.path.join(str(tmp_path), 'n00000001', _key(0) + '.jpg'),
+                            os.path.join(str(tmp_path), 'n00000002', _key(1) + '.jpg'))
+    assert store.exists('n00000001', _key(0)) and not store.exists('n00000001', _key(1))
+
+    # new content of a stored key, which duplicates another image, replaces the old file
+    store.save('n00000003', _key(2), jpeg_bytes('2'))
+    store.save('n00000003', _key(3), jpeg_bytes('3'))
+    store.link('n00000003', _key(2), 'n00000003', _key(3), digest='b' * 64)
+    assert store.read('n00000003', _key(2)) == jpeg_bytes('3')
+    assert dict((key, digest) for key, _, digest, _, _ in store.entries('n00000003'))[_key(2)] == 'b' * 64
+    assert sorted(os.listdir(os.path.join(str(tmp_path), 'n00000003'))) == [MANIFEST_NAME, _key(2) + '.jpg',
+                                                                            _key(3) + '.jpg']
+
+
+def test_directory_store_manifest_lists_images(tmp_path):
+    store = DirectoryStore(str(tmp_path))
+    assert store.entries('n00000001') is None and store.count('n00000001') is None
+    store.save('n00000001', _key(0), jpeg_bytes('0'), digest='a' * 64, dims=(40, 30))
+    store.save('n00000001', _key(1), jpeg_bytes('1'))
+    store.link('n00000001', _key(2), 'n00000001', _key(0), digest='a' * 64, dims=(40, 30))
+    assert sorted(store.entries('n00000001')) == [(_key(0), len(jpeg_bytes('0')), 'a' * 64, 40, 30),
+                                                  (_key(1), len(jpeg_bytes('1')), None, None, None),
+                                                  (_key(2), len(jpeg_bytes('0')), 'a' * 64, 40, 30)]
+
+    # files changed by hand are listed by scan(), known sha256 and dimensions are kept
+    directory = os.path.join(str(tmp_path), 'n00000001')
+    os.unlink(os.path.join(directory, _key(1) + '.jpg'))
+    with open(os.path.join(directory, _key(3) + '.jpg'), 'wb') as fp:
+        fp.write(jpeg_bytes('3'))
+    assert store.count('n00000001') == 3
+    assert sorted(store.scan('n00000001')) == [_key(0), _key(2), _key(3)]
+    assert sorted(store.entries('n00000001'))[0] == (_key(0), len(jpeg_bytes('0')), 'a' * 64, 40, 30)
+
+    # a lost manifest is rebuilt from the class directory
+    os.unlink(os.path.join(directory, MANIFEST_NAME))
+    assert sorted(store.keys_iter('n00000001')) == [_key(0), _key(2), _key(3)]
+    assert os.path.getsize(os.path.join(directory, MANIFEST_NAME))
+
+
+def test_count_images_of_subtree(dsn, http, tmp_path):
+    urls = {'n00000002': [http.url(f'/jpeg/c{i}') for i in range(3)], 'n00000003': [http.url('/jpeg/c3')]}
+    seed(dsn, {'n00000001': ['n00000002'], 'n00000002': ['n00000003']}, urls)
+    with open_session(dsn, tmp_path) as api:
+        api.fetch(api.get_urls(['n00000002', 'n00000003']))
+        assert api.count_images('n00000001') is None
+        assert api.count_images('n00000002') == 3
+        assert api.count_images('n00000001', recursive=True, workers=2) == 4
+        assert api.count_images('n00000001', recursive=True, deep=1) == 3
@@ -0,0 +1,211 @@
+import os
+import time
+import asyncio
+import threading
+from imagenet_pkg.images_puller import _SaveStage, _sha256
+from imagenet_pkg.image_store import DirectoryStore, PackStore
+from imagenet_pkg.content_index import ContentIndex
+from imagenet_pkg.constants import *
+from conftest import jpeg_bytes, seed, query, states, open_session
+
+
+class _FailingStore(DirectoryStore):
+    def save(self, wnid, key, img_bytes, digest=None, dims=None):
+        if wnid == 'n00000002':
+            raise OSError('No space left on device')
+        super().save(wnid, key, img_bytes, digest=digest, dims=dims)
+
+
+def test_save_stage_records_failed_saves(tmp_path):
+    store = _FailingStore(str(tmp_path))
+    saved = {}
+
+    def on_saved(url, url_id, wnid, state, validators, size):
+        saved[url_id] = state
+
+    async def run():
+        stage = _SaveStage(store, None, None, SAVE_EXECUTOR_THREAD, 2, 2, on_saved)
+        try:
+            await stage.submit('http://a/1', 1, 'n00000001', jpeg_bytes('1'))
+            await stage.submit('http://a/2', 2, 'n00000002', jpeg_bytes('2'))
+            await stage.submit('http://a/3', 3, 'n00000001', b'<html></html>')
+            await stage.submit('http://a/4', 4, 'n00000001', jpeg_bytes('4'))
+            await stage.join()
+        finally:
+            stage.close()
+
+    asyncio.run(run())
+
+    assert saved == {1: URL_STATE_SAVED, 2: URL_STATE_FAILED, 3: URL_STATE_NON_IMAGE, 4: URL_STATE_SAVED}
+    assert store.read('n00000001', _sha256('http://a/4')[:20]) == jpeg_bytes('4')
+
+
+class _CountingIndex(ContentIndex):
+    def _connection(self):
+        if getattr(self._local, 'conn', None) is None:
+            with open(self.path + '.opened', 'a') as fp:
+                fp.write(f'{os.getpid()}\n')
+        return super()._connection()
+
+
+def test_save_processes_set_up_store_and_index_once(tmp_path):
+    store = PackStore(str(tmp_path))
+    index = _CountingIndex(str(tmp_path / CONTENT_INDEX_NAME))
+    saved = {}
+
+    async def run():
+        stage = _SaveStage(store, index, None, SAVE_EXECUTOR_PROCESS, 2, 4,
+                           lambda url, url_id, wnid, state, validators, size: saved.update({url_id: state}))
+        try:
+            for i in range(20):
+                await stage.submit(f'http://a/{i}', i, 'n00000001', jpeg_bytes(str(i % 10)))
+            await stage.join()
+        finally:
+            stage.close()
+
+    asyncio.run(run())
+
+    assert saved == {i: URL_STATE_SAVED for i in range(20)}
+    assert index.report()['duplicates'] == 10
+    assert store.count('n00000001') == 20
+    # one connection per pool process, not one per image
+    with open(index.path + '.opened') as fp:
+        opened = [pid for pid in fp.read().split() if pid != str(os.getpid())]
+    assert 1 <= len(opened) == len(set(opened)) <= 2
+    store.close()
+
+
+def test_pull_is_resumable_and_conditional(dsn, http, tmp_path):
+    urls = [http.url(f'/jpeg/r{i}') for i in range(5)] + [http.url('/html/r5')]
+    seed(dsn, {'n00000000': ['n00000001']}, {'n00000001': urls})
+    with open_session(dsn, tmp_path) as api:
+        api.fetch(api.get_urls('n00000001'))
+        assert states(dsn) == {**{url: URL_STATE_SAVED for url in urls[:5]}, urls[5]: URL_STATE_NON_IMAGE}
+        assert query(dsn, "SELECT etag FROM url_states WHERE etag IS NOT NULL ORDER BY etag;") == \
+            [(f'"r{i}"',) for i in range(5)]
+        assert api.count_images('n00000001') == 5
+
+        # saved images are requested with their validators, unchanged ones aren't downloaded
+        http.reset()
+        api.revalidate(['n00000001'])
+        assert http.not_modified == 5
+
+        # states lost by an interrupted run: stored images are not requested again
+        query(dsn, f"UPDATE url_states SET state_id = {URL_STATE_NONE};")
+        http.reset()
+        api.fetch(api.get_urls('n00000001'), skip_existing=True)
+        assert list(http.hits) == ['/html/r5']
+        assert states(dsn)[urls[0]] == URL_STATE_SAVED
+
+        # images removed by hand are requested again by the next pull
+        os.unlink(os.path.join(str(tmp_path), 'n00000001', _sha256(urls[0])[:20] + '.jpg'))
+        assert api.reconcile(['n00000001']) == {'saved': 0, 'reset': 1}
+        assert [row[2] for row in api.get_urls('n00000001')] == [urls[0]]
+
+
+def test_reconcile_pack_store_with_many_threads(dsn, http, tmp_path, monkeypatch):
+    wnids = [f'n000001{i:02d}' for i in range(24)]
+    urls = {wnid: [http.url(f'/jpeg/{wnid}_{j}') for j in range(2)] for wnid in wnids}
+    seed(dsn, {'n00000000': wnids}, urls)
+    with open_session(dsn, tmp_path, storage=STORAGE_PACK) as api:
+        api.fetch(api.get_urls(wnids))
+        # images saved by another process, and states lost by an interrupted run
+        other = PackStore(str(tmp_path))
+        other.save(wnids[0], _sha256(urls[wnids[0]][0])[:20], jpeg_bytes('other'))
+        other.close()
+        query(dsn, f"UPDATE url_states SET state_id = {URL_STATE_NONE};")
+
+        reads = []
+        read_new = PackStore._read_new
+        monkeypatch.setattr(PackStore, '_read_new', lambda self, *args: reads.append(args[0]) or read_new(self, *args))
+        assert api.reconcile(wnids, workers=8) == {'saved': 48, 'reset': 0}
+
+    # index files are read once, not once per class
+    assert len(reads) == len(set(reads))
+    assert set(states(dsn).values()) == {URL_STATE_SAVED}
+
+
+def test_work_requests_urls_once_and_releases_failed_leases(dsn, http, tmp_path):
+    urls = [http.url(f'/jpeg/w{i}') for i in range(4)] + [http.url('/flaky/w4?fail=1'), http.url('/missing/w5')]
+    ids = seed(dsn, {'n00000000': ['n00000001']}, {'n00000001': urls})
+    # a lease of another worker, which expires soon
+    query(dsn, "INSERT INTO url_states (url_id, state_id, lease_until, lease_owner) "
+               "VALUES (%s, %s, now() + interval '1 second', 'other');", (ids[urls[3]], URL_STATE_NONE))
+
+    with open_session(dsn, tmp_path) as api:
+        api.work(['n00000001'], batch_size=2, owner='worker')
+        assert states(dsn) == {**{url: URL_STATE_SAVED for url in urls[:4]},
+                               urls[4]: URL_STATE_FAILED, urls[5]: URL_STATE_DEAD}
+        # the failed url was requested once, and its lease is released for other workers, but keeps its owner
+        assert http.hits['/flaky/w4'] == 1
+        assert query(dsn, 'SELECT lease_until, lease_owner FROM url_states WHERE url_id = %s;',
+                     (ids[urls[4]],)) == [(None, 'worker')]
+
+        api.work(['n00000001'], owner='worker')
+        assert states(dsn)[urls[4]] == URL_STATE_SAVED
+
+
+def test_work_renews_leases_of_urls_in_flight(dsn, http, tmp_path):
+    urls = [http.url(f'/slow/l{i}?delay=1.5') for i in range(3)]
+    seed(dsn, {'n00000000': ['n00000001']}, {'n00000001': urls})
+
+    def work(owner):
+        with open_session(dsn, tmp_path / owner) as api:
+            api.work(['n00000001'], lease_timeout=0.6, owner=owner)
+
+    # downloads take longer than the lease timeout, the second worker doesn't take them over
+    first = threading.Thread(target=work, args=('first',))
+    first.start()
+    time.sleep(0.3)
+    work('second')
+    first.join()
+
+    assert states(dsn) == {url: URL_STATE_SAVED for url in urls}
+    assert [http.hits[f'/slow/l{i}'] for i in range(3)] == [1, 1, 1]
+
+
+def test_fetch_async_runs_in_callers_loop(dsn, http, tmp_path):
+    urls = [http.url(f'/slow/a{i}?delay=0.05') for i in range(10)]
+    seed(dsn, {'n00000000': ['n00000001']}, {'n00000001': urls})
+    with open_session(dsn, tmp_path, max_async_requests=5) as api:
+        async def run():
+            ticks = []
+
+            async def ticker():
+                while True:
+                    ticks.append(asyncio.get_running_loop().time())
+                    await asyncio.sleep(0.01)
+
+            task = asyncio.ensure_future(ticker())
+            # rows of a server-side cursor are read by threads
+            await api.fetch_async(api.get_urls('n00000001', stream=True, batch_size=3))
+            task.cancel()
+            return ticks
+
+        ticks = asyncio.run(run())
+
+    assert states(dsn) == {url: URL_STATE_SAVED for url in urls}
+    # the loop kept running other tasks while urls were read, fetched and saved
+    assert len(ticks) >= 5
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.5
+
+
+def test_fetch_async_stops_at_targets_and_url_stats(dsn, http, tmp_path):
+    urls = {'n00000001': [http.url(f'/jpeg/t{i}') for i in range(20)],
+            'n00000002': [http.url('/jpeg/t20'), http.url('/missing/t21')]}
+    seed(dsn, {'n00000000': ['n00000001'], 'n00000001': ['n00000002']}, urls)
+    with open_session(dsn, tmp_path, max_async_requests=1) as api:
+        targets = api.fetch_targets(['n00000001', 'n00000002', 'n00000003'], 0.25)
+        assert targets == {'n00000001': 5, 'n00000002': 1, 'n00000003': 0}
+
+        # urls queued before the target was reached may still be saved
+        asyncio.run(api.fetch_async(api.get_urls(['n00000001', 'n00000002']), targets=targets))
+        assert 5 <= api.count_images('n00000001') < 10
+        assert api.fetch_targets(['n00000001', 'n00000002'], 0.25) == {'n00000001': 0, 'n00000002': 0}
+
+        asyncio.run(api.fetch_async(api.get_urls(['n00000001', 'n00000002'])))
+        assert api.imagenet_puller.url_counts() == {'n00000001': (20, 20, 0, 0, 0), 'n00000002': (2, 1, 0, 0, 1)}
+        stats = {row.pop('wnid'): row for row in api.url_stats(['n00000000'], recursive=True)}
+
+    assert stats['n00000000'] == {'level': 1, 'urls': 22, 'saved': 21, 'failed': 0, 'non_image': 0, 'dead': 1}
+    assert stats['n00000002'] == {'level': 3, 'urls': 2, 'saved': 1, 'failed': 0, 'non_image': 0, 'dead': 1}
@@ -0,0 +1,65 @@
+import os
+import pytest
+from imagenet_pkg.planner import PullPlanner
+from imagenet_pkg.constants import *
+from conftest import seed, query, open_session
+
+# r: A (a1, a2, a3, a4), B (b1), C (c1 (c1x, c1y))
+TREE = {'r': ['A', 'B', 'C'], 'A': ['a1', 'a2', 'a3', 'a4'], 'B': ['b1'], 'C': ['c1'], 'c1': ['c1x', 'c1y']}
+
+
+def _classes():
+    paths = {'r': 'r'}
+    for parent, children in TREE.items():
+        for child in children:
+            paths[child] = paths[parent] + os.sep + child
+    # candidates come in any order
+    return [(wnid, wnid, wnid, path) for wnid, path in sorted(paths.items(), key=lambda item: item[0].lower())]
+
+
+def _select(strategy, max_classes=None, seed=None):
+    return PullPlanner(max_classes=max_classes, strategy=strategy, seed=seed).select_classes(_classes())
+
+
+def test_select_classes_strategies():
+    assert _select(PLAN_STRATEGY_LEAVES) == ['a1', 'a2', 'a3', 'a4', 'b1', 'c1x', 'c1y']
+    assert _select(PLAN_STRATEGY_LEAVES, 3) == ['a2', 'a4', 'c1x']
+    assert _select(PLAN_STRATEGY_DEPTH, 3) == ['r', 'A', 'C']
+    # every subtree below the root gets an equal share, small subtrees leave the rest to others
+    assert _select(PLAN_STRATEGY_STRATIFIED, 3) == ['a3', 'b1', 'c1y']
+    assert _select(PLAN_STRATEGY_STRATIFIED, 6) == ['a1', 'a3', 'a4', 'b1', 'c1x', 'c1y']
+
+    assert _select(PLAN_STRATEGY_LEAVES, 3, seed=1) == _select(PLAN_STRATEGY_LEAVES, 3, seed=1)
+    with pytest.raises(Exception):
+        PullPlanner(strategy='random')
+
+
+def test_select_urls_prefers_reliable_hosts():
+    rows = [(1, 'w1', 'http://good/1', URL_STATE_SAVED), (2, 'w1', 'http://bad/1', URL_STATE_DEAD),
+            (3, 'w1', 'http://bad/2', None), (4, 'w1', 'http://good/2', None),
+            (5, 'w1', 'http://bad/3', URL_STATE_FAILED), (6, 'w1', 'http://good/3', URL_STATE_NONE),
+            (7, 'w1', 'http://bad/4', None)]
+    urls, targets = PullPlanner(per_class=2).select_urls(['w1', 'w2'], rows)
+
+    assert targets == {'w1': 1, 'w2': 2}
+    # one more image is planned with three urls, as about half of the requests fail
+    assert [row[0] for row in urls] == [4, 6, 3]
+    assert urls[0] == (4, 'w1', 'http://good/2', None)
+
+
+def test_plan_urls_and_fetch(dsn, http, tmp_path):
+    urls = [http.url(f'/jpeg/p{i}') for i in range(6)] + [http.url(f'/jpeg/q{i}', host='localhost') for i in range(6)]
+    ids = seed(dsn, {'n00000000': ['n00000001']}, {'n00000001': urls})
+    for url, state in ((urls[0], URL_STATE_SAVED), (urls[6], URL_STATE_DEAD), (urls[7], URL_STATE_DEAD)):
+        query(dsn, 'INSERT INTO url_states (url_id, state_id) VALUES (%s, %s);', (ids[url], state))
+
+    with open_session(dsn, tmp_path) as api:
+        planned, targets = api.plan_urls(['n00000001'], 3)
+        assert targets == {'n00000001': 2}
+        assert 2 <= len(planned) < 10
+        # urls of the host with failures come last
+        assert [row[2] for row in planned[:5]] == urls[1:6]
+
+        api.fetch(planned, targets=targets)
+        assert api.count_images('n00000001') >= 2
+        assert http.hits['/jpeg/q2'] == 0
@@ -0,0 +1,40 @@
+import pytest
+from conftest import seed, open_session
+
+pytest.importorskip('PIL')
+pytest.importorskip('numpy')
+
+
+def test_reader_splits_shuffles_and_decodes(dsn, http, tmp_path):
+    urls = {'n00000001': [http.url(f'/real/{16 + i}x8') for i in range(3)],
+            'n00000002': [http.url(f'/real/8x{16 + i}') for i in range(2)]}
+    seed(dsn, {'n00000000': ['n00000001', 'n00000002']}, urls)
+    with open_session(dsn, tmp_path) as api:
+        api.fetch(api.get_urls(['n00000001', 'n00000002']))
+
+        # ranks read disjoint parts of the same shuffled order, padded so that every rank reads as much
+        ranks = [api.reader(['n00000002', 'n00000001'], seed=7, rank=rank, world_size=2, workers=2, prefetch=1)
+                 for rank in range(2)]
+        parts = [list(reader) for reader in ranks]
+        assert [len(reader) for reader in ranks] == [len(part) for part in parts] == [3, 3]
+        samples = ranks[0].samples() + ranks[1].samples()
+        assert len(set(samples)) == 5
+        assert {(wnid, label) for part in parts for _, label, wnid in part} == {('n00000001', 0), ('n00000002', 1)}
+        assert all(bytes(data[:2]) == b'\xff\xd8' for part in parts for data, _, _ in part)
+
+        # the order depends on the seed and the epoch only
+        reader = api.reader(['n00000001', 'n00000002'], seed=7)
+        first = reader.samples()
+        assert api.reader(['n00000001', 'n00000002'], seed=7).samples() == first
+        reader.set_epoch(1)
+        assert sorted(reader.samples()) == sorted(first)
+
+        # decoded batches of descendants of a class
+        reader = api.reader(['n00000000'], recursive=True, decode=True, image_size=(8, 4), batch_size=2)
+        batches = list(reader)
+        assert len(reader) == len(batches) == 3
+        assert [images.shape for images, _, _ in batches] == [(2, 4, 8, 3), (2, 4, 8, 3), (1, 4, 8, 3)]
+        assert sorted(label for _, labels, _ in batches for label in labels.tolist()) == [1, 1, 1, 2, 2]
+
+        with pytest.raises(Exception):
+            api.reader(['n00000001'], decode=True, batch_size=2)
@@ -0,0 +1,45 @@
+import os
+import imagenet_pkg.class_distributer as cd
+from imagenet_pkg.snapshot import load_snapshot, save_snapshot, snapshot_path
+from imagenet_pkg.constants import *
+from conftest import seed, query
+
+
+def test_snapshot_roundtrip_and_invalidation(tmp_path):
+    directory = str(tmp_path)
+    assert load_snapshot(directory, 'fall2011', (1, 2)) is None
+
+    save_snapshot(directory, 'fall2011', (1, 2), {'wnids': ['n00000001']})
+    assert load_snapshot(directory, 'fall2011', (1, 2)) == {'wnids': ['n00000001']}
+    assert load_snapshot(directory, 'fall2011', (1, 3)) is None
+    assert load_snapshot(directory, 'spring2010', (1, 2)) is None
+    assert [name for name in os.listdir(directory) if name.endswith('.tmp')] == []
+
+    with open(snapshot_path(directory, 'fall2011'), 'wb') as fp:
+        fp.write(b'truncated')
+    assert load_snapshot(directory, 'fall2011', (1, 2)) is None
+
+
+def test_class_distributer_uses_snapshot_until_tables_change(dsn, tmp_path, monkeypatch):
+    seed(dsn, {'n00000001': ['n00000002', 'n00000003']})
+    snapshot_dir = str(tmp_path)
+
+    first = cd.ClassDistributer(dsn, release=DEFAULT_RELEASE, snapshot_dir=snapshot_dir)
+    first.init_db()
+    assert os.path.isfile(snapshot_path(snapshot_dir, DEFAULT_RELEASE))
+
+    def no_tables(self, datatype):
+        raise AssertionError(f'{datatype} read from database')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(cd.ClassDistributer, '_get_data', no_tables)
+        second = cd.ClassDistributer(dsn, release=DEFAULT_RELEASE, snapshot_dir=snapshot_dir)
+        second.init_db()
+    assert second.paths == first.paths
+    assert sorted(second.get_wnids(parent='n00000001')) == ['n00000002', 'n00000003']
+
+    query(dsn, "INSERT INTO classes (wnid, words) VALUES ('n00000004', 'new');"
+               "INSERT INTO structure VALUES (%s, 'n00000003', 'n00000004');", (DEFAULT_RELEASE,))
+    third = cd.ClassDistributer(dsn, release=DEFAULT_RELEASE, snapshot_dir=snapshot_dir)
+    third.init_db()
+    assert third.paths['n00000004'] == os.path.join('n00000001', 'n00000003', 'n00000004')
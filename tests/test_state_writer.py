@@ -0,0 +1,44 @@
+from imagenet_pkg.db import Database
+from imagenet_pkg.state_writer import UrlStatesWriter
+from imagenet_pkg.constants import *
+from conftest import seed, query, wait_for
+
+
+def test_states_are_flushed_in_batches(dsn):
+    ids = seed(dsn, {'n00000001': []}, {'n00000001': [f'http://a/{i}' for i in range(5)]})
+    db = Database(dsn=dsn)
+    writer = UrlStatesWriter(db, batch_size=3, flush_interval=0)
+    try:
+        writer.add([(ids['http://a/0'], URL_STATE_FAILED, '"e0"', 'Mon, 01 Jan 2024 00:00:00 GMT')])
+        writer.add([(ids['http://a/1'], URL_STATE_FAILED)])
+        assert query(dsn, 'SELECT COUNT(*) FROM url_states;')[0][0] == 0
+
+        # only the latest state of a url is kept, the batch is full with the third url
+        writer.add([(ids['http://a/1'], URL_STATE_SAVED, None, None, 640, 480),
+                    (ids['http://a/2'], URL_STATE_NON_IMAGE)])
+        assert writer.flushed == 3
+
+        # empty validators don't overwrite stored ones
+        writer.add([(ids['http://a/0'], URL_STATE_SAVED)])
+        writer.close()
+    finally:
+        db.close()
+
+    rows = {row[0]: row[1:] for row in query(dsn, 'SELECT url_id, state_id, etag, last_modified, width, height '
+                                                  'FROM url_states;')}
+    assert rows == {
+        ids['http://a/0']: (URL_STATE_SAVED, '"e0"', 'Mon, 01 Jan 2024 00:00:00 GMT', None, None),
+        ids['http://a/1']: (URL_STATE_SAVED, None, None, 640, 480),
+        ids['http://a/2']: (URL_STATE_NON_IMAGE, None, None, None, None),
+    }
+
+
+def test_states_are_flushed_periodically(dsn):
+    ids = seed(dsn, {'n00000001': []}, {'n00000001': ['http://a/0']})
+    db = Database(dsn=dsn)
+    try:
+        with UrlStatesWriter(db, batch_size=1000, flush_interval=0.05) as writer:
+            writer.add([(ids['http://a/0'], URL_STATE_SAVED)])
+            assert wait_for(lambda: query(dsn, 'SELECT state_id FROM url_states;') == [(URL_STATE_SAVED,)])
+    finally:
+        db.close()
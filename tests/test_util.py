@@ -0,0 +1,154 @@
+import os
+import asyncio
+import hashlib
+import threading
+import imagenet_pkg.util as util
+from imagenet_pkg.constants import *
+from conftest import jpeg_bytes
+
+
+def test_fetch_with_callback_bounded(http):
+    async_limit = 4
+    consumed = []
+    in_flight_at_first = []
+
+    def urls():
+        for i in range(40):
+            consumed.append(i)
+            yield http.url(f'/slow/{i}?delay=0.02')
+
+    fetched = {}
+
+    def on_fetch(response):
+        url, data = response
+        if not in_flight_at_first:
+            in_flight_at_first.append(len(consumed))
+        fetched[url] = data
+
+    util.fetch_with_callback(urls(), on_fetch, async_limit=async_limit)
+
+    assert len(fetched) == 40
+    assert fetched[http.url('/slow/7?delay=0.02')] == jpeg_bytes('7')
+    assert http.max_active <= async_limit
+    # the generator is consumed lazily, at most a queue and a worker pool ahead of the first response
+    assert in_flight_at_first[0] <= async_limit * (FETCH_QUEUE_SIZE_FACTOR + 1) + 1
+
+
+def test_fetch_with_callback_async_iterable_and_failures(http):
+    async def urls():
+        for name in ('a', 'b'):
+            yield http.url(f'/jpeg/{name}')
+        yield (http.url('/missing/c'), 'payload')
+
+    fetched, failed = [], []
+
+    async def on_fetch(response):
+        await asyncio.sleep(0)
+        fetched.append(response[0])
+
+    util.fetch_with_callback(urls(), on_fetch, lambda data, error, dead: failed.append((data, error, dead)),
+                             async_limit=2)
+
+    assert sorted(fetched) == [http.url('/jpeg/a'), http.url('/jpeg/b')]
+    assert failed == [((http.url('/missing/c'), 'payload'), FETCH_ERROR_NOT_FOUND, True)]
+
+
+def test_host_limiter_caps_concurrency_per_host(http):
+    urls = [http.url(f'/slow/{i}?delay=0.05') for i in range(12)]
+    fetched = []
+    util.fetch_with_callback(urls, fetched.append, async_limit=10,
+                             host_limits={'initial_concurrency': 2, 'max_concurrency': 2})
+
+    assert len(fetched) == 12
+    assert http.max_active <= 2
+
+
+def test_host_limiter_drops_elements_of_dead_host(http):
+    urls = [http.url(f'/flaky/{i}?fail=100', host='localhost') for i in range(10)] + \
+        [http.url('/jpeg/ok')]
+    fetched, failed = [], []
+    util.fetch_with_callback(urls, fetched.append, lambda data, error, dead: failed.append(error), async_limit=1,
+                             host_limits={'initial_concurrency': 1, 'max_failures': 1, 'max_cooldowns': 0})
+
+    assert [response[0] for response in fetched] == [http.url('/jpeg/ok')]
+    assert failed.count(FETCH_ERROR_SERVER) == 1
+    assert failed.count(FETCH_ERROR_HOST_DEAD) == 9
+    assert sum(http.hits.values()) == 2
+
+
+def test_host_limiter_aimd():
+    async def run():
+        limiter = util.HostLimiter(initial_concurrency=4, max_concurrency=8, latency_target=1.0)
+        data = 'http://example.com/a'
+        assert await limiter.try_acquire(data)
+        limiter.release(data, True, 0.1)
+        grown = limiter.stats()['example.com'][0]
+        assert await limiter.try_acquire(data)
+        limiter.release(data, False, 0.1)
+        return grown, limiter.stats()['example.com']
+
+    grown, (concurrency, active, parked, _, error_rate, in_cooldown, dead) = asyncio.run(run())
+    assert grown == 4  # 4 + 1/4 slots
+    assert concurrency == 2
+    assert (active, parked, in_cooldown, dead) == (0, 0, False, False)
+    assert error_rate > 0
+
+
+def test_retry_policy_delays_and_caps():
+    policy = util.RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=1.5)
+    assert policy.attempts_allowed(FETCH_ERROR_SERVER) == 3
+    assert policy.attempts_allowed(FETCH_ERROR_NOT_FOUND) == 1
+    assert policy.next_delay(FETCH_ERROR_NOT_FOUND, 1) is None
+    assert all(0 <= policy.next_delay(FETCH_ERROR_SERVER, 2) <= 1.5 for _ in range(100))
+    assert policy.next_delay(FETCH_ERROR_SERVER, 3) is None
+
+
+def test_fetch_retries_until_success_or_dead(http):
+    urls = [http.url('/flaky/a?fail=2'), http.url('/flaky/b?fail=10'), http.url('/missing/c')]
+    fetched, failed = [], {}
+    util.fetch_with_callback(urls, fetched.append, lambda data, error, dead: failed.update({data: (error, dead)}),
+                             on_fail=URL_ON_FAIL_RETRY, async_limit=3,
+                             retry_policy=util.RetryPolicy(max_attempts=4, base_delay=0.01, max_delay=0.02),
+                             host_limits={'max_failures': 100})
+
+    assert [response[0] for response in fetched] == [http.url('/flaky/a?fail=2')]
+    assert http.hits['/flaky/a'] == 3
+    assert failed == {http.url('/flaky/b?fail=10'): (FETCH_ERROR_SERVER, True),
+                      http.url('/missing/c'): (FETCH_ERROR_NOT_FOUND, True)}
+    assert http.hits['/flaky/b'] == 4
+    assert http.hits['/missing/c'] == 1
+
+
+def test_body_policy_sniffs_caps_and_spools(http, tmp_path, monkeypatch):
+    urls = [http.url('/jpeg/small'), http.url('/html/page'), http.url('/big/huge?size=4194304'),
+            http.url('/big/fits?size=131072')]
+    fetched, failed = {}, {}
+    body = util.BodyPolicy(max_size=1 << 20, spool_dir=str(tmp_path), chunk_size=1 << 14)
+    # spool files are written by threads, not by the thread running the event loop
+    threads = set()
+    write = util._Spool.write
+    monkeypatch.setattr(util._Spool, 'write',
+                        lambda self, chunks: threads.add(threading.get_ident()) or write(self, chunks))
+    util.fetch_with_callback(urls, lambda response: fetched.update([response]),
+                             lambda data, error, dead: failed.update({data: error}), async_limit=4, body=body)
+    assert threads and threading.get_ident() not in threads
+
+    assert failed == {http.url('/html/page'): FETCH_ERROR_NON_IMAGE, http.url('/big/huge?size=4194304'):
+                      FETCH_ERROR_TOO_LARGE}
+    small, fits = fetched[http.url('/jpeg/small')], fetched[http.url('/big/fits?size=131072')]
+    assert isinstance(small, util.SpooledBody) and small.kind == 'jpeg'
+    assert small.read() == jpeg_bytes('small')
+    assert small.digest == hashlib.sha256(jpeg_bytes('small')).hexdigest()
+    assert fits.size == len(jpeg_bytes('fits')) + 131072
+    # rejected bodies leave no files behind
+    assert len(os.listdir(str(tmp_path))) == 2
+    small.discard()
+    fits.discard()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_sniff_image():
+    assert util.sniff_image(jpeg_bytes('a')[:SNIFF_SIZE]) == 'jpeg'
+    assert util.sniff_image(b'\x89PNG\r\n\x1a\n\x00\x00\x00\x0d') == 'png'
+    assert util.sniff_image(b'RIFF\x00\x00\x00\x00WEBP') == 'webp'
+    assert util.sniff_image(b'<!DOCTYPE html>') is None
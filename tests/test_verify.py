@@ -0,0 +1,40 @@
+import io
+import hashlib
+import pytest
+from imagenet_pkg.verify import ImageVerifier, load_placeholder_hashes
+from imagenet_pkg.constants import *
+from conftest import seed, query, states, open_session, real_jpeg
+
+PIL = pytest.importorskip('PIL')
+import PIL.Image
+
+
+def test_verifier_rejects_and_downscales(tmp_path):
+    small, large = real_jpeg(40, 30), real_jpeg(200, 100)
+    placeholder = real_jpeg(10, 10, color=(0, 0, 0))
+    (tmp_path / 'placeholders.txt').write_text(f'# known placeholders\n{hashlib.sha256(placeholder).hexdigest()}\n')
+    verifier = ImageVerifier(max_side=64, placeholder_hashes=load_placeholder_hashes(str(tmp_path /
+                                                                                          'placeholders.txt')))
+
+    def verify(data):
+        return verifier.verify(data, hashlib.sha256(data).hexdigest())
+
+    assert verify(small) == (None, (40, 30))
+    resized, size = verify(large)
+    assert size == (64, 32)
+    assert PIL.Image.open(io.BytesIO(resized)).size == (64, 32)
+    assert verify(placeholder) is None
+    assert verify(large[:len(large) // 2]) is None
+
+
+def test_pull_records_dimensions_of_verified_images(dsn, http, tmp_path):
+    urls = [http.url('/real/40x30'), http.url('/real/200x100'), http.url('/jpeg/corrupt')]
+    seed(dsn, {'n00000000': ['n00000001']}, {'n00000001': urls})
+    with open_session(dsn, tmp_path, verifier=ImageVerifier(max_side=64)) as api:
+        api.fetch(api.get_urls('n00000001'))
+        entries = api.images_entries('n00000001')
+
+    assert states(dsn) == {urls[0]: URL_STATE_SAVED, urls[1]: URL_STATE_SAVED, urls[2]: URL_STATE_NON_IMAGE}
+    assert sorted(query(dsn, 'SELECT width, height FROM url_states WHERE width IS NOT NULL;')) == \
+        [(40, 30), (64, 32)]
+    assert sorted((width, height) for _, _, _, width, height in entries) == [(40, 30), (64, 32)]